@@ -1,28 +1,58 @@
 import re
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from llm_tool import tool
 
-from model import Model
+from model import Model, GenerationRequest, GenerationStats
+from constrained import get_function_schemas
+from utils import StopPattern
 from const import (
-    ModelType
+    ModelType,
+    PromptSegments,
 )
-from logger import logger
+from logger import EpisodeMetrics, get_logger
 
 from typing import List, Dict, Any, Optional
 
+log = get_logger(__name__)
+
 LOG_FILE = "run_logs/log.txt"
 MISTAKE_1_COUNTER = 0
 MISTAKE_2_COUNTER = 0
 MISTAKE_3_COUNTER = 0
 GENERATED_TOKENS = 0
 
+# stop as soon as the decision is given / the function call's ```json fence is closed
+DECISION_STOP_PATTERN = StopPattern(r'"answer":\s*(true|false)', window=64)
+FUNCTION_CALL_STOP_PATTERN = StopPattern(r'```json\s*\{[\s\S]*\}\s*```$', window=8192, trigger='```')
+
 @dataclass
 class FunctionCalled:
     name: str
     arguments: Dict[str, Any]
     response: Any
+    # what the call changed in the state (see `state_render.StateRenderer.diff`), shown with the call if set.
+    # Left out of the repr, which is what legacy result records store and `evaluate` parses
+    state_changes: Optional[str] = field(default=None, repr=False)
+    # seconds: "started" since the start of the episode, "wait_and_generation" until the call was generated (queued
+    # behind other episodes' generations included, see the generation metrics for the model's own time), "duration"
+    # of the call
+    timings: Dict[str, float] = field(default_factory=dict, repr=False)
+
+    def to_record(self) -> Dict[str, Any]:
+        '''
+        The call as stored in the result records (see `evaluate.parse_function_calls`).
+        '''
+        record = {
+            "name": self.name,
+            "arguments": self.arguments,
+            "response": self.response,
+        }
+        if self.state_changes is not None:
+            record["state_changes"] = json.loads(self.state_changes)
+        record["timings"] = self.timings
+        return record
 
 class DecisionAgentPrompt:
 
@@ -32,35 +62,44 @@ class DecisionAgentPrompt:
         user_prompt: str,
         think: bool = True,
         additional_instructions: Optional[str] = None,
-        additional_state: Optional[str] = None
+        additional_state: Optional[str] = None,
+        max_history_steps: Optional[int] = None,
+        initial_state: Optional[str] = None,
     ):
         self.function_definitions = function_definitions
         self.user_prompt = user_prompt
         self.functions_called: List[FunctionCalled] = []
-        self.functions_called_str: str = ''
+        # rendered chunk of every function called, rendered once when the function is called
+        self._history: List[str] = []
         self.think = think
         self.additional_instructions = additional_instructions
         self.additional_state = additional_state
+        # state before any function is called, shown once before the functions called (which carry their state changes)
+        self.initial_state = initial_state
+        # only the last `max_history_steps` functions called are shown in the prompt (all if None)
+        self.max_history_steps = max_history_steps
     
     def function_called(self, func: FunctionCalled) -> None:
         self.functions_called.append(func)
-        self._parse_functions_called()
+        self._history.append(self._render_function_called(len(self._history), func))
     
-    def _parse_functions_called(self) -> None:
-        if not len(self.functions_called):
-            self.functions_called_str = ""
-            return
-            
-        self.functions_called_str = json.dumps([
-            {
-                "name": func.name,
-                "arguments": func.arguments,
-                "response": func.response,
-            } for func in self.functions_called
-        ])
-        
-    def get_prompt(self) -> str:
-        return f'''
+    @property
+    def functions_called_str(self) -> str:
+        # the chunks concatenate to the JSON list of the functions called
+        return f"{''.join(self._history)}]" if self._history else ""
+    
+    def _render_function_called(self, index: int, func: FunctionCalled) -> str:
+        item = {
+            "name": func.name,
+            "arguments": func.arguments,
+            "response": func.response,
+        }
+        if func.state_changes is not None:
+            item["state_changes"] = json.loads(func.state_changes)
+        return ("[" if index == 0 else ", ") + json.dumps(item)
+    
+    def get_segments(self) -> PromptSegments:
+        head = f'''
 You are a helpful assistant which decides whether the user's query is satisfied or not.
 Your task is to answer whether or not the user's query is satisfied based on the functions already called.
 You cannot call any of the functions. Your task is to solely decide whether the functions called were enough.
@@ -72,9 +111,9 @@ User prompt: "{self.user_prompt}"
 Available functions:
 {self.function_definitions}
 
-Functions called: {self.functions_called_str if self.functions_called_str else "No functions called yet"}
+{f"The initial state is: {self.initial_state}" if self.initial_state else ""}
 
-You should decide if the above functions and their responses were enough to satisfy the user's query.
+You should decide if the functions called and their responses were enough to satisfy the user's query.
 You should provide answer in JSON format as follows:
 ```json
 {{
@@ -87,7 +126,9 @@ Please give your answer now:
 {"<think>" if self.think else ""}
 Alright so the user query is: "{self.user_prompt}"
 
-and the functions called and their responses were: {self.functions_called_str if self.functions_called_str else "No functions called yet"}
+and the functions called and their responses were: '''
+        
+        tail = f'''{"]" if self._history else "No functions called yet"}
 
 {f"and the additional state is: {self.additional_state}" if self.additional_state else ""}
 
@@ -95,6 +136,19 @@ What are the user prompt's different goals? Are the functions called enough to s
 Let me break it down:
 <token>
 '''
+        segments = PromptSegments(
+            head=head,
+            history=list(self._history),
+            tail=tail,
+            # keep the rendered list valid JSON: the omission note takes the place of the first element
+            omission_note='["{} earlier function calls omitted"',
+        )
+        if self.max_history_steps is not None and len(self._history) > self.max_history_steps:
+            segments = segments.omit_history(len(self._history) - self.max_history_steps)
+        return segments
+    
+    def get_prompt(self) -> str:
+        return self.get_segments().text()
 
 class FunctionAgentPrompt:
 
@@ -104,27 +158,33 @@ class FunctionAgentPrompt:
         user_prompt: str,
         think: bool = True,
         additional_instructions: Optional[str] = None,
-        additional_state: Optional[str] = None
+        additional_state: Optional[str] = None,
+        max_history_steps: Optional[int] = None,
+        initial_state: Optional[str] = None,
     ):
         self.function_definitions = function_definitions
         self.user_prompt = user_prompt
         self.functions_called: List[FunctionCalled] = []
-        self.functions_called_str: str = ''
+        # rendered chunk of every function called, rendered once when the function is called
+        self._history: List[str] = []
         self.think = think
         self.additional_instructions = additional_instructions
         self.additional_state = additional_state
+        # state before any function is called, shown once before the functions called (which carry their state changes)
+        self.initial_state = initial_state
+        # only the last `max_history_steps` functions called are shown in the prompt (all if None)
+        self.max_history_steps = max_history_steps
     
     def function_called(self, func: FunctionCalled) -> None:
         self.functions_called.append(func)
-        self._parse_functions_called()
+        self._history.append(self._render_function_called(len(self._history), func))
     
-    def _parse_functions_called(self) -> None:
-        if not len(self.functions_called):
-            self.functions_called_str = ""
-            return
-            
-        self.functions_called_str = '\n\n'.join([
-            f'''
+    @property
+    def functions_called_str(self) -> str:
+        return ''.join(self._history)
+    
+    def _render_function_called(self, index: int, func: FunctionCalled) -> str:
+        return ('' if index == 0 else '\n\n') + f'''
             Step {index+1}
             I call the function:
             ```json
@@ -141,11 +201,12 @@ class FunctionAgentPrompt:
                 "function_name": "{func.name}",
                 "response": {func.response}
             }}
-            ''' for index, func in enumerate(self.functions_called)
-        ])
-        
-    def get_prompt(self) -> str:
-        return f'''
+            {f"""
+            The state changed: {func.state_changes}
+            """ if func.state_changes is not None else ""}'''
+    
+    def get_segments(self) -> PromptSegments:
+        head = f'''
 You are a helpful assistant which can use functions in order to satisfy the user's query.
 These are the functions which you have access to:
 {self.function_definitions}
@@ -156,6 +217,8 @@ Your task is to give the next function which should be called in order to satisf
 
 User prompt: "{self.user_prompt}"
 
+{f"The initial state is: {self.initial_state}" if self.initial_state else ""}
+
 You should give the next function which should be called.
 You should provide ONLY ONE function, the one that should be called right now.
 Give a SINGLE function call. Give a SINGLE JSON object.
@@ -174,19 +237,29 @@ Give your answer in JSON format as follows:
 Please give your answer now:
 
 {"<think>" if self.think else ""}
-{self.functions_called_str if self.functions_called_str else "I haven't called any functions yet."}
+'''
+        
+        tail = f'''{"" if self._history else "I haven't called any functions yet."}
 
 {f"and the additional state is: {self.additional_state}" if self.additional_state else ""}
 
 What function should I call next?
 <token>
 '''
+        segments = PromptSegments(head=head, history=list(self._history), tail=tail)
+        if self.max_history_steps is not None and len(self._history) > self.max_history_steps:
+            segments = segments.omit_history(len(self._history) - self.max_history_steps)
+        return segments
+    
+    def get_prompt(self) -> str:
+        return self.get_segments().text()
 
 class DecisionAgent:
     def __init__(
         self,
         model: ModelType,
         prompt: DecisionAgentPrompt,
+        metrics: Optional[EpisodeMetrics] = None,
         **kwargs,
     ):
         self.model = Model(
@@ -194,13 +267,28 @@ class DecisionAgent:
             **kwargs
         )
         self.prompt = prompt
+        # metrics of the episode the agent runs in
+        self.metrics = metrics if metrics is not None else EpisodeMetrics()
     
-    def decide(self) -> bool:
-        global GENERATED_TOKENS
-        out = self.model.prompt(
-            self.prompt.get_prompt()
+    def generation_request(self) -> GenerationRequest:
+        return GenerationRequest(
+            prompt=self.prompt.get_segments(),
+            stop_patterns=[DECISION_STOP_PATTERN],
         )
-        logger.mistake_counters["generated_tokens"] += self.model.last_generated_tokens
+    
+    def decide(self) -> bool:
+        out = self.model.prompt_request(self.generation_request())
+        return self.parse_decision(out, self.model.last_stats)
+    
+    async def decide_async(self, backend) -> bool:
+        '''
+        Same as `decide`, but the generation is queued on `backend` (see `scheduler.BatchingBackend`).
+        '''
+        out, stats = await backend.generate(self.model, self.generation_request())
+        return self.parse_decision(out, stats)
+    
+    def parse_decision(self, out: str, stats: GenerationStats) -> bool:
+        self.metrics.record_generation(stats)
         out=out.split('<token>')[1]
         
         reg = r'"answer":\s*(true|false)'
@@ -209,7 +297,8 @@ class DecisionAgent:
         if m:
             answer = m.group(1)
             return answer == "true"
-        logger.mistake_counters["type_1"] += 1
+        self.metrics.mistake_counters["type_1"] += 1
+        self.metrics.parse_failures += 1
         raise Exception("Could not parse answer")
 
 class FunctionAgent:
@@ -217,6 +306,8 @@ class FunctionAgent:
         self,
         model: ModelType,
         prompt: FunctionAgentPrompt,
+        constrained: bool = False,
+        metrics: Optional[EpisodeMetrics] = None,
         **kwargs,
     ):
         self.model = Model(
@@ -224,12 +315,38 @@ class FunctionAgent:
             **kwargs,
         )
         self.prompt = prompt
+        # constrained decoding: the model can only produce a valid call to one of the available functions
+        self.function_schemas = get_function_schemas(prompt.function_definitions) if constrained else None
+        # metrics of the episode the agent runs in
+        self.metrics = metrics if metrics is not None else EpisodeMetrics()
     
-    def get_next_function(self) -> Dict[str, Any]:
-        out = self.model.prompt(
-            self.prompt.get_prompt()
+    def generation_request(self) -> GenerationRequest:
+        if self.function_schemas is not None:
+            segments = self.prompt.get_segments()
+            segments.tail += "```json\n"
+            return GenerationRequest(prompt=segments, function_schemas=self.function_schemas)
+        
+        return GenerationRequest(
+            prompt=self.prompt.get_segments(),
+            stop_patterns=[FUNCTION_CALL_STOP_PATTERN],
         )
-        logger.mistake_counters["generated_tokens"] += self.model.last_generated_tokens
+    
+    def get_next_function(self) -> Dict[str, Any]:
+        out = self.model.prompt_request(self.generation_request())
+        return self.parse_function_call(out, self.model.last_stats)
+    
+    async def get_next_function_async(self, backend) -> Dict[str, Any]:
+        '''
+        Same as `get_next_function`, but the generation is queued on `backend` (see `scheduler.BatchingBackend`).
+        '''
+        out, stats = await backend.generate(self.model, self.generation_request())
+        return self.parse_function_call(out, stats)
+    
+    def parse_function_call(self, out: str, stats: GenerationStats) -> Dict[str, Any]:
+        self.metrics.record_generation(stats)
+        if self.function_schemas is not None:
+            return self._parse_constrained_function_call(out)
+        
         out=out.split('<token>')[-1]
         
         reg = re.compile(
@@ -244,8 +361,8 @@ class FunctionAgent:
 
         if matches:
             if len(matches) > 1:
-                print("[CORE]: MORE THAN ONE OUTPUT JSON")
-                logger.mistake_counters["type_1"] += 1
+                log.info("[CORE]: MORE THAN ONE OUTPUT JSON")
+                self.metrics.mistake_counters["type_1"] += 1
                 # raise Exception("More than one function call found")
             
             check_chars = ['{', '}', ':', '[', ']', ',', ' ']
@@ -267,7 +384,7 @@ class FunctionAgent:
                 t += "'"
             last_function_call = t
 
-            print(f"Last function call: {last_function_call}")
+            log.debug("Last function call: %s", last_function_call)
             
             try:
                 try:
@@ -275,14 +392,28 @@ class FunctionAgent:
                 except json.decoder.JSONDecodeError as e:
                     return json.loads(last_function_call+'\n}')
             except json.decoder.JSONDecodeError as e:
-                print(f'Error: {repr(e)}')
-                print('[CORE]: INVALID JSON')
-                logger.mistake_counters["type_2"] += 1
+                log.info("[CORE]: INVALID JSON: %r", e)
+                self.metrics.mistake_counters["type_2"] += 1
+                self.metrics.parse_failures += 1
                 raise e
         
-        print("[CORE]: NOT FOLLOWING SYSTEM PROMPT FORMAT")
-        logger.mistake_counters["type_1"] += 1
+        log.info("[CORE]: NOT FOLLOWING SYSTEM PROMPT FORMAT")
+        self.metrics.mistake_counters["type_1"] += 1
+        self.metrics.parse_failures += 1
         raise Exception("Could not parse answer")
+    
+    def _parse_constrained_function_call(self, out: str) -> Dict[str, Any]:
+        out = out.split('<token>')[-1]
+        out = out[out.index('```json') + len('```json'):]
+        
+        try:
+            return json.loads(out)
+        except json.decoder.JSONDecodeError as e:
+            # the output budget ran out before the function call was complete
+            log.info("[CORE]: INVALID JSON: %r", e)
+            self.metrics.mistake_counters["type_2"] += 1
+            self.metrics.parse_failures += 1
+            raise e
 
 @tool()
 def search_restaurant(location: str, cuisine: str, budget: str = "medium") -> List[str]:
@@ -5,16 +5,23 @@ import json
 import time
 from datetime import datetime
 import uuid
+from functools import partial
 
 from const import ModelType, MessageType, Role
 from model import Model
 from agents import DecisionAgentPrompt, DecisionAgent, FunctionAgentPrompt, FunctionAgent, FunctionCalled
 from llm_tool import tool
 
+from worlds.world import World
 from worlds import Automation, Communication, Configurations, CRUD, DesktopManager, EventsScheduler, FileManagement, LegalCompliance, Computations, Navigation, Transactions, Validation, WebBrowsing, Writing
-from logger import logger
+from logger import EpisodeMetrics, get_logger
+from scheduler import BatchingBackend, EpisodeScheduler
+from results import ResultSink
+from state_render import STATE_MODES, StateRenderer
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+log = get_logger(__name__)
 
 
 tests = {
@@ -44,168 +51,254 @@ def load_prompt_dataset(dataset_file: str) -> List[Dict]:
     }
     return prompt_dict
 
-def main(model: str, output_file: str):
-
-    # load dataset
-    dataset_file = 'all_worlds_dataset.json'
+def load_prompts(dataset_file: str = 'all_worlds_dataset.json') -> List[Tuple[object, Dict, str]]:
+    '''
+    Lists the (world, prompt, user prompt) of every prompt to run, in the order they are run.
+    '''
     prompt_dict = load_prompt_dataset(dataset_file)
+    
+    prompts = []
+    for world in list(tests.values()):
+        for prompt in world.prompts:
+            # prompt from dataset
+            current_prompt = prompt_dict.get(prompt['prompt_id'], None)
+            if current_prompt is None:
+                log.warning("Prompt with id %s not found in dataset.", prompt["prompt_id"])
+                continue
+            
+            user_prompt = current_prompt.get('prompt', None)
+            if user_prompt is None:
+                log.warning("Prompt with id %s not found in dataset.", prompt["id"])
+                continue
+            
+            prompts.append((world, prompt, user_prompt))
+    return prompts
 
-    OUTPUT_TOKENS_CAP = 10_000
+async def run_episode(
+    model: ModelType,
+    template: World,
+    prompt: Dict,
+    user_prompt: str,
+    backend: BatchingBackend,
+    output_tokens_cap: int,
+    seed: Optional[int] = None,
+    state_mode: str = "repr",
+    constrained: bool = False,
+) -> Dict:
+    '''
+    Runs the agents on a single prompt of a world and returns its result record.
     
-    GENERATED_TOKENS_AVG = 0
-    RESULTS = []
+    Every episode gets its own fork of the `template` world and its own metrics, so episodes can run concurrently.
+    `state_mode` is how the world state is shown to the agents (see `state_render.STATE_MODES`).
+    With `constrained`, the function agent can only generate valid calls to the available functions.
+    '''
+    world = template.fork()
+    episode_metrics = EpisodeMetrics(prompt['prompt_id'])
     
-    try:
+    log.info("---------------------- PROMPT: %s ----------------------", user_prompt)
     
-        for world in list(tests.values()):
-            logger.reset()
-            print(f'---------------------- WORLD: {world.__class__.__name__} ----------------------')
-            for prompt in world.prompts:
-                logger.reset()
-                
-                # prompt from dataset
-                current_prompt = prompt_dict.get(prompt['prompt_id'], None)
-                if current_prompt is None:
-                    print(f'Prompt with id {prompt["prompt_id"]} not found in dataset.')
-                    continue
-                
-                user_prompt = current_prompt.get('prompt', None)
-                if user_prompt is None:
-                    print(f'Prompt with id {prompt["id"]} not found in dataset.')
-                    continue
-                
-                print(f'---------------------- PROMPT: {user_prompt} ----------------------')
-                
-                # from agents import GENERATED_TOKENS
-                # temp_generated_tokens = GENERATED_TOKENS
-                prev_generated_tokens = logger.mistake_counters["generated_tokens"]
-                
-                setup_functions = prompt.get('functions', [])
-            
-                # reset the database
-                world.reset_world_state()
+    setup_functions = prompt.get('functions', [])
 
-                # run setup functions
-                for function in setup_functions:
-                    eval(f'world.{function}')
+    # reset the database
+    world.reset_world_state()
 
-                tool_definitions = world.tool_definitions
-            
-                FUNCTION_SYSTEM_PROMPT = world.function_system_prompt
-                DECISION_SYSTEM_PROMPT = world.decision_system_prompt
-
-                decision_prompt = DecisionAgentPrompt(
-                    function_definitions=tool_definitions,
-                    user_prompt=user_prompt,
-                    additional_instructions=DECISION_SYSTEM_PROMPT,
-                    additional_state=world.world_state_description.format(world.world_state)
-                )
-
-                function_prompt = FunctionAgentPrompt(
-                    function_definitions=tool_definitions,
-                    user_prompt=user_prompt,
-                    additional_instructions=FUNCTION_SYSTEM_PROMPT,
-                    additional_state=world.world_state_description.format(world.world_state)
-                )
-                
-                decision_agent = DecisionAgent(
-                    model=model,
-                    prompt=decision_prompt,
-                    max_output_length=OUTPUT_TOKENS_CAP,
-                )
-                
-                function_agent = FunctionAgent(
-                    model=model,
-                    prompt=function_prompt,
-                    max_output_length=OUTPUT_TOKENS_CAP,
-                )
-                
-                while True:
-                    
-                    try:
-                        function = function_agent.get_next_function()
-                    except Exception as e:
-                        print(f'Error: {repr(e)}')
-                        print(f'Failed to parse function')
-                        break
-                    
-                    print(f'Calling function: {function}')
-                    
-                    try:
-                        resp = getattr(world, function["function_name"])(**function["arguments"])
-                    except AttributeError as e:
-                        # function does not exist
-                        print(f'Error: {repr(e)}')
-                        print('Failed to call function')
-                        print('[CORE]: FUNCTION CALLING ERROR')
-                        logger.mistake_counters["type_3"] += 1
-                        logger.mistake_counters["function_hallucination"] += 1
-                        break
-                    except TypeError as e:
-                        # parameter does not exist
-                        print(f'Error: {repr(e)}')
-                        print('Failed to call function')
-                        print('[CORE]: FUNCTION CALLING ERROR')
-                        # function or parameter does not exist
-                        logger.mistake_counters["type_3"] += 1
-                        logger.mistake_counters["parameter_hallucination"] += 1
-                        break
-                    except Exception as e:
-                        # "function_name" or "arguments" do not exist -> invalid JSON format
-                        print(f'Error: {repr(e)}')
-                        print('Failed to call function')
-                        logger.mistake_counters["type_2"] += 1
-                        break
-                    
-                    fc = FunctionCalled(
-                        name=function["function_name"],
-                        arguments=function["arguments"],
-                        response=resp,
-                    )
-                    
-                    # update additional states
-                    new_state = world.world_state_description.format(world.world_state)
-                    decision_prompt.additional_state = new_state
-                    function_prompt.additional_state = new_state
-                    
-                    decision_prompt.function_called(fc)
-                    function_prompt.function_called(fc)
-                    
-                    try:
-                        if decision_agent.decide(): break
-                    except Exception as e:
-                        print(f'Error: {repr(e)}')
-                        print('Failed to parse decision')
-                        break
-                    
-                # print mistake counters
-                print(f'------------ logger ------------')
-                print(f'MISTAKE_1_COUNTER: {logger.mistake_counters["type_1"]}')
-                print(f'MISTAKE_2_COUNTER: {logger.mistake_counters["type_2"]}')
-                print(f'MISTAKE_3_COUNTER: {logger.mistake_counters["type_3"]}')
-                print(f'FUNCTION_HALLUCINATION: {logger.mistake_counters["function_hallucination"]}')
-                print(f'PARAMETER_HALLUCINATION: {logger.mistake_counters["parameter_hallucination"]}')
-                print(f'GENERATED_TOKENS: {logger.mistake_counters["generated_tokens"] - prev_generated_tokens}')
-                GENERATED_TOKENS_AVG += logger.mistake_counters["generated_tokens"] - prev_generated_tokens
-                
-                print(f'Sequence: {decision_prompt.functions_called}')
-                RESULTS.append({
-                    "world": world.__class__.__name__,
-                    "prompt_id": prompt['prompt_id'],
-                    "prompt": user_prompt,
-                    "functions_called": str(decision_prompt.functions_called),
-                    "mistakes": {
-                        "MISTAKE_1_COUNTER": logger.mistake_counters["type_1"],
-                        "MISTAKE_2_COUNTER": logger.mistake_counters["type_2"],
-                        "MISTAKE_3_COUNTER": logger.mistake_counters["type_3"],
-                        "FUNCTION_HALLUCINATION": logger.mistake_counters["function_hallucination"],
-                        "PARAMETER_HALLUCINATION": logger.mistake_counters["parameter_hallucination"],
-                    },
-                    "generated_tokens": logger.mistake_counters["generated_tokens"] - prev_generated_tokens,
-                    "database": world.world_state,
-                })
+    # run setup functions
+    for function in setup_functions:
+        eval(f'world.{function}')
+
+    tool_definitions = world.tool_definitions
+
+    FUNCTION_SYSTEM_PROMPT = world.function_system_prompt
+    DECISION_SYSTEM_PROMPT = world.decision_system_prompt
+
+    state_renderer = StateRenderer()
+    
+    def render_state() -> str:
+        if state_mode == "repr":
+            return world.world_state_description.format(world.world_state)
+        return world.world_state_description.format(state_renderer.render(world.world_state))
+    
+    # in "diff" mode the state is shown once, before the functions called, which then carry what they changed
+    state = render_state()
+    initial_state, additional_state = (state, None) if state_mode == "diff" else (None, state)
+
+    decision_prompt = DecisionAgentPrompt(
+        function_definitions=tool_definitions,
+        user_prompt=user_prompt,
+        additional_instructions=DECISION_SYSTEM_PROMPT,
+        additional_state=additional_state,
+        initial_state=initial_state,
+    )
+
+    function_prompt = FunctionAgentPrompt(
+        function_definitions=tool_definitions,
+        user_prompt=user_prompt,
+        additional_instructions=FUNCTION_SYSTEM_PROMPT,
+        additional_state=additional_state,
+        initial_state=initial_state,
+    )
+    
+    decision_agent = DecisionAgent(
+        model=model,
+        prompt=decision_prompt,
+        metrics=episode_metrics,
+        max_output_length=output_tokens_cap,
+        seed=seed,
+    )
+    
+    function_agent = FunctionAgent(
+        model=model,
+        prompt=function_prompt,
+        metrics=episode_metrics,
+        max_output_length=output_tokens_cap,
+        seed=seed,
+        constrained=constrained,
+    )
+    
+    episode_start = time.perf_counter()
+    while True:
+        
+        try:
+            generation_start = time.perf_counter()
+            function = await function_agent.get_next_function_async(backend)
+        except Exception as e:
+            log.info("Failed to parse function: %r", e)
+            break
+        
+        log.debug("Calling function: %s", function)
+        
+        call_start = time.perf_counter()
+        try:
+            resp = getattr(world, function["function_name"])(**function["arguments"])
+        except AttributeError as e:
+            # function does not exist
+            log.info("[CORE]: FUNCTION CALLING ERROR: %r", e)
+            episode_metrics.mistake_counters["type_3"] += 1
+            episode_metrics.mistake_counters["function_hallucination"] += 1
+            break
+        except TypeError as e:
+            # parameter does not exist
+            log.info("[CORE]: FUNCTION CALLING ERROR: %r", e)
+            # function or parameter does not exist
+            episode_metrics.mistake_counters["type_3"] += 1
+            episode_metrics.mistake_counters["parameter_hallucination"] += 1
+            break
+        except Exception as e:
+            # "function_name" or "arguments" do not exist -> invalid JSON format
+            log.info("Failed to call function: %r", e)
+            episode_metrics.mistake_counters["type_2"] += 1
+            break
+        
+        fc = FunctionCalled(
+            name=function["function_name"],
+            arguments=function["arguments"],
+            response=resp,
+            timings={
+                "started": generation_start - episode_start,
+                "wait_and_generation": call_start - generation_start,
+                "duration": time.perf_counter() - call_start,
+            },
+        )
+        
+        # update additional states
+        if state_mode == "diff":
+            fc.state_changes = state_renderer.diff(world.world_state)
+        else:
+            new_state = render_state()
+            decision_prompt.additional_state = new_state
+            function_prompt.additional_state = new_state
+        
+        decision_prompt.function_called(fc)
+        function_prompt.function_called(fc)
+        
+        try:
+            if await decision_agent.decide_async(backend): break
+        except Exception as e:
+            log.info("Failed to parse decision: %r", e)
+            break
+        
+    log.info("------------ metrics: %s ------------\n%s", prompt["prompt_id"], episode_metrics.summary())
+    log.debug("Sequence: %s", decision_prompt.functions_called)
+    return {
+        "world": world.__class__.__name__,
+        "prompt_id": prompt['prompt_id'],
+        "prompt": user_prompt,
+        "functions_called": [fc.to_record() for fc in decision_prompt.functions_called],
+        "mistakes": {
+            "MISTAKE_1_COUNTER": episode_metrics.mistake_counters["type_1"],
+            "MISTAKE_2_COUNTER": episode_metrics.mistake_counters["type_2"],
+            "MISTAKE_3_COUNTER": episode_metrics.mistake_counters["type_3"],
+            "FUNCTION_HALLUCINATION": episode_metrics.mistake_counters["function_hallucination"],
+            "PARAMETER_HALLUCINATION": episode_metrics.mistake_counters["parameter_hallucination"],
+        },
+        "generated_tokens": episode_metrics.generated_tokens,
+        "metrics": episode_metrics.to_dict(),
+        "database": world.world_state,
+    }
+
+def main(
+    model: str,
+    output_file: str,
+    concurrency: int = 1,
+    resume: bool = False,
+    shard: Tuple[int, int] = (0, 1),
+    seed: Optional[int] = None,
+    state_mode: str = "repr",
+    constrained: bool = False,
+):
+    '''
+    Runs every prompt of every world and appends the result of each episode to the JSONL `output_file`
+    as soon as it finishes.
+    
+    :param concurrency: number of episodes kept in flight, their generations are batched together
+    :param resume: keep the results already in `output_file` and skip their prompts
+    :param shard: (index, number of shards): only run every n-th prompt, starting from the index-th (see `sharding`)
+    :param seed: seeds sampling before every generation, so that completions can be cached and replayed (see `completion_cache`)
+    :param state_mode: how the world state is shown to the agents, one of `state_render.STATE_MODES`
+    :param constrained: constrain the function agent's outputs to valid calls of the available functions (see `constrained`)
+    '''
+    if state_mode not in STATE_MODES:
+        raise ValueError(f"Unknown state mode {state_mode!r}, expected one of {STATE_MODES}")
+
+    OUTPUT_TOKENS_CAP = 10_000
+    
+    # function responses are stored as they are, the ones which are not JSON serializable by their repr
+    sink = ResultSink(output_file, resume=resume, default=repr)
+    
+    shard_index, num_shards = shard
+    episodes = []
+    for world, prompt, user_prompt in load_prompts()[shard_index::num_shards]:
+        if prompt['prompt_id'] in sink.completed:
+            log.info("Prompt with id %s already done, skipping.", prompt["prompt_id"])
+            continue
+        
+        episodes.append(partial(
+            run_episode,
+            model,
+            world,
+            prompt,
+            user_prompt,
+            output_tokens_cap=OUTPUT_TOKENS_CAP,
+            seed=seed,
+            state_mode=state_mode,
+            constrained=constrained,
+        ))
+    
+    run_metrics = EpisodeMetrics(output_file)
+    finished = 0
+    
+    def on_result(index: int, result: Dict) -> None:
+        nonlocal finished
+        sink.write(result)
+        run_metrics.merge(result["metrics"])
+        finished += 1
+    
+    try:
+        EpisodeScheduler(concurrency=concurrency).run(episodes, on_result=on_result)
     except KeyboardInterrupt:
-        print('KeyboardInterrupt: Stopping the execution')
+        log.warning("KeyboardInterrupt: Stopping the execution")
+    finally:
+        sink.close()
+    
+    log.info("------------ metrics: %s (%d episodes) ------------\n%s", output_file, finished, run_metrics.summary())
 
-    with open(output_file, 'w') as f:
-        json.dump(RESULTS, f, indent=4)
\ No newline at end of file
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from evaluate import load_world, evaluate_world, load_result_records
+from logger import configure_logging, get_logger
+
+from typing import Any, Dict, List, Optional, Tuple
+
+log = get_logger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_FILE = os.path.join(BASE_DIR, 'all_worlds_dataset.json')
+BFCL_DATASET_FILE = os.path.join(BASE_DIR, 'bfcl_dataset', 'bfcl_dataset_final_list.json')
+
+# dataset entries by prompt id and compiled worlds, per worker process (set by `_init_worker`)
+_entries: Dict[str, Dict] = {}
+_worlds: Dict[str, Dict] = {}
+
+def load_entries(dataset_files: List[str]) -> Dict[str, Dict]:
+    '''
+    Loads the dataset entries (of all_worlds_dataset.json and of the BFCL dataset) by prompt id.
+    '''
+    entries = {}
+    for dataset_file in dataset_files:
+        if not os.path.exists(dataset_file):
+            log.warning("Dataset %s not found, skipping it.", dataset_file)
+            continue
+        with open(dataset_file, 'r') as f:
+            for entry in json.load(f):
+                entries.setdefault(entry["prompt_id"], entry)
+    return entries
+
+def _init_worker(dataset_files: List[str], log_level: Optional[str]) -> None:
+    global _entries
+    configure_logging(log_level)
+    _entries = load_entries(dataset_files)
+
+def _score(task: Tuple[str, List[Dict]]) -> Tuple[Optional[float], Optional[str]]:
+    prompt_id, functions_called = task
+    try:
+        # every prompt is compiled once per worker, whatever the number of results files scoring it
+        if prompt_id not in _worlds:
+            _worlds[prompt_id] = load_world(_entries[prompt_id])
+        return evaluate_world(_worlds[prompt_id], {"functions_called": functions_called}), None
+    except Exception as e:
+        return None, repr(e)
+
+def evaluate_results(
+    results_files: List[str],
+    dataset_files: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+    log_level: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    '''
+    Scores every record of the `results_files` against the DFA of its prompt, in a pool of `workers` processes.
+
+    Records are joined with the dataset entries by prompt id (by prompt for the older records without one).
+    Returns a row per record: results file, prompt id ("?" if no dataset entry has it, the record isn't scored),
+    world, number of function calls, score (None if it isn't scored) and the error scoring it raised, if any.
+    `dataset_files` default to all_worlds_dataset.json and the BFCL dataset, `log_level` is the one of the workers
+    (see `logger.configure_logging`).
+    '''
+    dataset_files = dataset_files or [DATASET_FILE, BFCL_DATASET_FILE]
+    entries = load_entries(dataset_files)
+    by_prompt = {}
+    for prompt_id, entry in entries.items():
+        by_prompt.setdefault(entry["prompt"], prompt_id)
+
+    rows, tasks = [], []
+    for results_file in results_files:
+        for record in load_result_records(results_file):
+            prompt_id = record.get("prompt_id") or by_prompt.get(record.get("prompt"))
+            entry = entries.get(prompt_id)
+            rows.append({
+                "results_file": results_file,
+                "prompt_id": prompt_id or "?",
+                "world": record.get("world") or (entry["world"] if entry else "?"),
+                "calls": len(record["functions_called"]),
+                "score": None,
+                "error": None,
+            })
+            if entry:
+                tasks.append((len(rows) - 1, (prompt_id, record["functions_called"])))
+
+    workers = workers or os.cpu_count() or 1
+    # big enough chunks to amortize the round trips, small enough to balance the workers
+    chunksize = max(1, len(tasks) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dataset_files, log_level)) as executor:
+        scores = executor.map(_score, [task for _, task in tasks], chunksize=chunksize)
+        for (index, _), (score, error) in zip(tasks, scores):
+            rows[index]["score"] = score
+            rows[index]["error"] = error
+    return rows
+
+def summarize(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Aggregates the rows of `evaluate_results` per results file and world: number of records, of records without
+    a dataset entry (unscored) and of records whose scoring failed (errors), mean score of the scored ones and
+    number of perfect scores.
+    '''
+    groups = defaultdict(list)
+    for row in rows:
+        groups[(row["results_file"], row["world"])].append(row)
+
+    summary = []
+    for (results_file, world), group in groups.items():
+        scores = [row["score"] for row in group if row["score"] is not None]
+        summary.append({
+            "results_file": results_file,
+            "world": world,
+            "records": len(group),
+            "unscored": sum(1 for row in group if row["score"] is None and row["error"] is None),
+            "errors": sum(1 for row in group if row["error"] is not None),
+            "mean_score": sum(scores) / len(scores) if scores else None,
+            "perfect": sum(1 for score in scores if score == 1),
+        })
+    return summary
+
+def format_table(rows: List[Dict[str, Any]], columns: List[str]) -> str:
+    def cell(value: Any) -> str:
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.3f}"
+        return str(value)
+
+    cells = [columns] + [[cell(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in cells)
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Scores results files against the DFAs of their prompts.")
+    parser.add_argument("results_files", nargs="+", help="results files (JSONL, or the older JSON lists)")
+    parser.add_argument("--dataset", action="append", dest="dataset_files",
+                        help=f"dataset with the DFAs of the prompts, can be repeated (default: {DATASET_FILE} and {BFCL_DATASET_FILE})")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--summary-only", action="store_true", help="only print the per world summary")
+    parser.add_argument("--log-level", default=None, help="e.g. DEBUG to trace every function call (default: $LOG_LEVEL, else INFO)")
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+
+    rows = evaluate_results(args.results_files, args.dataset_files, args.workers, args.log_level)
+
+    if not args.summary_only:
+        print(format_table(rows, ["results_file", "prompt_id", "world", "calls", "score", "error"]))
+        print()
+    print(format_table(summarize(rows), ["results_file", "world", "records", "unscored", "errors", "mean_score", "perfect"]))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
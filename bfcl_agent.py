@@ -4,18 +4,25 @@ import sys
 import json
 import time
 from copy import deepcopy
+from functools import partial
 from datetime import datetime
 import uuid
 
 from bfcl_dataset import GorillaFileSystem, MathAPI, MessageAPI, TwitterAPI, TicketAPI, TradingBot, TravelAPI, VehicleControlAPI
+from bfcl_dataset.scenario_cache import ScenarioCache
 from const import ModelType, MessageType, Role
 from model import Model
 from agents import DecisionAgentPrompt, DecisionAgent, FunctionAgentPrompt, FunctionAgent, FunctionCalled
 from llm_tool import tool
 
-from logger import logger
+from logger import EpisodeMetrics, get_logger
+from scheduler import BatchingBackend, EpisodeScheduler
+from results import ResultSink
+from state_render import STATE_MODES, StateRenderer
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+log = get_logger(__name__)
 
 bfcl_worlds = {
     "GorillaFileSystem": GorillaFileSystem,
@@ -28,6 +35,9 @@ bfcl_worlds = {
     "VehicleControlAPI": VehicleControlAPI,
 }
 
+# every distinct initial config of a world is loaded once, episodes get forks of it
+scenario_cache = ScenarioCache(bfcl_worlds)
+
 def load_tool_definitions(tool_definitions_file: str) -> List[Dict]:
     with open(tool_definitions_file, 'r') as f:
         tool_definitions = json.load(f)
@@ -55,12 +65,179 @@ def _prep_name(name: str) -> str:
     name = name.replace('Api', 'API')
     return name
 
-def main(
-    model: str,
-    output_file: str
-):
+async def run_episode(
+    model: ModelType,
+    test_entry: Dict,
+    tool_definitions: Dict[str, List[Dict]],
+    tool_to_world_map: Dict[str, str],
+    backend: BatchingBackend,
+    output_tokens_cap: int,
+    seed: Optional[int] = None,
+    state_mode: str = "repr",
+    constrained: bool = False,
+) -> Dict:
+    '''
+    Runs the agents on a single BFCL test entry and returns its result record.
+    
+    Every episode gets its own world instances and metrics, so episodes can run concurrently.
+    `state_mode` is how the world states are shown to the agents (see `state_render.STATE_MODES`).
+    With `constrained`, the function agent can only generate valid calls to the available functions.
+    '''
+    log.debug("Test entry: %s", test_entry)
+    episode_metrics = EpisodeMetrics(test_entry['prompt_id'])
 
-    # load datasets
+    active_worlds = {}
+    for world in test_entry['involved_classes']:
+        log.debug("Loading world: %s", world)
+        # every world only gets its own part of the initial config
+        active_worlds[world] = scenario_cache.fork(world, test_entry['initial_config'].get(world, {}))
+        log.debug("World %s loaded successfully", world)
+        
+    # prompt from dataset
+    user_prompt = test_entry["prompt"]
+    
+    log.info("---------------------- PROMPT: %s ----------------------", user_prompt)
+    
+    # world name -> attribute -> value, so that state changes are shown per attribute
+    state_renderer = StateRenderer(depth=2)
+    
+    def world_states() -> Dict[str, Dict]:
+        # some worlds (e.g. MathAPI) have no state
+        return {
+            world: active_worlds[world].get_state() if hasattr(active_worlds[world], "get_state") else {}
+            for world in active_worlds
+        }
+    
+    def render_state(states: Dict[str, Dict]) -> str:
+        return str(states) if state_mode == "repr" else state_renderer.render(states)
+    
+    states = world_states()
+    # in "diff" mode the state is shown once, before the functions called, which then carry what they changed
+    state = render_state(states)
+    initial_state, additional_state = (state, None) if state_mode == "diff" else (None, state)
+
+    decision_prompt = DecisionAgentPrompt(
+        function_definitions=tool_definitions,
+        user_prompt=user_prompt,
+        # additional_instructions=DECISION_SYSTEM_PROMPT,
+        additional_state=additional_state,
+        initial_state=initial_state,
+    )
+
+    function_prompt = FunctionAgentPrompt(
+        function_definitions=tool_definitions,
+        user_prompt=user_prompt,
+        # additional_instructions=FUNCTION_SYSTEM_PROMPT,
+        additional_state=additional_state,
+        initial_state=initial_state,
+    )
+    
+    decision_agent = DecisionAgent(
+        model=model,
+        prompt=decision_prompt,
+        metrics=episode_metrics,
+        max_output_length=output_tokens_cap,
+        seed=seed,
+    )
+    
+    function_agent = FunctionAgent(
+        model=model,
+        prompt=function_prompt,
+        metrics=episode_metrics,
+        max_output_length=output_tokens_cap,
+        seed=seed,
+        constrained=constrained,
+    )
+    
+    episode_start = time.perf_counter()
+    while True:
+        
+        try:
+            generation_start = time.perf_counter()
+            function = await function_agent.get_next_function_async(backend)
+        except Exception as e:
+            log.info("Failed to parse function: %r", e)
+            break
+        
+        log.debug("Calling function: %s", function)
+        
+        call_start = time.perf_counter()
+        try:
+            world_name = tool_to_world_map[function["function_name"]]
+            world = active_worlds[world_name]
+            resp = getattr(world, function["function_name"])(**function["arguments"])
+        except AttributeError as e:
+            # function does not exist
+            log.info("[CORE]: FUNCTION CALLING ERROR: %r", e)
+            episode_metrics.mistake_counters["type_3"] += 1
+            episode_metrics.mistake_counters["function_hallucination"] += 1
+            break
+        except TypeError as e:
+            # parameter does not exist
+            log.info("[CORE]: FUNCTION CALLING ERROR: %r", e)
+            # function or parameter does not exist
+            episode_metrics.mistake_counters["type_3"] += 1
+            episode_metrics.mistake_counters["parameter_hallucination"] += 1
+            break
+        except Exception as e:
+            # "function_name" or "arguments" do not exist -> invalid JSON format
+            log.info("Failed to call function: %r", e)
+            episode_metrics.mistake_counters["type_2"] += 1
+            break
+        
+        fc = FunctionCalled(
+            name=function["function_name"],
+            arguments=function["arguments"],
+            response=resp,
+            timings={
+                "started": generation_start - episode_start,
+                "wait_and_generation": call_start - generation_start,
+                "duration": time.perf_counter() - call_start,
+            },
+        )
+        
+        # update additional states
+        states = world_states()
+        if state_mode == "diff":
+            fc.state_changes = state_renderer.diff(states)
+        else:
+            additional_state = render_state(states)
+            decision_prompt.additional_state = additional_state
+            function_prompt.additional_state = additional_state
+        
+        decision_prompt.function_called(fc)
+        function_prompt.function_called(fc)
+        
+        try:
+            if await decision_agent.decide_async(backend): break
+        except Exception as e:
+            log.info("Failed to parse decision: %r", e)
+            break
+            
+    log.info("------------ metrics: %s ------------\n%s", test_entry["prompt_id"], episode_metrics.summary())
+    log.debug("Sequence: %s", decision_prompt.functions_called)
+    return {
+        "world": test_entry["world"],
+        "prompt_id": test_entry['prompt_id'],
+        "prompt": user_prompt,
+        "functions_called": [fc.to_record() for fc in decision_prompt.functions_called],
+        "mistakes": {
+            "MISTAKE_1_COUNTER": episode_metrics.mistake_counters["type_1"],
+            "MISTAKE_2_COUNTER": episode_metrics.mistake_counters["type_2"],
+            "MISTAKE_3_COUNTER": episode_metrics.mistake_counters["type_3"],
+            "FUNCTION_HALLUCINATION": episode_metrics.mistake_counters["function_hallucination"],
+            "PARAMETER_HALLUCINATION": episode_metrics.mistake_counters["parameter_hallucination"],
+        },
+        "generated_tokens": episode_metrics.generated_tokens,
+        "metrics": episode_metrics.to_dict(),
+        "database": states,
+    }
+
+def load_datasets() -> Tuple[Dict[str, Dict], Dict[str, List[Dict]], Dict[str, str]]:
+    '''
+    Loads the test entries (by prompt id, in the order they are run), the tool definitions of every world
+    and the map of tool name -> world name.
+    '''
     base_dir = os.path.dirname(os.path.abspath(__file__))
     dataset_file = os.path.join(base_dir, 'bfcl_dataset', 'bfcl_dataset_final_list.json')
     test_entry_dict = load_test_entries_dataset(dataset_file)
@@ -75,157 +252,79 @@ def main(
             for tool_def in _tool_definitions:
                 tool_to_world_map[tool_def["name"]] = name  # map tool name to world name
             tool_definitions[name] = _tool_definitions
+    
+    return test_entry_dict, tool_definitions, tool_to_world_map
 
+def main(
+    model: str,
+    output_file: str,
+    concurrency: int = 1,
+    resume: bool = False,
+    shard: Tuple[int, int] = (0, 1),
+    seed: Optional[int] = None,
+    state_mode: str = "repr",
+    constrained: bool = False,
+):
+    '''
+    Runs every BFCL test entry and appends the result of each episode to the JSONL `output_file`
+    as soon as it finishes.
+    
+    :param concurrency: number of episodes kept in flight, their generations are batched together
+    :param resume: keep the results already in `output_file` and skip their test entries
+    :param shard: (index, number of shards): only run every n-th test entry, starting from the index-th (see `sharding`)
+    :param seed: seeds sampling before every generation, so that completions can be cached and replayed (see `completion_cache`)
+    :param state_mode: how the world states are shown to the agents, one of `state_render.STATE_MODES`
+    :param constrained: constrain the function agent's outputs to valid calls of the available functions (see `constrained`)
+    '''
+    if state_mode not in STATE_MODES:
+        raise ValueError(f"Unknown state mode {state_mode!r}, expected one of {STATE_MODES}")
+
+    # load datasets
+    test_entry_dict, tool_definitions, tool_to_world_map = load_datasets()
+    shard_index, num_shards = shard
+    test_entries = list(test_entry_dict.values())[shard_index::num_shards]
 
     OUTPUT_TOKENS_CAP = 26_000
     
-    GENERATED_TOKENS_AVG = 0
-    RESULTS = []
+    # world states may hold objects (e.g. GorillaFileSystem directories) which are stored by their repr
+    sink = ResultSink(output_file, resume=resume, default=repr)
+    
+    episodes = [
+        partial(
+            run_episode,
+            model,
+            test_entry,
+            tool_definitions,
+            tool_to_world_map,
+            output_tokens_cap=OUTPUT_TOKENS_CAP,
+            seed=seed,
+            state_mode=state_mode,
+            constrained=constrained,
+        ) for test_entry in test_entries
+        if test_entry['prompt_id'] not in sink.completed
+    ]
+    log.info("Skipping %d test entries already done.", len(test_entries) - len(episodes))
+    
+    run_metrics = EpisodeMetrics(output_file)
+    finished = 0
+    
+    def on_result(index: int, result: Dict) -> None:
+        nonlocal finished
+        sink.write(result)
+        run_metrics.merge(result["metrics"])
+        finished += 1
     
     try:
-        for test_entry in test_entry_dict.values():
-            print(test_entry)
-            logger.reset()
-
-            active_worlds = {}
-            for world in test_entry['involved_classes']:
-                active_worlds[world] = bfcl_worlds[world]()
-                print(f'Loading world: {world}')
-                active_worlds[world]._load_scenario(test_entry['initial_config'])
-                print(f'World {world} loaded successfully')
-                
-            # prompt from dataset
-            user_prompt = test_entry["prompt"]
-            
-            print(f'---------------------- PROMPT: {user_prompt} ----------------------')
-            
-            prev_generated_tokens = logger.mistake_counters["generated_tokens"]
-            
-            additional_state = {
-                world: active_worlds[world].get_state() for world in active_worlds
-            }
-
-            decision_prompt = DecisionAgentPrompt(
-                function_definitions=tool_definitions,
-                user_prompt=user_prompt,
-                # additional_instructions=DECISION_SYSTEM_PROMPT,
-                additional_state=additional_state
-            )
-
-            function_prompt = FunctionAgentPrompt(
-                function_definitions=tool_definitions,
-                user_prompt=user_prompt,
-                # additional_instructions=FUNCTION_SYSTEM_PROMPT,
-                additional_state=additional_state
-            )
-            
-            decision_agent = DecisionAgent(
-                model=model,
-                prompt=decision_prompt,
-                max_output_length=OUTPUT_TOKENS_CAP,
-            )
-            
-            function_agent = FunctionAgent(
-                model=model,
-                prompt=function_prompt,
-                max_output_length=OUTPUT_TOKENS_CAP,
-            )
-            
-            while True:
-                
-                try:
-                    function = function_agent.get_next_function()
-                except Exception as e:
-                    print(f'Error: {repr(e)}')
-                    print(f'Failed to parse function')
-                    break
-                
-                print(f'Calling function: {function}')
-                
-                try:
-                    world_name = tool_to_world_map[function["function_name"]]
-                    world = active_worlds[world_name]
-                    resp = getattr(world, function["function_name"])(**function["arguments"])
-                except AttributeError as e:
-                    # function does not exist
-                    print(f'Error: {repr(e)}')
-                    print('Failed to call function')
-                    print('[CORE]: FUNCTION CALLING ERROR')
-                    logger.mistake_counters["type_3"] += 1
-                    logger.mistake_counters["function_hallucination"] += 1
-                    break
-                except TypeError as e:
-                    # parameter does not exist
-                    print(f'Error: {repr(e)}')
-                    print('Failed to call function')
-                    print('[CORE]: FUNCTION CALLING ERROR')
-                    # function or parameter does not exist
-                    logger.mistake_counters["type_3"] += 1
-                    logger.mistake_counters["parameter_hallucination"] += 1
-                    break
-                except Exception as e:
-                    # "function_name" or "arguments" do not exist -> invalid JSON format
-                    print(f'Error: {repr(e)}')
-                    print('Failed to call function')
-                    logger.mistake_counters["type_2"] += 1
-                    break
-                
-                fc = FunctionCalled(
-                    name=function["function_name"],
-                    arguments=function["arguments"],
-                    response=resp,
-                )
-                
-                # update additional states
-                new_state = {
-                    world: active_worlds[world].get_state() for world in active_worlds
-                }
-                decision_prompt.additional_state = new_state
-                function_prompt.additional_state = new_state
-                
-                decision_prompt.function_called(fc)
-                function_prompt.function_called(fc)
-                
-                try:
-                    if decision_agent.decide(): break
-                except Exception as e:
-                    print(f'Error: {repr(e)}')
-                    print('Failed to parse decision')
-                    break
-                    
-                # print mistake counters
-                print(f'------------ logger ------------')
-                print(f'MISTAKE_1_COUNTER: {logger.mistake_counters["type_1"]}')
-                print(f'MISTAKE_2_COUNTER: {logger.mistake_counters["type_2"]}')
-                print(f'MISTAKE_3_COUNTER: {logger.mistake_counters["type_3"]}')
-                print(f'FUNCTION_HALLUCINATION: {logger.mistake_counters["function_hallucination"]}')
-                print(f'PARAMETER_HALLUCINATION: {logger.mistake_counters["parameter_hallucination"]}')
-                print(f'GENERATED_TOKENS: {logger.mistake_counters["generated_tokens"] - prev_generated_tokens}')
-                GENERATED_TOKENS_AVG += logger.mistake_counters["generated_tokens"] - prev_generated_tokens
-
-                print(f'Sequence: {decision_prompt.functions_called}')
-                RESULTS.append({
-                    "world": world.__class__.__name__,
-                    "prompt_id": prompt['prompt_id'],
-                    "prompt": user_prompt,
-                    "functions_called": str(decision_prompt.functions_called),
-                    "mistakes": {
-                        "MISTAKE_1_COUNTER": logger.mistake_counters["type_1"],
-                        "MISTAKE_2_COUNTER": logger.mistake_counters["type_2"],
-                        "MISTAKE_3_COUNTER": logger.mistake_counters["type_3"],
-                        "FUNCTION_HALLUCINATION": logger.mistake_counters["function_hallucination"],
-                        "PARAMETER_HALLUCINATION": logger.mistake_counters["parameter_hallucination"],
-                    },
-                    "generated_tokens": logger.mistake_counters["generated_tokens"] - prev_generated_tokens,
-                    "database": world.world_state,
-                })
+        EpisodeScheduler(concurrency=concurrency).run(episodes, on_result=on_result)
     except KeyboardInterrupt:
-        print('KeyboardInterrupt: Stopping the execution')
+        log.warning("KeyboardInterrupt: Stopping the execution")
+    finally:
+        sink.close()
+    
+    log.info("------------ metrics: %s (%d episodes) ------------\n%s", output_file, finished, run_metrics.summary())
 
-    with open(output_file, 'w') as f:
-        json.dump(RESULTS, f, indent=4)
 
 # main(
 #     ModelType.DEEPSEEK_1_5B,
-#     output_file="test.json"
+#     output_file="test.jsonl"
 # )
\ No newline at end of file
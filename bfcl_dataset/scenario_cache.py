@@ -0,0 +1,56 @@
+import json
+from copy import deepcopy
+
+from worlds.cow import fork, freeze, is_cheap_to_fork
+
+from typing import Any, Dict, Tuple
+
+class ScenarioCache:
+    '''
+    Loads every distinct (world, scenario) once into a template instance and hands out forks of it.
+
+    The plain dict / list state of a template is shared copy-on-write with its forks (see `worlds.cow`).
+    Worlds whose state is an object tree (e.g. the `GorillaFileSystem` directories) are cheaper to load
+    again than to deep-copy, so they get a new instance loaded from the cached scenario instead.
+    '''
+
+    def __init__(self, world_classes: Dict[str, type], long_context: bool = False):
+        self.world_classes = world_classes
+        self.long_context = long_context
+        # (world name, scenario) -> (template, whether it is forked or loaded again)
+        self._templates: Dict[Tuple[str, str], Tuple[Any, bool]] = {}
+        # id(scenario) -> (scenario, its serialization): test entries pass the same dicts again and again
+        self._serialized: Dict[int, Tuple[Dict, str]] = {}
+
+    def fork(self, world_name: str, scenario: Dict) -> Any:
+        '''
+        Returns a new instance of `world_name` with `scenario` loaded.
+        '''
+        key = (world_name, self._serialize(scenario))
+        if key not in self._templates:
+            template = freeze(self._load(world_name, scenario))
+            self._templates[key] = (template, is_cheap_to_fork(template))
+
+        template, forkable = self._templates[key]
+        if forkable:
+            return fork(template)
+        return self._load(world_name, scenario)
+
+    def _serialize(self, scenario: Dict) -> str:
+        cached = self._serialized.get(id(scenario))
+        if cached is None or cached[0] is not scenario:
+            cached = (scenario, json.dumps(scenario, sort_keys=True, default=repr))
+            self._serialized[id(scenario)] = cached
+        return cached[1]
+    
+    def _load(self, world_name: str, scenario: Dict) -> Any:
+        world = self.world_classes[world_name]()
+        # some worlds (e.g. MathAPI) are stateless
+        if hasattr(world, "_load_scenario"):
+            # worlds keep references to the scenario they load
+            world._load_scenario(deepcopy(scenario), long_context=self.long_context)
+        return world
+
+    def clear(self) -> None:
+        self._templates.clear()
+        self._serialized.clear()
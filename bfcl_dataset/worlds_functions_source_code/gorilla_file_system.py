@@ -1,7 +1,7 @@
 import datetime
 import subprocess
 from copy import deepcopy
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, NamedTuple, Optional, Union
 
 from bfcl_dataset.worlds_functions_source_code.long_context import (
     FILE_CONTENT_EXTENSION, FILES_TAIL_USED, POPULATE_FILE_EXTENSION)
@@ -20,6 +20,8 @@ class File:
         self.name: str = name
         self.content: str = content
         self._last_modified: datetime.datetime = datetime.datetime.now()
+        # directories holding the file (several once cp shared it), whose cached indexes count its size
+        self._containers: List["Directory"] = []
 
     def _write(self, new_content: str) -> None:
         """
@@ -71,6 +73,12 @@ class Directory:
         self.name: str = name
         self.parent: Optional["Directory"] = parent
         self.contents: Dict[str, Union["File", "Directory"]] = {}
+        # SubtreeIndex cached by GorillaFileSystem._subtree_index, dropped by GorillaFileSystem._changed
+        self._index: Optional["SubtreeIndex"] = None
+        # directories holding this one (not only its parent once cp shared it), whose cached indexes include it
+        self._containers: List["Directory"] = []
+        # directories with the very same contents dict (mv hands it over to the moved directory)
+        self._sharing: List["Directory"] = []
 
     def _add_file(self, file_name: str, content: str = "") -> None:
         """
@@ -85,7 +93,7 @@ class Directory:
                 f"File '{file_name}' already exists in directory '{self.name}'."
             )
         new_file = File(file_name, content)
-        self.contents[file_name] = new_file
+        self._put_item(file_name, new_file)
 
     def _add_directory(self, dir_name: str) -> None:
         """
@@ -99,7 +107,55 @@ class Directory:
                 f"Directory '{dir_name}' already exists in directory '{self.name}'."
             )
         new_dir = Directory(dir_name, self)
-        self.contents[dir_name] = new_dir
+        self._put_item(dir_name, new_dir)
+
+    def _put_item(self, item_name: str, item: Union["File", "Directory"]) -> None:
+        """
+        Put an item (file or subdirectory) in the directory.
+
+        Args:
+            item_name (str): The name of the item.
+            item (any): The file or directory.
+        """
+        self.contents[item_name] = item
+        item._containers.append(self)
+
+    def _remove_item(self, item_name: str) -> Union["File", "Directory"]:
+        """
+        Remove an item (file or subdirectory) from the directory.
+
+        Args:
+            item_name (str): The name of the item to remove.
+
+        Returns:
+            item (any): The removed item.
+        """
+        item = self.contents.pop(item_name)
+        item._containers = [container for container in item._containers if container is not self]
+        return item
+
+    def _set_contents(self, contents: Dict[str, Union["File", "Directory"]]) -> None:
+        """
+        Replace the contents of the (empty) directory, e.g. with a shallow copy of the ones of a copied directory.
+
+        Args:
+            contents (dict): The new contents, whose items can be shared with other directories.
+        """
+        self.contents = contents
+        for item in contents.values():
+            item._containers.append(self)
+
+    def _share_contents(self, other: "Directory") -> None:
+        """
+        Make the (empty) directory share the contents of another one, e.g. of the directory it was moved from.
+
+        Args:
+            other (Directory): The directory whose contents dict is shared.
+        """
+        self._set_contents(other.contents)
+        self._sharing = [other] + other._sharing
+        for directory in self._sharing:
+            directory._sharing.append(self)
 
     def _get_item(self, item_name: str) -> Union["File", "Directory", None]:
         """
@@ -133,6 +189,18 @@ class Directory:
         return self.name == other.name and self.contents == other.contents
 
 
+class SubtreeIndex(NamedTuple):
+    """
+    What `find` and `du` need to know about a directory's subtree.
+    """
+    # path of every item relative to the directory ("/name", "/name/child", ...), in the order find lists them
+    paths: List[str]
+    # item name -> positions of the items with that name in paths (ascending)
+    names: Dict[str, List[int]]
+    # total size of the files, in bytes
+    size: int
+
+
 DEFAULT_STATE = {"root": Directory("/", None)}
 
 
@@ -214,6 +282,57 @@ class GorillaFileSystem:
             )
         self._current_dir = self.root
 
+    def _changed(self, item: Union[File, Directory]) -> None:
+        """
+        Drop the cached indexes which include a changed file or directory: its own and the ones of the
+        directories holding it, up to the root.
+
+        Subtrees can be shared between directories (cp copies the contents shallowly, mv hands them over),
+        so the indexes are dropped along every directory holding or sharing the item rather than along its
+        parents only.
+        """
+        stack = [item]
+        visited = set()
+        while stack:
+            item = stack.pop()
+            if id(item) in visited:
+                continue
+            visited.add(id(item))
+            if isinstance(item, Directory):
+                item._index = None
+                stack.extend(item._sharing)
+            stack.extend(item._containers)
+
+    def _subtree_index(self, directory: Directory) -> SubtreeIndex:
+        """
+        Index of the subtree of `directory`, cached on it until something in it changes (see `_changed`).
+
+        Only the indexes of the changed directories and of the ones holding them are rebuilt, the others
+        are reused.
+        """
+        if directory._index is not None:
+            return directory._index
+
+        paths = []
+        names = {}
+        size = 0
+        for item_name, item in directory.contents.items():
+            names.setdefault(item_name, []).append(len(paths))
+            paths.append(f"/{item_name}")
+            if isinstance(item, Directory):
+                child = self._subtree_index(item)
+                offset = len(paths)
+                for name, positions in child.names.items():
+                    names.setdefault(name, []).extend(offset + position for position in positions)
+                paths.extend(f"/{item_name}{path}" for path in child.paths)
+                size += child.size
+            elif isinstance(item, File):
+                size += len(item._read().encode("utf-8"))
+
+        index = SubtreeIndex(paths, names, size)
+        directory._index = index
+        return index
+
     def _load_directory(
         self, current: dict, parent: Optional[Directory] = None
     ) -> Directory:
@@ -234,14 +353,14 @@ class GorillaFileSystem:
                 is_bottommost = False
                 new_dir = Directory(dir_name, parent)
                 new_dir = self._load_directory(dir_data["contents"], new_dir)
-                parent.contents[dir_name] = new_dir
+                parent._put_item(dir_name, new_dir)
 
             elif dir_data["type"] == "file":
                 content = dir_data["content"]
                 if self.long_context and dir_name not in FILES_TAIL_USED:
                     content += FILE_CONTENT_EXTENSION
                 new_file = File(dir_name, content)
-                parent.contents[dir_name] = new_file
+                parent._put_item(dir_name, new_file)
 
         if is_bottommost and self.long_context:
             self._populate_directory(parent)
@@ -342,6 +461,7 @@ class GorillaFileSystem:
             return {"error": f"mkdir: cannot create directory '{dir_name}': File exists"}
 
         self._current_dir._add_directory(dir_name)
+        self._changed(self._current_dir)
         return None
 
     def touch(self, file_name: str) -> Union[None, Dict[str, str]]:
@@ -358,6 +478,7 @@ class GorillaFileSystem:
             return {"error": f"touch: cannot touch '{file_name}': File exists"}
 
         self._current_dir._add_file(file_name)
+        self._changed(self._current_dir)
         return None
 
     def echo(
@@ -380,9 +501,12 @@ class GorillaFileSystem:
 
         if file_name:
             if file_name in self._current_dir.contents:
-                self._current_dir._get_item(file_name)._write(content)
+                item = self._current_dir._get_item(file_name)
+                item._write(content)
+                self._changed(item)
             else:
                 self._current_dir._add_file(file_name, content)
+                self._changed(self._current_dir)
         else:
             return {"terminal_output": content}
 
@@ -425,19 +549,19 @@ class GorillaFileSystem:
             matches (List[str]): A list of matching file and directory paths relative to the given path.
 
         """
-        matches = []
-        target_dir = self._current_dir
-
-        def recursive_search(directory: Directory, base_path: str) -> None:
-            for item_name, item in directory.contents.items():
-                item_path = f"{base_path}/{item_name}"
-                if name is None or name in item_name:
-                    matches.append(item_path)
-                if isinstance(item, Directory):
-                    recursive_search(item, item_path)
+        index = self._subtree_index(self._current_dir)
+        base_path = path.rstrip("/")
 
-        recursive_search(target_dir, path.rstrip("/"))
-        return {"matches": matches}
+        if name is None:
+            positions = range(len(index.paths))
+        else:
+            # only the distinct names are matched, many items share theirs (e.g. long context files)
+            positions = sorted(
+                position
+                for item_name, item_positions in index.names.items() if name in item_name
+                for position in item_positions
+            )
+        return {"matches": [base_path + index.paths[position] for position in positions]}
 
     def wc(self, file_name: str, mode: str = "l") -> Dict[str, Union[int, str]]:
         """
@@ -526,19 +650,11 @@ class GorillaFileSystem:
         Returns:
             disk_usage (str): The estimated disk usage.
         """
-
-        def get_size(item: Union[File, Directory]) -> int:
-            if isinstance(item, File):
-                return len(item._read().encode("utf-8"))
-            elif isinstance(item, Directory):
-                return sum(get_size(child) for child in item.contents.values())
-            return 0
-
         target_dir = self._navigate_to_directory(None)
         if isinstance(target_dir, dict):  # Error condition check
             return target_dir
 
-        total_size = get_size(target_dir)
+        total_size = self._subtree_index(target_dir).size
 
         if human_readable:
             for unit in ["B", "KB", "MB", "GB", "TB"]:
@@ -644,12 +760,14 @@ class GorillaFileSystem:
                         "error": f"mv: cannot move '{source}' to '{destination}/{source}': File exists"
                     }
                 else:
-                    self._current_dir.contents.pop(source)
+                    self._current_dir._remove_item(source)
+                    self._changed(self._current_dir)
                     if isinstance(item, File):
                         dest_item._add_file(source, item.content)
                     else:
                         dest_item._add_directory(source)
-                        dest_item.contents[source].contents = item.contents
+                        dest_item.contents[source]._share_contents(item)
+                    self._changed(dest_item)
                     return {"result": f"'{source}' moved to '{destination}/{source}'"}
             else:
                 return {
@@ -657,12 +775,13 @@ class GorillaFileSystem:
                 }
         else:
             # Destination is not an existing directory, move/rename the item
-            self._current_dir.contents.pop(source)
+            self._current_dir._remove_item(source)
             if isinstance(item, File):
                 self._current_dir._add_file(destination, item.content)
             else:
                 self._current_dir._add_directory(destination)
-                self._current_dir.contents[destination].contents = item.contents
+                self._current_dir.contents[destination]._share_contents(item)
+            self._changed(self._current_dir)
             return {"result": f"'{source}' moved to '{destination}'"}
 
     def rm(self, file_name: str) -> Dict[str, str]:
@@ -678,7 +797,8 @@ class GorillaFileSystem:
         if file_name in self._current_dir.contents:
             item = self._current_dir._get_item(file_name)
             if isinstance(item, File) or isinstance(item, Directory):
-                self._current_dir.contents.pop(file_name)
+                self._current_dir._remove_item(file_name)
+                self._changed(self._current_dir)
                 return {"result": f"'{file_name}' removed"}
             else:
                 return {
@@ -705,7 +825,8 @@ class GorillaFileSystem:
                         "error": f"rmdir: failed to remove '{dir_name}': Directory not empty"
                     }
                 else:
-                    self._current_dir.contents.pop(dir_name)
+                    self._current_dir._remove_item(dir_name)
+                    self._changed(self._current_dir)
                     return {"result": f"'{dir_name}' removed"}
             else:
                 return {"error": f"rmdir: cannot remove '{dir_name}': Not a directory"}
@@ -759,7 +880,8 @@ class GorillaFileSystem:
                         dest_item._add_file(source, item.content)
                     else:
                         dest_item._add_directory(source)
-                        dest_item.contents[source].contents = item.contents.copy()
+                        dest_item.contents[source]._set_contents(item.contents.copy())
+                    self._changed(dest_item)
                     return {"result": f"'{source}' copied to '{destination}/{source}'"}
             else:
                 return {
@@ -771,7 +893,8 @@ class GorillaFileSystem:
                 self._current_dir._add_file(destination, item.content)
             else:
                 self._current_dir._add_directory(destination)
-                self._current_dir.contents[destination].contents = item.contents.copy()
+                self._current_dir.contents[destination]._set_contents(item.contents.copy())
+            self._changed(self._current_dir)
             return {"result": f"'{source}' copied to '{destination}'"}
 
     def _navigate_to_directory(
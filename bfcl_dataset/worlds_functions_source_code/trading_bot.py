@@ -1,7 +1,8 @@
 import random
+from bisect import bisect_left, bisect_right, insort
 from copy import deepcopy
 from datetime import datetime, time, timedelta
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from bfcl_dataset.worlds_functions_source_code.long_context import (
     AUTOMOBILE_EXTENSION,
@@ -14,6 +15,7 @@ from bfcl_dataset.worlds_functions_source_code.long_context import (
 )
 
 CURRENT_TIME = datetime(2024, 9, 1, 10, 30)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 DEFAULT_STATE = {
     "orders": {
@@ -203,6 +205,8 @@ class TradingBot:
         self.transaction_history = scenario.get(
             "transaction_history", DEFAULT_STATE_COPY["transaction_history"]
         )
+        # (ISO timestamp, position in transaction_history) of the first transactions, sorted (see `_indexed_transactions`)
+        self._transaction_index: List[Tuple[str, int]] = []
         self.long_context = long_context
         self._random = random.Random(
             (scenario.get("random_seed", DEFAULT_STATE_COPY["random_seed"]))
@@ -228,7 +232,23 @@ class TradingBot:
         # Convert the random timestamp to a datetime object
         random_date = datetime.fromtimestamp(random_timestamp)
 
-        return random_date.strftime("%Y-%m-%d %H:%M:%S")
+        return random_date.strftime(TIMESTAMP_FORMAT)
+
+    def _indexed_transactions(self) -> List[Tuple[str, int]]:
+        """
+        Index of the transaction history sorted by timestamp.
+
+        The history is only ever appended to, so the transactions added since the last call are indexed
+        on demand. ISO timestamps have a fixed width, so they sort like the datetimes they stand for.
+
+        Returns:
+            index (List[Tuple[str, int]]): (ISO timestamp, position in the history) of every transaction, sorted.
+        """
+        index = self._transaction_index
+        for position in range(len(index), len(self.transaction_history)):
+            timestamp = datetime.strptime(self.transaction_history[position]["timestamp"], TIMESTAMP_FORMAT)
+            insort(index, (timestamp.isoformat(), position))
+        return index
 
     def get_current_time(self) -> Dict[str, str]:
         """
@@ -631,12 +651,13 @@ class TradingBot:
         else:
             end = datetime.max
 
+        # transactions in [start, end], in the order they were made
+        index = self._indexed_transactions()
+        low = bisect_left(index, (start.isoformat(),)) if start_date else 0
+        high = bisect_right(index, (end.isoformat(), len(index))) if end_date else len(index)
         filtered_history = [
-            transaction
-            for transaction in self.transaction_history
-            if start
-            <= datetime.strptime(transaction["timestamp"], "%Y-%m-%d %H:%M:%S")
-            <= end
+            self.transaction_history[position]
+            for position in sorted(position for _, position in index[low:high])
         ]
 
         if self.long_context:
@@ -708,8 +729,7 @@ class TradingBot:
         filtered_stocks = [
             symbol
             for symbol in stocks
-            if self.stocks.get(symbol, {}).get("price", 0) >= min_price
-            and self.stocks.get(symbol, {}).get("price", 0) <= max_price
+            if min_price <= self.stocks.get(symbol, {}).get("price", 0) <= max_price
         ]
         return {"filtered_stocks": filtered_stocks}
 
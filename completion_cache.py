@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+
+from typing import Any, Dict, Optional
+
+# default max size of a cache directory
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+# cache used by every Model which isn't given one (see set_completion_cache)
+_DEFAULT_CACHE: Optional["CompletionCache"] = None
+
+class CompletionCache:
+    '''
+    On-disk cache of completions, one JSON file per key.
+
+    Hits refresh the file's mtime and the least recently used files are evicted once the directory
+    holds more than `max_bytes`. A `read_only` cache (replay mode) never writes or evicts anything.
+    Several processes can share a directory: files are written atomically.
+    '''
+
+    def __init__(self, path: str, max_bytes: int = MAX_CACHE_BYTES, read_only: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._size = self._scan_size()
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        '''
+        Hashes the parts a completion depends on (they have to be JSON serializable).
+        '''
+        encoded = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=repr)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        file = self._file(key)
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if not self.read_only:
+            try:
+                os.utime(file)
+            except FileNotFoundError:
+                # evicted by another process meanwhile
+                pass
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        if self.read_only:
+            return
+
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        try:
+            # replaced, not added
+            replaced_size = os.path.getsize(file)
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(tmp_file, file)
+
+        self._size += os.path.getsize(file) - replaced_size
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.json'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    yield os.path.join(root, name), stat
+
+    def _scan_size(self) -> int:
+        if not os.path.isdir(self.path):
+            return 0
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _evict(self) -> None:
+        # drop the least recently used files until the cache is back to 90% of its max size
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        self._size = sum(stat.st_size for _, stat in entries)
+        for file, stat in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            self._size -= stat.st_size
+
+def set_completion_cache(cache: Optional[CompletionCache]) -> None:
+    '''
+    Makes every `Model` created afterwards in this process use `cache` (no cache if None).
+    '''
+    global _DEFAULT_CACHE
+    _DEFAULT_CACHE = cache
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    return _DEFAULT_CACHE
@@ -1,5 +1,7 @@
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+
+from typing import List
 
 class ModelType(Enum):
     # SPECIAL
@@ -35,6 +37,36 @@ class MessageType:
     role: Role
     content: str
 
+@dataclass
+class PromptSegments:
+    '''
+    A prompt split by how often its parts change between agent steps:
+    `head` never changes during an episode, `history` only grows (one chunk per step)
+    and `tail` may change on every step.
+    
+    The first `omitted` history chunks are left out of the prompt and replaced by `omission_note`
+    (formatted with their number).
+    '''
+    head: str
+    history: List[str] = field(default_factory=list)
+    tail: str = ""
+    omitted: int = 0
+    omission_note: str = "({} earlier steps omitted)"
+    
+    def chunks(self) -> List[str]:
+        if not self.omitted:
+            return self.history
+        return [self.omission_note.format(self.omitted), *self.history[self.omitted:]]
+    
+    def text(self) -> str:
+        return self.head + "".join(self.chunks()) + self.tail
+    
+    def omit_history(self, n: int) -> "PromptSegments":
+        '''
+        Returns a copy of the segments with `n` more of the oldest history chunks omitted.
+        '''
+        return replace(self, omitted=min(self.omitted + n, len(self.history)))
+
 STOP_STRINGS = ['\n</end_of_response>\n', '\n</end_of_response>', '</end_of_response>\n', '</end_of_response>']
 
 base_system_prompt = '''
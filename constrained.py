@@ -0,0 +1,338 @@
+import re
+import torch
+from transformers import LogitsProcessor
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
+
+# how many of the highest scoring tokens are checked against the grammar before falling back to the whole vocabulary
+TOP_K_CANDIDATES = 64
+# max whitespace characters allowed in a row outside of strings
+MAX_WHITESPACE_RUN = 8
+
+NUMBER_PREFIX = re.compile(r'-?(0|[1-9]\d*)?(\.\d*)?([eE][+-]?\d*)?')
+NUMBER = re.compile(r'-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?')
+LITERALS = ('true', 'false', 'null')
+
+
+def get_function_schemas(tool_definitions: Union[List[Dict], Dict[str, List[Dict]]]) -> Dict[str, List[str]]:
+    '''
+    Maps every tool name to its parameter names.
+
+    Accepts `llm_tool` definitions (`{"type": "function", "function": {...}}`), BFCL definitions
+    (`{"name": ..., "parameters": {...}}`) or a dict of world name -> definitions (as used by `bfcl_agent`).
+    '''
+    if isinstance(tool_definitions, dict):
+        tool_definitions = [d for definitions in tool_definitions.values() for d in definitions]
+
+    schemas = {}
+    for definition in tool_definitions:
+        definition = definition.get("function", definition)
+        schemas[definition["name"]] = list(definition.get("parameters", {}).get("properties", {}).keys())
+    return schemas
+
+
+class JsonPrefixParser:
+    '''
+    Incremental character-level JSON parser which only accepts valid prefixes of a single JSON value.
+
+    When `top_level_keys` is given the value must be an object whose keys are taken from it (each at most once).
+    '''
+
+    def __init__(self, top_level_keys: Optional[Iterable[str]] = None):
+        # stack of open containers: [kind ('obj' / 'arr'), expected token, used keys]
+        self.stack: List[list] = []
+        self.top_level_keys: Optional[Set[str]] = set(top_level_keys) if top_level_keys is not None else None
+        # the value currently being lexed: None, 'str', 'key', 'num' or 'lit'
+        self.token: Optional[str] = None
+        self.buffer = ''
+        self.escape = 0
+        self.started = False
+        self.done = False
+        self.ws_run = 0
+
+    def copy(self) -> "JsonPrefixParser":
+        other = JsonPrefixParser.__new__(JsonPrefixParser)
+        other.stack = [[kind, expect, used] for kind, expect, used in self.stack]
+        other.top_level_keys = self.top_level_keys
+        other.token = self.token
+        other.buffer = self.buffer
+        other.escape = self.escape
+        other.started = self.started
+        other.done = self.done
+        other.ws_run = self.ws_run
+        return other
+
+    def feed(self, text: str) -> bool:
+        for c in text:
+            if not self._feed(c):
+                return False
+        return True
+
+    def _feed(self, c: str) -> bool:
+        if self.token in ('str', 'key'):
+            return self._feed_string(c)
+
+        if self.token == 'num':
+            if NUMBER_PREFIX.fullmatch(self.buffer + c):
+                self.buffer += c
+                return True
+            if not NUMBER.fullmatch(self.buffer):
+                return False
+            self.token = None
+            self._value_done()
+            return self._feed(c)
+
+        if self.token == 'lit':
+            self.buffer += c
+            if not any(lit.startswith(self.buffer) for lit in LITERALS):
+                return False
+            if self.buffer in LITERALS:
+                self.token = None
+                self._value_done()
+            return True
+
+        if c in ' \t\n\r':
+            self.ws_run += 1
+            return self.ws_run <= MAX_WHITESPACE_RUN and not self.done
+        self.ws_run = 0
+
+        if self.done:
+            return False
+
+        expect = self.stack[-1][1] if self.stack else 'value'
+
+        if expect in ('key', 'key_or_end'):
+            if c == '}' and expect == 'key_or_end':
+                self.stack.pop()
+                self._value_done()
+                return True
+            if c == '"':
+                self.token = 'key'
+                self.buffer = ''
+                return True
+            return False
+
+        if expect == 'colon':
+            if c == ':':
+                self.stack[-1][1] = 'value'
+                return True
+            return False
+
+        if expect == 'comma_or_end':
+            kind = self.stack[-1][0]
+            if c == ',':
+                self.stack[-1][1] = 'key' if kind == 'obj' else 'value'
+                return True
+            if (kind, c) in (('obj', '}'), ('arr', ']')):
+                self.stack.pop()
+                self._value_done()
+                return True
+            return False
+
+        # expecting a value
+        if c == ']' and expect == 'value_or_end':
+            self.stack.pop()
+            self._value_done()
+            return True
+        if not self.stack and not self.started and self.top_level_keys is not None and c != '{':
+            return False
+        self.started = True
+        if c == '{':
+            self.stack.append(['obj', 'key_or_end', set()])
+            return True
+        if c == '[':
+            self.stack.append(['arr', 'value_or_end', None])
+            return True
+        if c == '"':
+            self.token = 'str'
+            self.buffer = ''
+            return True
+        if c == '-' or c.isdigit():
+            self.token = 'num'
+            self.buffer = c
+            return NUMBER_PREFIX.fullmatch(c) is not None
+        if c in 'tfn':
+            self.token = 'lit'
+            self.buffer = c
+            return True
+        return False
+
+    def _feed_string(self, c: str) -> bool:
+        if self.escape:
+            if self.escape == 1:
+                if c == 'u':
+                    self.escape = 5
+                    return True
+                self.escape = 0
+                return c in '"\\/bfnrt'
+            # \uXXXX
+            self.escape -= 1
+            if self.escape == 1:
+                self.escape = 0
+            return c in '0123456789abcdefABCDEF'
+
+        if c == '\\':
+            self.escape = 1
+            return self.token == 'str'
+        if ord(c) < 0x20:
+            return False
+
+        if c == '"':
+            if self.token == 'key':
+                allowed = self._allowed_keys()
+                if allowed is not None and self.buffer not in allowed:
+                    return False
+                self.stack[-1][2].add(self.buffer)
+                self.stack[-1][1] = 'colon'
+                self.token = None
+                return True
+            self.token = None
+            self._value_done()
+            return True
+
+        if self.token == 'key':
+            allowed = self._allowed_keys()
+            if allowed is not None and not any(key.startswith(self.buffer + c) for key in allowed):
+                return False
+        self.buffer += c
+        return True
+
+    def _allowed_keys(self) -> Optional[Set[str]]:
+        if self.top_level_keys is None or len(self.stack) != 1:
+            return None
+        return self.top_level_keys - self.stack[-1][2]
+
+    def _value_done(self) -> None:
+        if self.stack:
+            self.stack[-1][1] = 'comma_or_end'
+        else:
+            self.done = True
+
+
+class FunctionCallParser:
+    '''
+    Accepts exactly the prefixes of `{"function_name": "<tool>", "arguments": {...}}`
+    where `<tool>` is one of the schemas' tools and the arguments are that tool's parameters.
+    '''
+
+    def __init__(self, schemas: Dict[str, List[str]]):
+        self.schemas = schemas
+        self.phase = 'head'
+        self.pending = '{"function_name": "'
+        self.name = ''
+        self.arguments: Optional[JsonPrefixParser] = None
+
+    @property
+    def done(self) -> bool:
+        return self.phase == 'done'
+
+    def copy(self) -> "FunctionCallParser":
+        other = FunctionCallParser.__new__(FunctionCallParser)
+        other.schemas = self.schemas
+        other.phase = self.phase
+        other.pending = self.pending
+        other.name = self.name
+        other.arguments = self.arguments.copy() if self.arguments is not None else None
+        return other
+
+    def feed(self, text: str) -> bool:
+        for c in text:
+            if not self._feed(c):
+                return False
+        return True
+
+    def _feed(self, c: str) -> bool:
+        if self.phase in ('head', 'middle', 'end'):
+            if not self.pending or c != self.pending[0]:
+                return False
+            self.pending = self.pending[1:]
+            if not self.pending:
+                if self.phase == 'head':
+                    self.phase = 'name'
+                elif self.phase == 'middle':
+                    self.phase = 'arguments'
+                    self.arguments = JsonPrefixParser(top_level_keys=self.schemas[self.name])
+                else:
+                    self.phase = 'done'
+            return True
+
+        if self.phase == 'name':
+            if c == '"':
+                if self.name not in self.schemas:
+                    return False
+                self.phase = 'middle'
+                self.pending = ', "arguments": '
+                return True
+            if not any(name.startswith(self.name + c) for name in self.schemas):
+                return False
+            self.name += c
+            return True
+
+        if self.phase == 'arguments':
+            if self.arguments.done:
+                if c in ' \n':
+                    return False
+                self.phase = 'end'
+                self.pending = '}'
+                return self._feed(c)
+            return self.arguments.feed(c)
+
+        return False
+
+
+class FunctionCallLogitsProcessor(LogitsProcessor):
+    '''
+    Constrains generation to a single function call object (see `FunctionCallParser`) and forces EOS once it is complete.
+
+    Every row of the batch is constrained independently.
+    '''
+
+    def __init__(self, tokenizer, schemas: Dict[str, List[str]], top_k: int = TOP_K_CANDIDATES):
+        self.tokenizer = tokenizer
+        self.schemas = schemas
+        self.top_k = top_k
+        self.eos_token_id = tokenizer.eos_token_id
+        self.special_ids = set(tokenizer.all_special_ids)
+        self._token_text: Dict[int, str] = {}
+        self._parsers: List[FunctionCallParser] = []
+        self._prompt_len: Optional[int] = None
+
+    def _text(self, token_id: int) -> str:
+        if token_id not in self._token_text:
+            self._token_text[token_id] = self.tokenizer.decode([token_id])
+        return self._token_text[token_id]
+
+    def _is_allowed(self, parser: FunctionCallParser, token_id: int) -> bool:
+        if token_id in self.special_ids:
+            return False
+        text = self._text(token_id)
+        return bool(text) and parser.copy().feed(text)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self._prompt_len is None:
+            self._prompt_len = input_ids.shape[1]
+            self._parsers = [FunctionCallParser(self.schemas) for _ in range(input_ids.shape[0])]
+        elif input_ids.shape[1] > self._prompt_len:
+            # advance every row with the token chosen on the previous step
+            for row, parser in enumerate(self._parsers):
+                token_id = input_ids[row, -1].item()
+                if not parser.done and token_id != self.eos_token_id:
+                    parser.feed(self._text(token_id))
+
+        mask = torch.full_like(scores, float('-inf'))
+        for row, parser in enumerate(self._parsers):
+            if parser.done:
+                mask[row, self.eos_token_id] = 0
+                continue
+
+            candidates = torch.topk(scores[row], min(self.top_k, scores.shape[-1])).indices.tolist()
+            allowed = [token_id for token_id in candidates if self._is_allowed(parser, token_id)]
+            if not allowed:
+                # none of the likely tokens fits the grammar: take the most likely one that does
+                for token_id in torch.argsort(scores[row], descending=True).tolist():
+                    if self._is_allowed(parser, token_id):
+                        allowed = [token_id]
+                        break
+            mask[row, allowed] = 0
+
+        return scores + mask
@@ -1,6 +1,15 @@
+import heapq
+import logging
+from collections import OrderedDict
 from dataclasses import dataclass, field
 
-from typing import List, Tuple, Optional
+import numpy as np
+
+from logger import get_logger
+
+from typing import Any, Dict, List, Tuple, Optional, Union
+
+log = get_logger(__name__)
 
 @dataclass
 class Node:
@@ -35,41 +44,113 @@ G2.transitions = [
     Transition(symbol="B01'", _from=G2, _to=G2),
 ]
 
-paths = [
-    {
-        "G0": 1,
-        "G1": 0,
-        "G2": 0,
-    }
-]
-path_sequences = [
-    {
-        "G0": [ [0] ],
-        "G1": [ [] ],
-        "G2": [ [] ],
-    }
-]
+# bounds of the path cache: number of DFAs and total number of symbols in their enumerated paths
+MAX_CACHED_DFAS = 512
+MAX_CACHED_PATH_SYMBOLS = 10_000_000
 
-def get_path(dfa: List[Node], start: Node, k: int):
-    if k < len(paths):
-        return paths[k]
+def dfa_key(dfa: List[Node], start: Node) -> Tuple:
+    """
+    Structural key of a DFA: equal for DFAs with the same states (by position), finality and transitions,
+    whichever objects they are made of.
+    """
+    index = {id(node): i for i, node in enumerate(dfa)}
+    return (
+        index.get(id(start), start.name),
+        tuple(
+            (node.name, node.is_final, tuple(
+                (transition.symbol, index.get(id(transition._to), transition._to.name))
+                for transition in node.transitions
+            ))
+            for node in dfa
+        ),
+    )
 
-    start = len(paths)
+@dataclass
+class DfaPaths:
+    """
+    The paths through a DFA enumerated so far, by length.
+    """
+    # paths[k][state name]: number of paths of k transitions from the start state to the state
+    paths: List[Dict[str, int]]
+    # path_sequences[k][state name]: those paths, as their symbols preceded by the 0 marker
+    path_sequences: List[Dict[str, List[List]]]
+    symbols: int = 0
 
-    for i in range(start, k+1):
-        new_path_counts = { node.name: 0 for node in dfa }
-        new_path_seq = { node.name: [] for node in dfa }
+class PathCache:
+    """
+    Enumerated paths of the most recently used DFAs, keyed by `dfa_key`, so that scoring many results of the
+    same prompt enumerates its DFA once. The least recently used DFAs are evicted once more than `max_dfas`
+    are cached or their paths hold more than `max_symbols` symbols; the paths of a single DFA can't exceed
+    `max_symbols` (the number of paths grows exponentially with their length).
+    """
 
-        for node in dfa:
-            for transition in node.transitions:
-                new_path_counts[transition._to.name] += paths[i-1][node.name]
-               
-                new_path_seq[transition._to.name].extend(
-                    [*path, transition.symbol] for path in path_sequences[i-1][node.name] if path
+    def __init__(self, max_dfas: int = MAX_CACHED_DFAS, max_symbols: int = MAX_CACHED_PATH_SYMBOLS):
+        self.max_dfas = max_dfas
+        self.max_symbols = max_symbols
+        self._entries: "OrderedDict[Tuple, DfaPaths]" = OrderedDict()
+        self._symbols = 0
+
+    def get(self, dfa: List[Node], start: Node, k: int) -> DfaPaths:
+        """
+        Returns the paths of `dfa` from `start`, enumerated up to length `k` at least.
+        Raises ValueError if they would hold more than `max_symbols` symbols.
+        """
+        key = dfa_key(dfa, start)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = DfaPaths(
+                paths=[{node.name: int(node is start) for node in dfa}],
+                path_sequences=[{node.name: [[0]] if node is start else [] for node in dfa}],
+            )
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        for i in range(len(entry.paths), k + 1):
+            new_path_counts = {node.name: 0 for node in dfa}
+            for node in dfa:
+                for transition in node.transitions:
+                    new_path_counts[transition._to.name] += entry.paths[i-1][node.name]
+            # counted before enumerating them
+            symbols = i * sum(new_path_counts.values())
+            if entry.symbols + symbols > self.max_symbols:
+                self._evict()
+                raise ValueError(
+                    f"The paths of length {i} would hold more than {self.max_symbols} symbols"
                 )
 
-        paths.append(new_path_counts)
-        path_sequences.append(new_path_seq)
+            new_path_seq = {node.name: [] for node in dfa}
+            for node in dfa:
+                for transition in node.transitions:
+                    new_path_seq[transition._to.name].extend(
+                        [*path, transition.symbol] for path in entry.path_sequences[i-1][node.name]
+                    )
+
+            entry.paths.append(new_path_counts)
+            entry.path_sequences.append(new_path_seq)
+            entry.symbols += symbols
+            self._symbols += symbols
+
+        self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_dfas or self._symbols > self.max_symbols:
+            _, entry = self._entries.popitem(last=False)
+            self._symbols -= entry.symbols
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._symbols = 0
+
+path_cache = PathCache()
+
+def get_path(dfa: List[Node], start: Node, k: int) -> Dict[str, int]:
+    """
+    Returns the number of paths of `k` transitions from `start` to every state of `dfa`
+    (their sequences are in `path_cache.get(dfa, start, k).path_sequences[k]`).
+    Raises ValueError if the paths up to length `k` would hold more than `path_cache.max_symbols` symbols.
+    """
+    return path_cache.get(dfa, start, k).paths[k]
 
 def LD(s1, s2):
     m, n = len(s1), len(s2)
@@ -104,57 +185,114 @@ def LD_norm(a: List[str], b: List[str], fail_states: Optional[int] = None) -> fl
 def path_correctness(a: List[str], b: List[str]) -> float:
     return 1 - LD_norm(a, b)
 
-def evaluate(seq: List[str], dfa: List[Node]) -> float:
-    
-    start = dfa[0]
-    final = dfa[-1]
-    max_pc = 0
-    min_ld = len(seq)
-
-    # case 1: |seq| == |target|
-    get_path(dfa, start, len(seq)-1)
-
-    for path in path_sequences[len(seq)-1][final.name]:
-        print(f"evaluating: {path} with {seq}")
-        pc = path_correctness(path[1:], seq[1:])
-        ld = LD(path[1:], seq[1:])
-        print(f"pc: {pc}")
-        if pc > max_pc:
-            max_pc = pc
-        print(f"ld: {ld}")
-        if ld < min_ld:
-            min_ld = ld
-
-    if max_pc == 1: return max_pc
-
-    for i in range(len(seq)-min_ld, len(seq)):
-        for path in path_sequences[len(seq)-i-1][final.name]:
-            print(f"evaluating: {path} with {seq}")
-            pc = path_correctness(path[1:], seq[1:])
-            ld = LD(path[1:], seq[1:])
-            print(f"pc: {pc}")
-            if pc > max_pc:
-                max_pc = pc
-            print(f"ld: {ld}")
-            if ld < min_ld:
-                min_ld = ld
-
-    if max_pc == 1: return max_pc
-
-    get_path(dfa, start, len(seq)+min_ld)
-    for i in range(len(seq), len(seq)+min_ld):
-        for path in path_sequences[len(seq)-i-1][final.name]:
-            print(f"evaluating: {path} with {seq}")
-            pc = path_correctness(path[1:], seq[1:])
-            ld = LD(path[1:], seq[1:])
-            print(f"pc: {pc}")
-            if pc > max_pc:
-                max_pc = pc
-            print(f"ld: {ld}")
-            if ld < min_ld:
-                min_ld = ld
-
-    return max_pc
+def closest_path(seq: List[str], dfa: Union[List[Node], "CompiledDFA"]) -> Tuple[Optional[List[str]], int]:
+    """
+    Finds the path from the initial state (dfa[0]) to the final state (dfa[-1]) whose symbols are the closest
+    to `seq` in Levenshtein distance, without enumerating the paths.
+
+    Dynamic programming over (sequence position, state): every step either follows a transition while consuming
+    the next action of `seq` (match or substitution), consumes an action without moving (deletion) or follows a
+    transition without consuming one (insertion). Costs are (distance, -path length) compared lexicographically,
+    so among the closest paths the longest one is kept; paths of the same distance and length are not told apart,
+    the first one reached (in the order of the states and their transitions) is kept.
+    Runs in O(|seq| * |transitions| * log |states|).
+
+    Args:
+        seq (List[str]): The sequence of actions, without the starting '0' marker.
+        dfa (List[Node] or CompiledDFA): The list of nodes of the DFA, the initial one first and the final one last,
+            or its compiled form.
+
+    Returns:
+        Tuple[Optional[List[str]], int]: The symbols of the closest path (None if the final state can't be reached)
+        and its distance to `seq`.
+    """
+    if isinstance(dfa, CompiledDFA):
+        edges, start, final = dfa.edges(), dfa.start, dfa.final
+    else:
+        edges, start, final = _node_edges(dfa)
+    nodes = edges
+    # cost[j][q]: best (distance, -length) of a path from start to q aligned with seq[:j]
+    # back[j][q]: (previous position, previous state, symbol appended to the path or None for a deletion)
+    cost: List[List[Optional[Tuple[int, int]]]] = [[None] * len(nodes) for _ in range(len(seq) + 1)]
+    back: List[List[Optional[Tuple[int, int, Optional[str]]]]] = [[None] * len(nodes) for _ in range(len(seq) + 1)]
+    cost[0][start] = (0, 0)
+
+    def relax(j: int, q: int, candidate: Tuple[int, int], step: Tuple[int, int, Optional[str]]) -> bool:
+        if cost[j][q] is None or candidate < cost[j][q]:
+            cost[j][q] = candidate
+            back[j][q] = step
+            return True
+        return False
+
+    for j in range(len(seq) + 1):
+        if j > 0:
+            for q, current in enumerate(cost[j - 1]):
+                if current is None:
+                    continue
+                ld, length = current
+                # deletion: the action has no counterpart in the path
+                relax(j, q, (ld + 1, length), (j - 1, q, None))
+                # match / substitution
+                for r, symbol in edges[q]:
+                    relax(j, r, (ld + (symbol != seq[j - 1]), length - 1), (j - 1, q, symbol))
+
+        # insertions stay at position j and always cost a unit of distance, so Dijkstra settles them
+        heap = [(current, q) for q, current in enumerate(cost[j]) if current is not None]
+        heapq.heapify(heap)
+        while heap:
+            current, q = heapq.heappop(heap)
+            if current != cost[j][q]:
+                continue
+            ld, length = current
+            for r, symbol in edges[q]:
+                if relax(j, r, (ld + 1, length - 1), (j, q, symbol)):
+                    heapq.heappush(heap, (cost[j][r], r))
+
+    if cost[len(seq)][final] is None:
+        return None, len(seq)
+
+    path = []
+    j, q = len(seq), final
+    while back[j][q] is not None:
+        j, q, symbol = back[j][q]
+        if symbol is not None:
+            path.append(symbol)
+    path.reverse()
+    return path, cost[len(seq)][final][0]
+
+def _node_edges(dfa: List[Node]) -> Tuple[List[List[Tuple[int, str]]], int, int]:
+    # (next state, symbol) of every state by index, states reachable through transitions are included
+    # even if they are missing from the list
+    states: Dict[int, int] = {}
+    nodes: List[Node] = []
+    for node in dfa:
+        if id(node) not in states:
+            states[id(node)] = len(nodes)
+            nodes.append(node)
+    i = 0
+    while i < len(nodes):
+        for transition in nodes[i].transitions:
+            if id(transition._to) not in states:
+                states[id(transition._to)] = len(nodes)
+                nodes.append(transition._to)
+        i += 1
+    edges = [
+        [(states[id(transition._to)], transition.symbol) for transition in node.transitions]
+        for node in nodes
+    ]
+    return edges, states[id(dfa[0])], states[id(dfa[-1])]
+
+def evaluate(seq: List[str], dfa: Union[List[Node], "CompiledDFA"]) -> float:
+    """
+    Path correctness of `seq` (starting with the '0' marker) against the closest path of the DFA (see `closest_path`).
+    """
+    path, ld = closest_path(seq[1:], dfa)
+    if path is None:
+        return 0
+    if not path and len(seq) <= 1:
+        # nothing to do and nothing done
+        return 1
+    return path_correctness(path, seq[1:])
 
 def actions_to_states(seq: List[str], dfa: List[Node]) -> List[str]:
     """
@@ -197,15 +335,19 @@ def actions_to_states(seq: List[str], dfa: List[Node]) -> List[str]:
 
 def simplify_action_sequence(seq: List[str], dfa: List[Node]) -> Tuple[List[str], int]:
     if not seq:
-        print("[Simplify] Empty sequence provided.")
+        log.debug("[Simplify] Empty sequence provided.")
         return []
 
+    # checked once: the traces below are per action
+    debug = log.isEnabledFor(logging.DEBUG)
+
     current = dfa[0]  # Start at initial state
     simplified_seq = [0]  # Always keep the initial '0'
 
     fail_states = 0
 
-    print(f"[Simplify] Starting at state: {current.name}")
+    if debug:
+        log.debug("[Simplify] Starting at state: %s", current.name)
     for idx, action in enumerate(seq):
         if idx == 0:
             # Skip '0' marker
@@ -219,23 +361,27 @@ def simplify_action_sequence(seq: List[str], dfa: List[Node]) -> Tuple[List[str]
 
         if next_state is None:
             # we are in fail state
-            print(f"[Simplify] Action '{action}' is invalid from state '{current.name}'. Stopping.")
+            if debug:
+                log.debug("[Simplify] Action '%s' is invalid from state '%s'. Stopping.", action, current.name)
             fail_states += 1
             simplified_seq.append(action)
             continue
 
-        print(f"[Simplify] Action '{action}' transitions from '{current.name}' to '{next_state.name}'.")
+        if debug:
+            log.debug("[Simplify] Action '%s' transitions from '%s' to '%s'.", action, current.name, next_state.name)
 
         if next_state.name == current.name:
-            print(f"[Simplify] -> State did not change (self-loop). Removing action '{action}' from sequence.")
+            if debug:
+                log.debug("[Simplify] -> State did not change (self-loop). Removing action '%s' from sequence.", action)
         else:
-            print(f"[Simplify] -> State changed! Keeping action '{action}'.")
+            if debug:
+                log.debug("[Simplify] -> State changed! Keeping action '%s'.", action)
             simplified_seq.append(action)
 
         current = next_state
 
-    print(f"[Simplify] Final simplified sequence: {simplified_seq}")
-    print(f"[Simplify] Fail states: {fail_states}")
+    log.debug("[Simplify] Final simplified sequence: %s", simplified_seq)
+    log.debug("[Simplify] Fail states: %s", fail_states)
     return simplified_seq, fail_states
 
 def evaluate_v2(seq: List[str], dfa: List[Node], optimal_seq: List[str]) -> int:
@@ -243,10 +389,197 @@ def evaluate_v2(seq: List[str], dfa: List[Node], optimal_seq: List[str]) -> int:
     return 1 - LD_norm(simplified_seq[1:], optimal_seq[1:], fail_states)
 
 
+class CompiledDFA:
+    """
+    A DFA as a dense transition table: states and symbols are interned to integer ids and
+    `table[state, symbol]` is the next state, or -1 without a transition. As when walking the transitions,
+    the first transition of a state for a symbol wins.
+
+    Built once per DFA (from `Node` lists, `dfas.dfa.Node` lists with several symbols per transition, or their
+    JSON form), it simulates many sequences at once: every step is one table lookup for all of them.
+    Like `evaluate`, the first node given is the initial state and the last one the final state; targets of
+    transitions which aren't among the nodes are states without transitions, added after them.
+    """
+
+    def __init__(
+        self,
+        states: List[str],
+        symbols: List[str],
+        table: np.ndarray,
+        is_final: Optional[List[bool]] = None,
+        transitions: Optional[List[List[Tuple[int, int]]]] = None,
+        final: Optional[int] = None,
+    ):
+        self.states = states
+        self.state_ids = {name: i for i, name in enumerate(states)}
+        self.symbols = symbols
+        self.symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+        self.table = table
+        # (symbol, next state) of every transition of every state, in order: unlike the table it keeps the
+        # transitions of a state shadowed by an earlier one for the same symbol (non-deterministic DFAs)
+        self.transitions = transitions if transitions is not None else [
+            [(symbol, int(to)) for symbol, to in enumerate(row) if to >= 0] for row in table
+        ]
+        self.is_final = np.array(is_final if is_final is not None else [False] * len(states), dtype=bool)
+        self.start = 0
+        # the last state by default; `_compile` passes the last node given, whatever the states appended after it
+        self.final = final if final is not None else len(states) - 1
+        # two extra columns: unknown symbols (no transition from anywhere) and padding (stays in place)
+        self._unknown = len(symbols)
+        self._padding = len(symbols) + 1
+        self._table = np.concatenate([
+            table,
+            np.full((len(states), 1), -1, dtype=table.dtype),
+            np.arange(len(states), dtype=table.dtype)[:, None],
+        ], axis=1)
+
+    @classmethod
+    def from_nodes(cls, dfa: List[Any]) -> "CompiledDFA":
+        """
+        Compiles a list of `Node`s or `dfas.dfa.Node`s (the initial one first, the final one last).
+        """
+        return cls._compile([
+            (
+                node.name,
+                node.is_final,
+                [
+                    (transition.symbols if hasattr(transition, "symbols") else [transition.symbol], transition._to.name)
+                    for transition in node.transitions
+                ],
+            )
+            for node in dfa
+        ])
+
+    @classmethod
+    def from_json(cls, nodes: List[Dict[str, Any]]) -> "CompiledDFA":
+        """
+        Compiles the JSON form of a DFA: the `"nodes"` of an `all_worlds_dataset.json` entry or the `"dfa"` of a BFCL one.
+        """
+        return cls._compile([
+            (
+                node["name"],
+                node.get("is_final", False),
+                [(transition["symbols"], transition["to"]) for transition in node.get("transitions", [])],
+            )
+            for node in nodes
+        ])
+
+    @classmethod
+    def _compile(cls, nodes: List[Tuple[str, bool, List[Tuple[List[str], str]]]]) -> "CompiledDFA":
+        # a state defined twice keeps its first position and its last definition, as `evaluate.load_world` does
+        definitions = {name: (final, transitions) for name, final, transitions in nodes}
+        # the final state is the last node given, even if its name was defined earlier
+        final_name = nodes[-1][0] if nodes else None
+        nodes = [(name, final, transitions) for name, (final, transitions) in definitions.items()]
+
+        states = [name for name, _, _ in nodes]
+        state_ids = {name: i for i, name in enumerate(states)}
+        final_id = state_ids.get(final_name)
+        symbol_ids: Dict[str, int] = {}
+        for _, _, transitions in nodes:
+            for symbols, to in transitions:
+                if to not in state_ids:
+                    state_ids[to] = len(states)
+                    states.append(to)
+                for symbol in symbols:
+                    symbol_ids.setdefault(symbol, len(symbol_ids))
+
+        table = np.full((len(states), len(symbol_ids)), -1, dtype=np.int32)
+        all_transitions: List[List[Tuple[int, int]]] = [[] for _ in states]
+        for name, _, transitions in nodes:
+            row = table[state_ids[name]]
+            for symbols, to in transitions:
+                for symbol in symbols:
+                    all_transitions[state_ids[name]].append((symbol_ids[symbol], state_ids[to]))
+                    if row[symbol_ids[symbol]] < 0:
+                        row[symbol_ids[symbol]] = state_ids[to]
+
+        is_final = [False] * len(states)
+        for name, final, _ in nodes:
+            is_final[state_ids[name]] = final
+        return cls(states, list(symbol_ids), table, is_final, all_transitions, final_id)
+
+    def edges(self) -> List[List[Tuple[int, str]]]:
+        """
+        (next state, symbol) of every transition of every state, in the order they were defined.
+        """
+        return [[(to, self.symbols[symbol]) for symbol, to in transitions] for transitions in self.transitions]
+
+    def encode(self, seqs: List[List[str]]) -> np.ndarray:
+        """
+        Symbol ids of the actions of every sequence (after the '0' marker), padded to the longest one.
+        """
+        lengths = np.fromiter((max(len(seq) - 1, 0) for seq in seqs), dtype=np.int64, count=len(seqs))
+        get = self.symbol_ids.get
+        flat = np.fromiter(
+            (get(action, self._unknown) for seq in seqs for action in seq[1:]),
+            dtype=np.int32,
+            count=int(lengths.sum()),
+        )
+        ids = np.full((len(seqs), int(lengths.max(initial=0))), self._padding, dtype=np.int32)
+        ids[np.arange(ids.shape[1]) < lengths[:, None]] = flat
+        return ids
+
+    def actions_to_states(self, seqs: List[List[str]]) -> List[List[str]]:
+        """
+        `actions_to_states` of every sequence: the states visited until the first action without a transition.
+        """
+        ids = self.encode(seqs)
+        current = np.full(len(seqs), self.start, dtype=np.int32)
+        alive = np.ones(len(seqs), dtype=bool)
+        visited = np.empty((len(seqs), ids.shape[1] + 1), dtype=np.int32)
+        visited[:, 0] = current
+        counts = np.ones(len(seqs), dtype=np.int32)
+        for j in range(ids.shape[1]):
+            moving = alive & (ids[:, j] != self._padding)
+            following = self._table[current, ids[:, j]]
+            alive &= ~(moving & (following < 0))
+            moving &= alive
+            current = np.where(moving, following, current)
+            visited[:, j + 1] = current
+            counts += moving
+
+        names = np.array(self.states, dtype=object)
+        return [names[row[:count]].tolist() for row, count in zip(visited, counts)]
+
+    def simplify_action_sequences(self, seqs: List[List[str]]) -> List[Tuple[List, int]]:
+        """
+        `simplify_action_sequence` of every sequence (without its logs): the actions which changed the state
+        or had no transition (counted as fail states, the state stays the same) after the 0 marker.
+        """
+        ids = self.encode(seqs)
+        current = np.full(len(seqs), self.start, dtype=np.int32)
+        # kept[i, j]: whether the j-th action of the i-th sequence stays in the simplified one
+        kept = np.zeros(ids.shape, dtype=bool)
+        fail_states = np.zeros(len(seqs), dtype=np.int32)
+        for j in range(ids.shape[1]):
+            padding = ids[:, j] == self._padding
+            following = self._table[current, ids[:, j]]
+            failed = following < 0
+            kept[:, j] = ~padding & (failed | (following != current))
+            fail_states += failed
+            current = np.where(failed, current, following)
+
+        return [
+            ([0, *(action for action, keep in zip(seq[1:], kept[i]) if keep)], int(fail_states[i]))
+            for i, seq in enumerate(seqs)
+        ]
+
+    def accepts(self, seqs: List[List[str]]) -> np.ndarray:
+        """
+        Whether every sequence leads from the initial state to the final one, following a transition for each action.
+        """
+        ids = self.encode(seqs)
+        current = np.full(len(seqs), self.start, dtype=np.int32)
+        for j in range(ids.shape[1]):
+            current = np.where(current >= 0, self._table[np.maximum(current, 0), ids[:, j]], -1)
+        return current == self.final
+
+
 def main() -> None:
     # get_path([G0, G1, G2], G0, 5)
-    # print(paths[2])
-    # print(path_sequences[2])
+    # print(path_cache.get([G0, G1, G2], G0, 2).paths[2])
+    # print(path_cache.get([G0, G1, G2], G0, 2).path_sequences[2])
     # print(evaluate([0, "A", "B01'"], [G0, G1, G2]))
     IN_SEQ = ["0", "A", "B01"] 
 
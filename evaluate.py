@@ -1,12 +1,18 @@
 from dfas.dfa import Node, Transition, FunctionCall, FunctionArgument
 from build_json_dataset import serialize_function_call
-from core import evaluate, Transition as CoreTransition
+from core import evaluate, CompiledDFA, Transition as CoreTransition
+from results import load_results
+from logger import get_logger
 
 import sys
 import re
 import ast
 import json
-from typing import Optional, Dict, List
+import logging
+from operator import attrgetter
+from typing import Any, Optional, Dict, List, Tuple, NamedTuple, Union
+
+log = get_logger(__name__)
 
 alphabet: dict[str, FunctionCall] = {
     "A": FunctionCall(
@@ -95,6 +101,49 @@ def parse_function_calls_from_string(seq_str: str) -> List[Dict[str, Optional[st
         out[index] = s
     return [json.loads(s) for s in out if s.strip()]
 
+def parse_function_calls(functions_called: Union[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Returns the function calls of a result record as a list of {"name": ..., "arguments": {...}, "response": ...}.
+
+    Call records (see `agents.FunctionCalled.to_record`) are returned as they are. Legacy records store the repr
+    of the `FunctionCalled` list, which is parsed as the Python expression it is: values which are not literals
+    (e.g. the repr of an object in a response) are kept as their source text. Reprs which don't parse at all
+    go through `parse_function_calls_from_string`.
+    """
+    if not isinstance(functions_called, str):
+        return functions_called
+
+    source = functions_called.strip()
+    try:
+        calls = ast.parse(source, mode="eval").body
+        if not isinstance(calls, ast.List):
+            raise SyntaxError("not a list of function calls")
+    except SyntaxError:
+        return parse_function_calls_from_string(functions_called)
+
+    out = []
+    for call in calls.elts:
+        if not isinstance(call, ast.Call) or call.args:
+            return parse_function_calls_from_string(functions_called)
+        fc = {}
+        for keyword in call.keywords:
+            try:
+                fc[keyword.arg] = ast.literal_eval(keyword.value)
+            except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+                fc[keyword.arg] = ast.get_source_segment(source, keyword.value)
+        out.append(fc)
+    return out
+
+def load_result_records(path: str) -> List[Dict[str, Any]]:
+    """
+    Loads the result records of a run (see `results.load_results`) with their "functions_called" as lists of
+    function calls, whether they were stored as call records or as legacy reprs.
+    """
+    records = load_results(path)
+    for record in records:
+        record["functions_called"] = parse_function_calls(record.get("functions_called") or [])
+    return records
+
 alphabet_proc = {
     "set_config": [
         {
@@ -188,7 +237,7 @@ def fc2symbol(fc, alphabet) -> str:
                     # throws KeyError if argument is not present
                     # throws AssertionError if argument value does not match
                     assert fc["arguments"][arg_name] == arg_value["value"]
-                    print(f"Argument {arg_name} matched with value: {arg_value['value']}")
+                    log.debug("Argument %s matched with value: %s", arg_name, arg_value["value"])
                     out_symbol = symbol["symbol"]
                 else:
                     # this argument is not required
@@ -230,6 +279,130 @@ def convert_alphabet_to_proc(alphabet: dict[str, FunctionCall]) -> dict[str, lis
         proc[name].append(entry)
     return proc
 
+class _SymbolEntry(NamedTuple):
+    # position of the symbol in the alphabet, the first matching one wins
+    order: int
+    symbol: str
+    # arguments which must be absent or None (no value and no excluded values)
+    absent: Tuple[str, ...]
+    # (argument, excluded values) of the optional arguments
+    optional: Tuple[Tuple[str, list], ...]
+    # (argument, value) of all the required arguments if one of the values can't be hashed (the symbol isn't indexed)
+    unindexed: Tuple[Tuple[str, Any], ...]
+    # whether the symbol matches as soon as its required and absent arguments do
+    matched: bool
+
+_entry_order = attrgetter("order")
+
+class SymbolMatcher:
+    """
+    Maps function calls to the symbols of an alphabet exactly like `fc2symbol`, but compiled once per alphabet.
+
+    The symbols of every function name are indexed by the values of their required arguments: a call only
+    looks up the tuple of its values for each distinct set of required argument names, and the excluded
+    values are only checked for the symbols found. Like `fc2symbol`, a symbol matches when none of its
+    arguments fails and at least one of them matched (so symbols without arguments never match, and an
+    excluded value only doesn't count as a match).
+    """
+
+    def __init__(self, alphabet: dict[str, FunctionCall]):
+        # function name -> [(required argument names, values -> symbol entries)], symbol entries to check one by one
+        self._indexes: Dict[str, List[Tuple[Tuple[str, ...], Dict[tuple, List[_SymbolEntry]]]]] = {}
+        self._unindexed: Dict[str, List[_SymbolEntry]] = {}
+
+        for order, (symbol, func_call) in enumerate(alphabet.items()):
+            groups = self._indexes.setdefault(func_call.name, [])
+            unindexed = self._unindexed.setdefault(func_call.name, [])
+            if not symbol:
+                # an empty symbol is the same as no match
+                continue
+
+            required, absent, optional = [], [], []
+            hashable = True
+            for arg_name, arg in func_call.arguments.items():
+                if arg.value is not None:
+                    required.append((arg_name, arg.value))
+                    try:
+                        hash(arg.value)
+                    except TypeError:
+                        hashable = False
+                elif arg.excluded_values is None:
+                    absent.append(arg_name)
+                else:
+                    optional.append((arg_name, arg.excluded_values))
+            if not required and not absent and not optional:
+                continue
+
+            entry = _SymbolEntry(
+                order, symbol, tuple(absent), tuple(optional),
+                unindexed=() if hashable else tuple(required),
+                matched=bool(required or absent),
+            )
+            if not hashable:
+                unindexed.append(entry)
+                continue
+
+            names = tuple(arg_name for arg_name, _ in required)
+            values = tuple(value for _, value in required)
+            for group_names, table in groups:
+                if group_names == names:
+                    table.setdefault(values, []).append(entry)
+                    break
+            else:
+                groups.append((names, {values: [entry]}))
+
+        self._proc = convert_alphabet_to_proc(alphabet)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SymbolMatcher":
+        """
+        Compiles the JSON representation of an alphabet (see `json_to_alphabet`).
+        """
+        return cls(json_to_alphabet(data))
+
+    def match(self, fc: Dict) -> str:
+        """
+        Returns the symbol of the function call `fc` ({"name": ..., "arguments": {...}}), "" if none matches.
+        Raises KeyError if the function name is not in the alphabet.
+        """
+        groups = self._indexes[fc["name"]]
+        if "arguments" not in fc:
+            return ""
+        args = fc["arguments"]
+        if not isinstance(args, dict):
+            # keep whatever `fc2symbol` does with it
+            return fc2symbol(fc, self._proc)
+
+        candidates = []
+        for names, table in groups:
+            try:
+                found = table.get(tuple(map(args.__getitem__, names)))
+            except (KeyError, TypeError):
+                # a required argument is missing, or its value can't equal a hashable one
+                continue
+            if found:
+                candidates.extend(found)
+        for entry in self._unindexed[fc["name"]]:
+            if all(arg_name in args and args[arg_name] == value for arg_name, value in entry.unindexed):
+                candidates.append(entry)
+
+        if len(candidates) > 1:
+            candidates.sort(key=_entry_order)
+        for entry in candidates:
+            if self._matches(entry, args):
+                return entry.symbol
+        return ""
+
+    @staticmethod
+    def _matches(entry: _SymbolEntry, args: Dict) -> bool:
+        # the required arguments already matched
+        for arg_name in entry.absent:
+            if args.get(arg_name) is not None:
+                return False
+        if entry.matched:
+            return True
+        return any(arg_name in args and args[arg_name] not in excluded for arg_name, excluded in entry.optional)
+
 # print(fc2symbol(function_calls[2], alphabet_proc))
 # for fc in parse_function_calls_from_string(string):
 #     print(fc2symbol(fc, alphabet_proc))
@@ -246,19 +419,28 @@ def json_to_alphabet(data):
     return alphabet
 
 def load_world(a):
+    """
+    Loads a dataset entry (of all_worlds_dataset.json, or of the BFCL dataset with its DFA in "CORE") with its
+    symbol matcher and compiled DFA, so that its results are scored without compiling them again.
+    """
     out = {
         "prompt_id": a["prompt_id"],
         "alphabet": {},
         "nodes": {}
     }
     
-    for node in a["nodes"]:
+    # BFCL entries hold the DFA nodes as "dfa" in "CORE"
+    spec = a["CORE"] if a.get("CORE") is not None else a
+    nodes = spec["nodes"] if "nodes" in spec else spec["dfa"]
+    
+    for node in nodes:
         out["nodes"][node["name"]] = Node(name=node["name"], is_final=node.get("is_final", False))
     
-    out["alphabet"] = json_to_alphabet(a["alphabet"])
+    out["alphabet"] = json_to_alphabet(spec["alphabet"])
+    out["matcher"] = SymbolMatcher(out["alphabet"])
     
     # add transitions
-    for node in a["nodes"]:
+    for node in nodes:
         out["nodes"][node["name"]].transitions = []
         for transition in node.get("transitions", []):
             out["nodes"][node["name"]].transitions.append(Transition(
@@ -267,6 +449,9 @@ def load_world(a):
                 _to=out["nodes"][transition["to"]]
             ))
 
+    # compiled from the multi-symbol transitions as they are (convert_dfa rewrites the nodes in place)
+    out["dfa"] = CompiledDFA.from_nodes(list(out["nodes"].values()))
+
     return out
 
 def convert_dfa(dfa: dict[str, Node]) -> List[Node]:
@@ -286,43 +471,37 @@ def evaluate_world(world, result):
     """
     Evaluate the world against the result.
     """
-    # Convert the alphabet to a processing format
-    alphabet_proc = convert_alphabet_to_proc(world["alphabet"])
+    # compiled once by `load_world`
+    matcher = world["matcher"] if "matcher" in world else SymbolMatcher(world["alphabet"])
     
-    # Parse the function calls from the result
-    function_calls = parse_function_calls_from_string(result["functions_called"])
-    print(f"Parsed function calls: {function_calls}")
-    print("----------")
+    # call records, or the repr of legacy results
+    function_calls = parse_function_calls(result["functions_called"])
+    # checked once: the traces below are per function call
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug("Parsed function calls: %s", function_calls)
     
     # Check each function call against the alphabet
     agent_sequence = []
     for fc in function_calls:
-        symbol = fc2symbol(fc, alphabet_proc)
+        try:
+            symbol = matcher.match(fc)
+        except KeyError:
+            # a function which isn't in the alphabet (e.g. one the agent made up) matches no symbol
+            symbol = ""
         if not symbol:
-            print(f"Function call {fc} does not match any symbol in the alphabet.")
+            if debug:
+                log.debug("Function call %s does not match any symbol in the alphabet.", fc)
             continue
         agent_sequence.append(symbol)
-        print(f"Function call {fc} matches symbol: {symbol}")
+        if debug:
+            log.debug("Function call %s matches symbol: %s", fc, symbol)
     
-    dfa = world["nodes"]
+    dfa = world["dfa"] if "dfa" in world else CompiledDFA.from_nodes(list(world["nodes"].values()))
     
-    return evaluate(['0', *agent_sequence], convert_dfa(dfa))
+    return evaluate(['0', *agent_sequence], dfa)
 
 if __name__ == "__main__":
-    dataset_file = sys.argv[1]
-    results_file = sys.argv[2]
-
-    # Load the dataset (json)
-    with open(dataset_file, 'r') as f:
-        dataset = json.load(f)
-
-    world = load_world(dataset[2])
-    print(f"World loaded: {world['prompt_id']}")
-
-    # Load the results (json)
-    with open(results_file, 'r') as f:
-        results = json.load(f)
-    
-    print(f"Results loaded: {results[13]['prompt']}")
-    
-    print(evaluate_world(world, results[13]))
\ No newline at end of file
+    # scores whole results files (see `batch_evaluate`)
+    from batch_evaluate import main
+    main(sys.argv[1:])
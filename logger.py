@@ -1,23 +1,139 @@
-class Logger:
-    def __init__(self, name):
-        self.mistake_counters = {
-            "type_1": 0,
-            "type_2": 0,
-            "type_3": 0,
-            "function_hallucination": 0,
-            "parameter_hallucination": 0,
-            "generated_tokens": 0,
-        }
-    
-    def reset(self):
-        self.mistake_counters = {
-            "type_1": 0,
-            "type_2": 0,
-            "type_3": 0,
-            "function_hallucination": 0,
-            "parameter_hallucination": 0,
-            "generated_tokens": 0,
-        }
-        
-# singleton instance
-logger = Logger("baseline_agent_logger")
\ No newline at end of file
+import os
+import logging
+import threading
+
+from typing import Any, Dict, Optional, Union
+
+# level of the logs when `configure_logging` isn't given one, e.g. LOG_LEVEL=DEBUG for the per call traces
+LOG_LEVEL_ENV = "LOG_LEVEL"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def get_logger(name: str) -> logging.Logger:
+    '''
+    The logger of a module (`get_logger(__name__)`).
+
+    Modules only log: messages are formatted lazily (`log.debug("... %s", value)`), so below the configured
+    level they cost a level check. Loops check `log.isEnabledFor(logging.DEBUG)` once instead of per message.
+    '''
+    return logging.getLogger(name)
+
+def configure_logging(level: Optional[Union[int, str]] = None) -> None:
+    '''
+    Sends the logs at `level` and above (default: $LOG_LEVEL, else INFO) to stderr. Called once by the entry
+    points (and by every worker process, which doesn't inherit the configuration).
+    '''
+    if level is None:
+        level = os.environ.get(LOG_LEVEL_ENV, "INFO")
+    if isinstance(level, str):
+        level = level.upper()
+    logging.basicConfig(level=level, format=LOG_FORMAT, force=True)
+
+MISTAKE_TYPES = (
+    "type_1",
+    "type_2",
+    "type_3",
+    "function_hallucination",
+    "parameter_hallucination",
+)
+
+class EpisodeMetrics:
+    '''
+    Mistake counters, token counts and generation timings of one episode.
+
+    Every episode gets its own instance, which the runner merges into a run-wide one once the episode finishes.
+    `merge` is thread-safe and also accepts the `to_dict` form, so metrics can be sent back from worker processes.
+    '''
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.mistake_counters: Dict[str, int] = {mistake: 0 for mistake in MISTAKE_TYPES}
+        # outputs the agents could not parse (also counted as type_1 / type_2 mistakes)
+        self.parse_failures = 0
+
+        self.generation_calls = 0
+        # generations served by the completion cache
+        self.cached_generations = 0
+        self.prompt_tokens = 0
+        self.reused_prefix_tokens = 0
+        self.generated_tokens = 0
+        # seconds spent until the first token was generated / generating the rest of the output
+        self.prefill_time = 0.0
+        self.decode_time = 0.0
+
+        self._lock = threading.Lock()
+
+    def record_generation(self, stats) -> None:
+        '''
+        Adds the `model.GenerationStats` of one generation.
+        '''
+        with self._lock:
+            self.generation_calls += 1
+            self.cached_generations += int(stats.cached)
+            self.prompt_tokens += stats.prompt_tokens
+            self.reused_prefix_tokens += stats.reused_prefix_tokens
+            self.generated_tokens += stats.generated_tokens
+            self.prefill_time += stats.prefill_time
+            self.decode_time += stats.decode_time
+
+    def merge(self, other: Union["EpisodeMetrics", Dict[str, Any]]) -> "EpisodeMetrics":
+        '''
+        Adds the counters and timings of `other` (an `EpisodeMetrics` or its `to_dict` form) to these.
+        '''
+        if isinstance(other, EpisodeMetrics):
+            other = other.to_dict()
+
+        with self._lock:
+            for mistake, count in other["mistake_counters"].items():
+                self.mistake_counters[mistake] = self.mistake_counters.get(mistake, 0) + count
+            self.parse_failures += other["parse_failures"]
+            self.generation_calls += other["generation_calls"]
+            self.cached_generations += other["cached_generations"]
+            self.prompt_tokens += other["prompt_tokens"]
+            self.reused_prefix_tokens += other["reused_prefix_tokens"]
+            self.generated_tokens += other["generated_tokens"]
+            self.prefill_time += other["prefill_time"]
+            self.decode_time += other["decode_time"]
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "name": self.name,
+                "mistake_counters": dict(self.mistake_counters),
+                "parse_failures": self.parse_failures,
+                "generation_calls": self.generation_calls,
+                "cached_generations": self.cached_generations,
+                "prompt_tokens": self.prompt_tokens,
+                "reused_prefix_tokens": self.reused_prefix_tokens,
+                "generated_tokens": self.generated_tokens,
+                "prefill_time": self.prefill_time,
+                "decode_time": self.decode_time,
+            }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "EpisodeMetrics":
+        return cls(data.get("name", "")).merge(data)
+
+    def summary(self) -> str:
+        decode_speed = self.generated_tokens / self.decode_time if self.decode_time else 0.0
+        return '\n'.join([
+            f'MISTAKE_1_COUNTER: {self.mistake_counters["type_1"]}',
+            f'MISTAKE_2_COUNTER: {self.mistake_counters["type_2"]}',
+            f'MISTAKE_3_COUNTER: {self.mistake_counters["type_3"]}',
+            f'FUNCTION_HALLUCINATION: {self.mistake_counters["function_hallucination"]}',
+            f'PARAMETER_HALLUCINATION: {self.mistake_counters["parameter_hallucination"]}',
+            f'PARSE_FAILURES: {self.parse_failures}',
+            f'GENERATION_CALLS: {self.generation_calls} ({self.cached_generations} cached)',
+            f'PROMPT_TOKENS: {self.prompt_tokens} ({self.reused_prefix_tokens} reused)',
+            f'GENERATED_TOKENS: {self.generated_tokens}',
+            f'PREFILL_TIME: {self.prefill_time:.2f}s',
+            f'DECODE_TIME: {self.decode_time:.2f}s ({decode_speed:.1f} tokens/s)',
+        ])
+
+    # the lock can't be pickled: metrics are sent between processes without it
+    def __getstate__(self) -> Dict[str, Any]:
+        return self.to_dict()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state.get("name", ""))
+        self.merge(state)
@@ -1,16 +1,60 @@
 import re
 import json
+import time
+import logging
+import torch
+from collections import OrderedDict
+from dataclasses import dataclass
 from llm_tool import tool
+from transformers import DynamicCache, LogitsProcessorList, StoppingCriteriaList
 
 from const import (
     ModelType,
+    PromptSegments,
+    STOP_STRINGS,
 )
+from completion_cache import CompletionCache, get_completion_cache
+from constrained import FunctionCallLogitsProcessor
 from utils import (
+    GenerationTimer,
+    RowSampler,
+    StopOnString,
+    StopPattern,
     get_device,
     get_model_tools,
 )
+from logger import get_logger
 
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
+
+log = get_logger(__name__)
+
+# max number of tokenized prompt segments kept by a Model
+SEGMENT_CACHE_SIZE = 1024
+
+@dataclass
+class GenerationRequest:
+    '''
+    The arguments of a single `Model.prompt` call, so that it can be queued and batched with others.
+    '''
+    prompt: Union[str, PromptSegments]
+    stop_patterns: Optional[List[StopPattern]] = None
+    function_schemas: Optional[Dict[str, List[str]]] = None
+    max_new_tokens: Optional[int] = None
+
+@dataclass
+class GenerationStats:
+    '''
+    Token counts and timings of one prompt. Timings of batched prompts are those of the whole batch.
+    '''
+    prompt_tokens: int = 0
+    reused_prefix_tokens: int = 0
+    generated_tokens: int = 0
+    # seconds until the first token was generated / spent generating the rest of the output
+    prefill_time: float = 0.0
+    decode_time: float = 0.0
+    # the output came from the completion cache
+    cached: bool = False
 
 class Model:
     '''
@@ -21,44 +65,471 @@ class Model:
         self,
         model: ModelType,
         # config
+        # max number of generated tokens (the prompt is not counted)
         max_output_length: int = 1000,
         num_beams=1,
         do_sample=True,
         temperature=0.7,
-        top_p=0.9
+        top_p=0.9,
+        dtype: torch.dtype = torch.float16,
+        prefix_cache: bool = True,
+        min_prefix_tokens: int = 32,
+        stop_strings: List[str] = STOP_STRINGS,
+        context_length: Optional[int] = None,
+        # seeds sampling before every generation, so that outputs only depend on the prompt
+        seed: Optional[int] = None,
+        cache: Optional[CompletionCache] = None,
     ):
-        self._model, self.tokenizer = get_model_tools(model)
+        self.model_type = model
+        self.seed = seed
+        # completions are looked up here before generating (see completion_cache). Unseeded sampling draws a new
+        # output every time, so it isn't cached: the cache would replay the first draw
+        cache = cache if cache is not None else get_completion_cache()
+        deterministic = not do_sample or seed is not None
+        if cache is not None and cache.read_only and not deterministic:
+            raise ValueError("Replaying completions needs a seed when sampling (do_sample=True)")
+        self.cache = cache if deterministic else None
+        # seeded sampling draws every row with its own generator, seeded from the row's cache key, so a prompt
+        # samples the same output alone or in any batch (see utils.RowSampler)
+        self.row_sampling = do_sample and seed is not None and num_beams == 1
+        # replay: every completion has to come from the (read-only) cache, so the weights are never loaded
+        self.replay = self.cache is not None and self.cache.read_only
+        
+        # weights and tokenizer are shared between every Model of the same type (see utils.get_model_tools)
+        if self.replay:
+            self._model, self.tokenizer = None, None
+        else:
+            self._model, self.tokenizer = get_model_tools(model, dtype=dtype)
         
         self.config = {
-            "max_length": max_output_length,
+            "max_new_tokens": max_output_length,
             "num_beams": num_beams,
             "do_sample": do_sample,
             "temperature": temperature,
             "top_p": top_p,
-            "pad_token_id": self.tokenizer.eos_token_id,
+            "pad_token_id": self.tokenizer.eos_token_id if self.tokenizer is not None else None,
         }
         
+        self.stop_strings = stop_strings
+        # prompt + output have to fit in the context window
+        self._context_length = context_length
+        self.context_length = context_length or getattr(getattr(self._model, "config", None), "max_position_embeddings", None)
+        
         self.last_generated_tokens: Optional[int] = None
+        self.last_generated_tokens_batch: List[int] = []
+        self.last_stats: Optional[GenerationStats] = None
+        self.last_stats_batch: List[GenerationStats] = []
+        
+        # prefix cache: past-key-values of the last prompt, reused for the tokens the next prompt shares with it
+        self.prefix_cache = prefix_cache and getattr(self._model, "_supports_cache_class", False)
+        self.min_prefix_tokens = min_prefix_tokens
+        self._prefix_ids: List[int] = []
+        self._prefix_kv: Optional[DynamicCache] = None
+        self.last_reused_prefix_tokens: int = 0
+        
+        # token ids of the head / history segments of segmented prompts
+        self._segment_ids: "OrderedDict[Tuple[str, bool], List[int]]" = OrderedDict()
     
-    def prompt(self, prompt: str) -> str:
+    def prompt(
+        self,
+        prompt: Union[str, PromptSegments],
+        function_schemas: Optional[Dict[str, List[str]]] = None,
+        stop_patterns: Optional[List[StopPattern]] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> str:
+        '''
+        Prompts the model and returns the decoded prompt and output.
+        
+        At most `max_new_tokens` tokens are generated (`max_output_length` by default), fewer if prompt and
+        output would not fit in the context window; the oldest history of segmented prompts is omitted first.
+        Generation stops at EOS, at any of the model's `stop_strings` or as soon as one of `stop_patterns` is found.
+        If `function_schemas` (tool name -> parameter names) is given, the output is constrained to a
+        single `{"function_name": ..., "arguments": {...}}` object and generation stops right after it.
+        '''
+        
+        max_new_tokens = max_new_tokens or self.config["max_new_tokens"]
+        key = None
+        if self.cache is not None or self.row_sampling:
+            key = self._cache_key(prompt, function_schemas, stop_patterns, max_new_tokens)
+        if self.cache is not None:
+            cached = self._get_cached(key)
+            if cached is not None:
+                self.last_stats = self._cached_stats(cached)
+                self.last_generated_tokens = self.last_stats.generated_tokens
+                return cached["output"]
         
         # tokenize input
-        input_tensors = self.tokenizer(prompt, return_tensors="pt").to(get_device())
+        input_ids, max_new_tokens = self._plan(prompt, max_new_tokens)
+        input_tensors = self._to_tensors([input_ids])
         prompt_len = input_tensors["input_ids"].shape[-1]
         
+        past_key_values = self._get_prefix_cache(input_ids)
+        
+        if self.seed is not None:
+            torch.manual_seed(self.seed)
+        timer = GenerationTimer()
+        start = time.perf_counter()
         output_tokens = self._model.generate(
             **input_tensors,
-            **self.config,
+            **self._generate_config(max_new_tokens),
+            **self._generate_kwargs(prompt_len, function_schemas, [stop_patterns or []], timer, [key]),
+            **({"past_key_values": past_key_values} if past_key_values is not None else {}),
         )
+        prefill_time, decode_time = self._timings(start, timer)
+        
+        # keep the prompt's past-key-values for the next call (drop the generated part)
+        if past_key_values is not None:
+            past_key_values.crop(prompt_len)
+            self._prefix_ids = input_ids
+            self._prefix_kv = past_key_values
         
         # measure output tokens
         self.last_generated_tokens = output_tokens.shape[-1] - prompt_len
+        self.last_stats = GenerationStats(
+            prompt_tokens=prompt_len,
+            reused_prefix_tokens=self.last_reused_prefix_tokens,
+            generated_tokens=self.last_generated_tokens,
+            prefill_time=prefill_time,
+            decode_time=decode_time,
+        )
         
         # decode output
         output = self.tokenizer.decode(output_tokens[0], skip_special_tokens=True)
-        print(f"Output: {output}")
+        log.debug("Output: %s", output)
         
+        if self.cache is not None:
+            self.cache.put(key, self._cache_value(output, self.last_stats))
         return output
+    
+    def prompt_request(self, request: GenerationRequest) -> str:
+        return self.prompt(
+            request.prompt,
+            function_schemas=request.function_schemas,
+            stop_patterns=request.stop_patterns,
+            max_new_tokens=request.max_new_tokens,
+        )
+    
+    def _generate_kwargs(
+        self,
+        prompt_len: int,
+        function_schemas: Optional[Dict[str, List[str]]],
+        stop_patterns: List[List[StopPattern]],
+        timer: GenerationTimer,
+        keys: List[Optional[str]],
+    ) -> Dict:
+        kwargs = {
+            "stopping_criteria": StoppingCriteriaList([
+                timer,
+                StopOnString(self.tokenizer, prompt_len, self.stop_strings, stop_patterns),
+            ]),
+        }
+        processors = []
+        if function_schemas is not None:
+            processors.append(FunctionCallLogitsProcessor(self.tokenizer, function_schemas))
+        if self.row_sampling:
+            # last: samples from the scores the other processors left
+            processors.append(RowSampler(
+                [int(key[:16], 16) for key in keys],
+                temperature=self.config["temperature"],
+                top_p=self.config["top_p"],
+            ))
+        if processors:
+            kwargs["logits_processor"] = LogitsProcessorList(processors)
+        return kwargs
+    
+    def _generate_config(self, max_new_tokens: int) -> Dict:
+        config = {**self.config, "max_new_tokens": max_new_tokens}
+        if self.row_sampling:
+            # RowSampler has already drawn the token: generate only picks it
+            config.update(do_sample=False, temperature=None, top_p=None)
+        return config
+    
+    @staticmethod
+    def _timings(start: float, timer: GenerationTimer) -> Tuple[float, float]:
+        '''
+        Splits the time since `start` into prefill and decode time.
+        '''
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        first_token_time = timer.first_token_time or end
+        return first_token_time - start, end - first_token_time
+    
+    def _plan(self, prompt: Union[str, PromptSegments], max_new_tokens: int) -> Tuple[List[int], int]:
+        '''
+        Tokenizes `prompt` and fits it and its output budget in the context window, by omitting the oldest
+        history chunks of segmented prompts and then by shrinking the output budget.
+        
+        :return: the prompt's token ids and the output budget
+        '''
+        input_ids = self._encode(prompt)
+        if self.context_length is None:
+            return input_ids, max_new_tokens
+        
+        excess = len(input_ids) + max_new_tokens - self.context_length
+        if excess > 0 and isinstance(prompt, PromptSegments):
+            chunks = prompt.history[prompt.omitted:]
+            omitted = 0
+            while excess > 0 and omitted < len(chunks):
+                excess -= len(self._encode_segment(chunks[omitted]))
+                omitted += 1
+            # the omission note adds a few tokens, so omit one chunk more if needed
+            while True:
+                input_ids = self._encode(prompt.omit_history(omitted))
+                if len(input_ids) + max_new_tokens <= self.context_length or omitted >= len(chunks):
+                    break
+                omitted += 1
+        
+        max_new_tokens = min(max_new_tokens, self.context_length - len(input_ids))
+        if max_new_tokens < 1:
+            raise ValueError(f"Prompt of {len(input_ids)} tokens does not fit in the context window ({self.context_length} tokens)")
+        return input_ids, max_new_tokens
+    
+    def _encode(self, prompt: Union[str, PromptSegments]) -> List[int]:
+        '''
+        Tokenizes a prompt. The head and history chunks of segmented prompts are tokenized once
+        and cached, so every step only tokenizes its new history chunk and the tail.
+        '''
+        if isinstance(prompt, str):
+            return self.tokenizer(prompt)["input_ids"]
+        
+        input_ids = list(self._encode_segment(prompt.head, add_special_tokens=True))
+        for chunk in prompt.chunks():
+            input_ids.extend(self._encode_segment(chunk))
+        input_ids.extend(self.tokenizer(prompt.tail, add_special_tokens=False)["input_ids"])
+        return input_ids
+    
+    def _encode_segment(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        key = (text, add_special_tokens)
+        if key in self._segment_ids:
+            self._segment_ids.move_to_end(key)
+            return self._segment_ids[key]
+        
+        ids = self.tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+        self._segment_ids[key] = ids
+        if len(self._segment_ids) > SEGMENT_CACHE_SIZE:
+            self._segment_ids.popitem(last=False)
+        return ids
+    
+    def _to_tensors(self, rows: List[List[int]]) -> Dict[str, torch.Tensor]:
+        '''
+        Builds `generate` inputs from token id rows, left-padding them so that every row
+        continues from its own last token.
+        '''
+        pad_token_id = self.config["pad_token_id"]
+        width = max(len(row) for row in rows)
+        return {
+            "input_ids": torch.tensor(
+                [[pad_token_id] * (width - len(row)) + row for row in rows], device=get_device()
+            ),
+            "attention_mask": torch.tensor(
+                [[0] * (width - len(row)) + [1] * len(row) for row in rows], device=get_device()
+            ),
+        }
+    
+    def _get_prefix_cache(self, input_ids: List[int]) -> Optional[DynamicCache]:
+        '''
+        Returns the cache to pass to `generate` for `input_ids`: the cached past-key-values cropped to
+        the prefix shared with the previous prompt, or an empty cache to be filled by this call.
+        '''
+        self.last_reused_prefix_tokens = 0
+        if not self.prefix_cache:
+            return None
+        
+        shared = 0
+        for cached_id, input_id in zip(self._prefix_ids, input_ids):
+            if cached_id != input_id:
+                break
+            shared += 1
+        # at least one prompt token has to be prefilled by `generate` to produce logits
+        shared = min(shared, len(input_ids) - 1)
+        
+        if self._prefix_kv is None or shared < self.min_prefix_tokens:
+            self.reset_prefix_cache()
+            return DynamicCache()
+        
+        self._prefix_kv.crop(shared)
+        self.last_reused_prefix_tokens = shared
+        return self._prefix_kv
+    
+    def reset_prefix_cache(self) -> None:
+        self._prefix_ids = []
+        self._prefix_kv = None
+    
+    def _cache_key(
+        self,
+        prompt: Union[str, PromptSegments],
+        function_schemas: Optional[Dict[str, List[str]]],
+        stop_patterns: Optional[List[StopPattern]],
+        max_new_tokens: int,
+    ) -> str:
+        # everything the output depends on (with a seed: if sampling)
+        return CompletionCache.key(
+            model=self.model_type.value,
+            config={**{k: v for k, v in self.config.items() if k != "pad_token_id"}, "max_new_tokens": max_new_tokens},
+            stop_strings=list(self.stop_strings),
+            stop_patterns=[[pattern.pattern, pattern.window, pattern.trigger] for pattern in stop_patterns or []],
+            function_schemas=function_schemas,
+            context_length=self._context_length,
+            seed=self.seed,
+            prompt=prompt.text() if isinstance(prompt, PromptSegments) else prompt,
+        )
+    
+    def _get_cached(self, key: str) -> Optional[Dict]:
+        cached = self.cache.get(key)
+        if cached is None and self.replay:
+            raise LookupError(f"Completion {key} is not in the replay cache {self.cache.path}")
+        return cached
+    
+    @staticmethod
+    def _cache_value(output: str, stats: GenerationStats) -> Dict:
+        return {
+            "output": output,
+            "prompt_tokens": stats.prompt_tokens,
+            "generated_tokens": stats.generated_tokens,
+        }
+    
+    @staticmethod
+    def _cached_stats(cached: Dict) -> GenerationStats:
+        return GenerationStats(
+            prompt_tokens=cached["prompt_tokens"],
+            generated_tokens=cached["generated_tokens"],
+            cached=True,
+        )
+    
+    def prompt_batch(
+        self,
+        prompts: List[Union[str, PromptSegments]],
+        function_schemas: Optional[Dict[str, List[str]]] = None,
+        stop_patterns: Optional[List[Optional[List[StopPattern]]]] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> List[str]:
+        '''
+        Prompts the model with many independent prompts in a single `generate` call.
+        
+        `stop_patterns` holds the stop patterns of each row. Rows that reach EOS or a stop string / pattern
+        early are padded by `generate` while the rest keep decoding, and the call returns as soon as every
+        row has finished.
+        `last_generated_tokens_batch` holds the generated token count of each row and `last_stats_batch`
+        the stats of each row. Prompts found in the completion cache are not generated again. Seeded sampling
+        draws each row with its own generator, so the rows generated here are added to it like single prompts,
+        except when sampling beams (`num_beams` > 1): their samples depend on the other rows of the batch.
+        '''
+        if self.cache is None:
+            return self._prompt_batch(prompts, function_schemas, stop_patterns, max_new_tokens)
+        
+        max_new_tokens = max_new_tokens or self.config["max_new_tokens"]
+        stop_patterns = stop_patterns or [None] * len(prompts)
+        keys = [
+            self._cache_key(prompt, function_schemas, patterns, max_new_tokens)
+            for prompt, patterns in zip(prompts, stop_patterns)
+        ]
+        cached = [self._get_cached(key) for key in keys]
+        
+        outputs = [c["output"] if c is not None else None for c in cached]
+        stats = [self._cached_stats(c) if c is not None else None for c in cached]
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            generated = self._prompt_batch(
+                [prompts[i] for i in missing],
+                function_schemas,
+                [stop_patterns[i] for i in missing],
+                max_new_tokens,
+            )
+            for i, output, row_stats in zip(missing, generated, self.last_stats_batch):
+                outputs[i], stats[i] = output, row_stats
+                if not self.config["do_sample"] or self.row_sampling:
+                    self.cache.put(keys[i], self._cache_value(output, row_stats))
+        
+        self.last_stats_batch = stats
+        self.last_generated_tokens_batch = [row_stats.generated_tokens for row_stats in stats]
+        self.last_generated_tokens = sum(self.last_generated_tokens_batch)
+        return outputs
+    
+    def _prompt_batch(
+        self,
+        prompts: List[Union[str, PromptSegments]],
+        function_schemas: Optional[Dict[str, List[str]]] = None,
+        stop_patterns: Optional[List[Optional[List[StopPattern]]]] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> List[str]:
+        '''
+        Generates `prompts` in a single `generate` call (see `prompt_batch`), without the completion cache.
+        '''
+        if not prompts:
+            self.last_generated_tokens_batch = []
+            self.last_generated_tokens = 0
+            self.last_stats_batch = []
+            return []
+        
+        # tokenize input (left-padded)
+        max_new_tokens = max_new_tokens or self.config["max_new_tokens"]
+        stop_patterns = stop_patterns or [None] * len(prompts)
+        keys = [
+            self._cache_key(prompt, function_schemas, patterns, max_new_tokens) if self.row_sampling else None
+            for prompt, patterns in zip(prompts, stop_patterns)
+        ]
+        rows = [self._plan(prompt, max_new_tokens)[0] for prompt in prompts]
+        input_tensors = self._to_tensors(rows)
+        prompt_len = input_tensors["input_ids"].shape[-1]
+        
+        # padding makes every row as long as the longest one
+        if self.context_length is not None:
+            max_new_tokens = min(max_new_tokens, self.context_length - prompt_len)
+        
+        if self.seed is not None:
+            torch.manual_seed(self.seed)
+        timer = GenerationTimer()
+        generate_kwargs = self._generate_kwargs(
+            prompt_len,
+            function_schemas,
+            [patterns or [] for patterns in stop_patterns],
+            timer,
+            keys,
+        )
+        start = time.perf_counter()
+        output_tokens = self._model.generate(
+            **input_tensors,
+            **self._generate_config(max_new_tokens),
+            **generate_kwargs,
+        )
+        prefill_time, decode_time = self._timings(start, timer)
+        
+        # measure output tokens per row: everything up to its stop string / pattern or its first EOS
+        stopped_at = generate_kwargs["stopping_criteria"][-1].stopped_at
+        self.last_generated_tokens_batch = [
+            self._count_generated_tokens(row, stopped_at[i] if i < len(stopped_at) else None)
+            for i, row in enumerate(output_tokens[:, prompt_len:].tolist())
+        ]
+        self.last_generated_tokens = sum(self.last_generated_tokens_batch)
+        self.last_stats_batch = [
+            GenerationStats(
+                prompt_tokens=len(row),
+                generated_tokens=generated_tokens,
+                prefill_time=prefill_time,
+                decode_time=decode_time,
+            ) for row, generated_tokens in zip(rows, self.last_generated_tokens_batch)
+        ]
+        
+        # decode output
+        outputs = self.tokenizer.batch_decode(output_tokens, skip_special_tokens=True)
+        if log.isEnabledFor(logging.DEBUG):
+            for output in outputs:
+                log.debug("Output: %s", output)
+        
+        return outputs
+    
+    def _count_generated_tokens(self, generated_ids: List[int], stopped_at: Optional[int] = None) -> int:
+        '''
+        Counts the tokens a row generated before it finished: rows which finish early are padded up to the longest
+        row with `pad_token_id` (which is EOS), so padding only counts as a generated EOS if the row wasn't stopped
+        by a stop string / pattern (`stopped_at`: its generated token count at that point).
+        '''
+        count = len(generated_ids) if stopped_at is None else min(stopped_at, len(generated_ids))
+        eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id in generated_ids[:count]:
+            return generated_ids.index(eos_token_id) + 1
+        return count
 
 @tool()
 def get_weather(city: str) -> int:
@@ -0,0 +1,124 @@
+import os
+import json
+
+from logger import get_logger
+
+from typing import Any, Callable, Dict, List, Optional, Set
+
+log = get_logger(__name__)
+
+class ResultSink:
+    '''
+    Appends result records to a JSONL file, one line per finished episode.
+
+    Records are flushed right away and fsynced every `fsync_every` records (and on `close`), so a crash loses
+    at most the last few episodes. With `resume` the records already in the file are kept and their
+    `prompt_id`s are listed in `completed`, so that a restarted run can skip them.
+    '''
+
+    def __init__(
+        self,
+        path: str,
+        resume: bool = False,
+        fsync_every: int = 8,
+        default: Optional[Callable[[Any], Any]] = None,
+    ):
+        self.path = path
+        self.fsync_every = fsync_every
+        # used by `json.dumps` for values which are not JSON serializable
+        self.default = default
+        self.completed: Set[str] = self._read_completed() if resume else set()
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._unsynced = 0
+
+    def _read_completed(self) -> Set[str]:
+        if not os.path.exists(self.path):
+            return set()
+
+        completed = set()
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by a crash: it and everything after it is written again
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                completed.add(record["prompt_id"])
+                valid_size += len(line)
+
+        if valid_size != os.path.getsize(self.path):
+            log.warning("Dropping a truncated record at the end of %s", self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_size)
+        return completed
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record, default=self.default) + '\n')
+        self._file.flush()
+        self.completed.add(record["prompt_id"])
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.sync()
+        self._file.close()
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def merge_results(paths: List[str], output_file: str, order: List[str]) -> int:
+    '''
+    Merges the JSONL files of `paths` into `output_file`, sorting the records by the position of their
+    `prompt_id` in `order` (records of unknown prompts go last, in file order).
+    If a prompt has several records, the first one is kept.
+
+    :return: the number of merged records
+    '''
+    position = {prompt_id: i for i, prompt_id in enumerate(order)}
+
+    lines = {}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # cut short by a crash
+                    continue
+                # records are copied as they are, without serializing them again
+                lines.setdefault(json.loads(line)["prompt_id"], line)
+
+    ordered = sorted(
+        enumerate(lines.items()),
+        key=lambda item: (position.get(item[1][0], len(position)), item[0]),
+    )
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.writelines(line for _, (_, line) in ordered)
+    return len(ordered)
+
+def load_results(path: str) -> List[Dict[str, Any]]:
+    '''
+    Loads the result records of a run, either from a JSONL file written by `ResultSink`
+    or from the older files holding a single JSON list.
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
@@ -1,7 +1,8 @@
 from const import ModelType
-from baseline_agent import main
-from bfcl_agent import main as bfcl_main
-from logger import logger
+from logger import configure_logging, get_logger
+from sharding import default_workers, run_sharded
+
+log = get_logger(__name__)
 
 models = [
     ModelType.QWEN_0_5B,
@@ -12,10 +13,43 @@ models = [
     # ModelType.DEEPSEEK_LLAMA_70B,
 ]
 
-for model in models:
-    print(f'----------------------- RUNNING EXPERIMENTS FOR MODEL: {model} ----------------------')
-    main(model=model, output_file=f"results_{model}.json")
-    logger.reset()
-    bfcl_main(model=model, output_file=f"bfcl_results_{model}.json")
-    logger.reset()
-    print(f'----------------------- COMPLETED EXPERIMENTS FOR MODEL: {model} ----------------')
\ No newline at end of file
+# episodes kept in flight per runner, their generations are batched together
+CONCURRENCY = 8
+# keep the results of an interrupted sweep and only run the missing episodes
+RESUME = True
+# without GPUs: number of worker processes, each pinned to its own group of CPU cores
+CPU_SHARDS = 1
+# opt-in: completions are cached in this directory (e.g. "completion_cache"), so that re-running the sweep after a
+# parser / metric change doesn't generate them again. Sampled completions are only cached with a SEED
+COMPLETION_CACHE_DIR = None
+# only use cached completions: no model is loaded and missing completions are errors
+REPLAY = False
+# seeds sampling before every generation (None: unseeded, every run draws new samples and nothing is cached)
+SEED = None
+# how world states are shown to the agents: "repr" shows the whole state after every call, as in the published runs
+# (opt-in: "compact" encodes it compactly, "diff" shows the initial state once and then the changes of every call)
+STATE_MODE = "repr"
+# opt-in: constrain the function agent's outputs to valid calls of the available functions (see constrained)
+CONSTRAINED = False
+
+if __name__ == '__main__':
+    # level from $LOG_LEVEL (INFO by default, DEBUG for every generated output and parsed function call)
+    configure_logging()
+
+    # one worker process per GPU (or CPU core group), each running a shard of the prompts
+    workers = default_workers(cpu_shards=CPU_SHARDS)
+
+    for model in models:
+        log.info("----------------------- RUNNING EXPERIMENTS FOR MODEL: %s ----------------------", model)
+        run_sharded(
+            model,
+            workers,
+            concurrency=CONCURRENCY,
+            resume=RESUME,
+            seed=SEED,
+            cache_dir=COMPLETION_CACHE_DIR,
+            replay=REPLAY,
+            state_mode=STATE_MODE,
+            constrained=CONSTRAINED,
+        )
+        log.info("----------------------- COMPLETED EXPERIMENTS FOR MODEL: %s ----------------", model)
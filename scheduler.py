@@ -0,0 +1,213 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from model import Model, GenerationRequest, GenerationStats
+from logger import get_logger
+
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, Union
+
+log = get_logger(__name__)
+
+
+class BatchingBackend:
+    '''
+    Serves the generation requests of concurrently running episodes.
+
+    Requests are queued until the model is free and then generated together with `Model.prompt_batch`
+    (a lone request goes through `Model.prompt` so that it keeps its prefix cache). Generation runs in a
+    worker thread, so the episodes waiting on the event loop can parse outputs and call tools meanwhile.
+
+    A request which fails only fails its own episode: requests are planned one by one before being batched,
+    and if a batch fails anyway (e.g. out of memory, or a completion missing from the replay cache) its
+    requests are generated again one at a time.
+    '''
+
+    def __init__(self, max_batch_size: int = 8):
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[Model, GenerationRequest, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # a single worker: batches are generated one after the other
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    async def generate(self, model: Model, request: GenerationRequest) -> Tuple[str, GenerationStats]:
+        '''
+        Queues a request and waits for it to be generated.
+
+        :return: the decoded prompt and output, and its generation stats
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((model, request, future))
+        self._wakeup.set()
+        return await future
+
+    @staticmethod
+    def _batch_key(model: Model, request: GenerationRequest) -> Tuple:
+        # requests can share a `generate` call if they use the same weights, sampling config, stopping, context
+        # window, completion cache and decoding constraints: the batch is generated with its first request's Model
+        return (
+            model.model_type,
+            id(model._model),
+            tuple(sorted(model.config.items())),
+            model.seed,
+            tuple(model.stop_strings),
+            model.context_length,
+            id(model.cache),
+            # by value: every agent builds its own schemas
+            tuple(sorted((name, tuple(params)) for name, params in request.function_schemas.items()))
+            if request.function_schemas is not None else None,
+        )
+
+    def _next_batch(self) -> List[Tuple[Model, GenerationRequest, asyncio.Future]]:
+        key = self._batch_key(*self._pending[0][:2])
+        batch = [p for p in self._pending if self._batch_key(*p[:2]) == key][:self.max_batch_size]
+        self._pending = [p for p in self._pending if not any(p is b for b in batch)]
+        return batch
+
+    @staticmethod
+    def _generate_one(model: Model, request: GenerationRequest) -> Union[Tuple[str, GenerationStats], Exception]:
+        try:
+            return model.prompt_request(request), model.last_stats
+        except Exception as e:
+            return e
+
+    @staticmethod
+    def _check(model: Model, request: GenerationRequest) -> Optional[Exception]:
+        # e.g. a prompt which doesn't fit in the context window: only its own request fails
+        if model.replay:
+            return None
+        try:
+            model._plan(request.prompt, request.max_new_tokens or model.config["max_new_tokens"])
+        except Exception as e:
+            return e
+        return None
+
+    @classmethod
+    def _generate(
+        cls,
+        batch: List[Tuple[Model, GenerationRequest, asyncio.Future]],
+    ) -> List[Union[Tuple[str, GenerationStats], Exception]]:
+        '''
+        Generates a batch, returning the output and stats of every request, or the exception it failed with.
+        '''
+        if len(batch) == 1:
+            model, request, _ = batch[0]
+            return [cls._generate_one(model, request)]
+
+        results: List[Optional[Union[Tuple[str, GenerationStats], Exception]]] = [
+            cls._check(model, request) for model, request, _ in batch
+        ]
+        valid = [i for i, result in enumerate(results) if result is None]
+        if len(valid) < 2:
+            for i in valid:
+                results[i] = cls._generate_one(*batch[i][:2])
+            return results
+
+        try:
+            outputs = cls._generate_batch([batch[i] for i in valid])
+        except Exception as e:
+            log.warning("Batch of %d requests failed (%r), generating them one at a time", len(valid), e)
+            outputs = [cls._generate_one(*batch[i][:2]) for i in valid]
+        for i, output in zip(valid, outputs):
+            results[i] = output
+        return results
+
+    @staticmethod
+    def _generate_batch(batch: List[Tuple[Model, GenerationRequest, asyncio.Future]]) -> List[Tuple[str, GenerationStats]]:
+        model = batch[0][0]
+        requests = [request for _, request, _ in batch]
+        max_new_tokens = [request.max_new_tokens for request in requests]
+        outputs = model.prompt_batch(
+            [request.prompt for request in requests],
+            function_schemas=requests[0].function_schemas,
+            stop_patterns=[request.stop_patterns for request in requests],
+            max_new_tokens=None if None in max_new_tokens else max(max_new_tokens),
+        )
+        return list(zip(outputs, model.last_stats_batch))
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._pending:
+                # let the episodes that were just served queue their next request before batching
+                await asyncio.sleep(0)
+
+                batch = self._next_batch()
+                try:
+                    results = await loop.run_in_executor(self._executor, self._generate, batch)
+                except Exception as e:
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                for (_, _, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+
+class EpisodeScheduler:
+    '''
+    Runs episodes concurrently, keeping at most `concurrency` of them in flight.
+
+    An episode is a coroutine function taking the `BatchingBackend` its agents generate with.
+    Every episode runs its own steps in order; only generation is shared.
+    '''
+
+    def __init__(self, concurrency: int = 8, max_batch_size: Optional[int] = None):
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size or concurrency
+
+    def run(
+        self,
+        episodes: List[Callable[[BatchingBackend], Awaitable[Any]]],
+        on_result: Optional[Callable[[int, Any], None]] = None,
+    ) -> List[Any]:
+        '''
+        Runs all episodes and returns their results in the order of `episodes`.
+
+        `on_result(index, result)` is called as soon as each episode finishes.
+        '''
+        return asyncio.run(self._run(episodes, on_result))
+
+    async def _run(
+        self,
+        episodes: List[Callable[[BatchingBackend], Awaitable[Any]]],
+        on_result: Optional[Callable[[int, Any], None]],
+    ) -> List[Any]:
+        backend = BatchingBackend(max_batch_size=self.max_batch_size)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_episode(index: int, episode: Callable[[BatchingBackend], Awaitable[Any]]) -> Any:
+            async with semaphore:
+                result = await episode(backend)
+            if on_result is not None:
+                on_result(index, result)
+            return result
+
+        backend.start()
+        try:
+            return await asyncio.gather(*(run_episode(i, e) for i, e in enumerate(episodes)))
+        finally:
+            await backend.stop()
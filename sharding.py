@@ -0,0 +1,169 @@
+import os
+import multiprocessing
+from dataclasses import dataclass
+
+import torch
+
+from completion_cache import CompletionCache, set_completion_cache
+from const import ModelType
+from logger import configure_logging, get_logger
+from results import merge_results
+from utils import evict_model_tools, set_device
+
+from typing import List, Optional
+
+log = get_logger(__name__)
+
+# the runners a shard goes through, in order: (module, output file prefix)
+RUNNERS = [
+    ("baseline_agent", "results"),
+    ("bfcl_agent", "bfcl_results"),
+]
+
+@dataclass
+class ShardWorker:
+    '''
+    Where a shard runs: the device its model is loaded on and, optionally, the CPU cores its process is pinned to.
+    '''
+    device: str
+    cores: Optional[List[int]] = None
+
+def default_workers(cpu_shards: int = 1) -> List[ShardWorker]:
+    '''
+    One worker per GPU, or `cpu_shards` workers splitting the available CPU cores into contiguous groups.
+    '''
+    if torch.cuda.is_available():
+        return [ShardWorker(device=f"cuda:{i}") for i in range(torch.cuda.device_count())]
+
+    cores = sorted(os.sched_getaffinity(0))
+    cpu_shards = max(1, min(cpu_shards, len(cores)))
+    size, extra = divmod(len(cores), cpu_shards)
+    workers = []
+    start = 0
+    for i in range(cpu_shards):
+        end = start + size + (1 if i < extra else 0)
+        workers.append(ShardWorker(device="cpu", cores=cores[start:end]))
+        start = end
+    return workers
+
+def shard_file(prefix: str, model: ModelType, shard_index: int, num_shards: int) -> str:
+    if num_shards == 1:
+        return f"{prefix}_{model}.jsonl"
+    return f"{prefix}_{model}.shard{shard_index}-of-{num_shards}.jsonl"
+
+def _prompt_order(runner: str) -> List[str]:
+    # the prompt ids of a runner in the order it runs them
+    if runner == "baseline_agent":
+        from baseline_agent import load_prompts
+        return [prompt['prompt_id'] for _, prompt, _ in load_prompts()]
+
+    from bfcl_agent import load_datasets
+    return list(load_datasets()[0].keys())
+
+def run_shard(
+    model: ModelType,
+    worker: ShardWorker,
+    shard_index: int,
+    num_shards: int,
+    concurrency: int = 1,
+    resume: bool = False,
+    seed: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    replay: bool = False,
+    state_mode: str = "repr",
+    constrained: bool = False,
+) -> None:
+    '''
+    Pins the current process to `worker` and runs its shard of every runner.
+    
+    Completions are looked up in / added to the completion cache at `cache_dir`;
+    with `replay` they all have to come from it and no model is loaded.
+    `state_mode` is how world states are shown to the agents (see `state_render.STATE_MODES`) and `constrained`
+    whether function calls are generated with constrained decoding.
+    '''
+    # worker processes don't inherit the logging configuration
+    configure_logging()
+    if worker.cores is not None:
+        os.sched_setaffinity(0, worker.cores)
+        torch.set_num_threads(len(worker.cores))
+    set_device(worker.device)
+    if cache_dir is not None:
+        set_completion_cache(CompletionCache(cache_dir, read_only=replay))
+
+    # runners are imported here so that their worlds are built in the worker process
+    import baseline_agent
+    import bfcl_agent
+    mains = {"baseline_agent": baseline_agent.main, "bfcl_agent": bfcl_agent.main}
+
+    for runner, prefix in RUNNERS:
+        log.info("----------------------- SHARD %d/%d (%s): %s ----------------------", shard_index, num_shards, worker.device, runner)
+        mains[runner](
+            model=model,
+            output_file=shard_file(prefix, model, shard_index, num_shards),
+            concurrency=concurrency,
+            resume=resume,
+            shard=(shard_index, num_shards),
+            seed=seed,
+            state_mode=state_mode,
+            constrained=constrained,
+        )
+    # free the weights before the process is reused or exits
+    evict_model_tools(model)
+
+def run_sharded(
+    model: ModelType,
+    workers: List[ShardWorker],
+    concurrency: int = 1,
+    resume: bool = False,
+    seed: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    replay: bool = False,
+    state_mode: str = "repr",
+    constrained: bool = False,
+) -> None:
+    '''
+    Splits the prompts of every runner between `workers`, one process each, and once they are all done
+    merges their outputs into `<prefix>_<model>.jsonl` in the runners' prompt order.
+
+    Shard outputs are kept, so that an interrupted sweep can be resumed with the same workers.
+    See `run_shard` for the completion cache arguments.
+    '''
+    kwargs = {
+        "concurrency": concurrency,
+        "resume": resume,
+        "seed": seed,
+        "cache_dir": cache_dir,
+        "replay": replay,
+        "state_mode": state_mode,
+        "constrained": constrained,
+    }
+    num_shards = len(workers)
+    if num_shards == 1:
+        run_shard(model, workers[0], 0, 1, **kwargs)
+        return
+
+    # CUDA can't be used in forked processes
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_shard,
+            args=(model, worker, shard_index, num_shards),
+            kwargs=kwargs,
+        ) for shard_index, worker in enumerate(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} of {model} failed, rerun with resume=True to finish them")
+
+    for runner, prefix in RUNNERS:
+        merged = merge_results(
+            [shard_file(prefix, model, i, num_shards) for i in range(num_shards)],
+            f"{prefix}_{model}.jsonl",
+            order=_prompt_order(runner),
+        )
+        log.info("Merged %d results into %s_%s.jsonl", merged, prefix, model)
@@ -0,0 +1,196 @@
+import json
+import datetime
+
+from bfcl_dataset.worlds_functions_source_code.gorilla_file_system import Directory, File
+from worlds.cow import CowDict, CowList, _is_immutable
+
+from typing import Any, Dict, Optional, Set, Tuple, Union
+
+# how world states are shown to the agents:
+# "repr": the repr of the whole state after every step (the default, as in the published experiments)
+# "compact": the compact encoding of the whole state after every step
+# "diff": the compact encoding of the initial state once, then what every step changed
+STATE_MODES = ("repr", "compact", "diff")
+
+def to_canonical(value: Any, seen: Optional[Set[int]] = None) -> Any:
+    '''
+    Converts a state to plain JSON values: dicts with string keys, lists and scalars.
+    Sets are sorted, directories become the dict of their contents and files their content; a directory
+    already converted in the same state (`seen`, e.g. the current working directory) becomes its path.
+    '''
+    if seen is None:
+        seen = set()
+    # copy-on-write containers are read as they are: going through them would copy their shared children
+    if isinstance(value, dict):
+        return {str(k): to_canonical(v, seen) for k, v in dict.items(value)}
+    if isinstance(value, list):
+        return [to_canonical(v, seen) for v in list.__iter__(value)]
+    if isinstance(value, tuple):
+        return [to_canonical(v, seen) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((to_canonical(v, seen) for v in value), key=repr)
+    if isinstance(value, Directory):
+        if id(value) in seen:
+            return _directory_path(value)
+        seen.add(id(value))
+        return to_canonical(value.contents, seen)
+    if isinstance(value, File):
+        return value.content
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+def _directory_path(directory: Directory) -> str:
+    names = []
+    while directory is not None:
+        names.append(directory.name)
+        directory = directory.parent
+    return '/' + '/'.join(reversed(names))
+
+def encode(value: Any, seen: Optional[Set[int]] = None) -> str:
+    '''
+    Compact canonical encoding of a state: JSON with sorted keys and no whitespace.
+    '''
+    return json.dumps(to_canonical(value, seen), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+class StateRenderer:
+    '''
+    Renders a world state and what changed in it since the previous call.
+
+    The state is split into its entries down to `depth` levels of nested dicts (e.g. depth 2 for
+    world name -> attribute -> value); entries are encoded separately, so a change is reported as the
+    new value of the entries it touched.
+
+    Copy-on-write parts of the state (see `worlds.cow`) are split from a fork of them: the entries which
+    didn't change since the last call are then the very same shared containers, which can't have been
+    changed, so only the changed ones are encoded again. Other entries are encoded on every call.
+    '''
+
+    def __init__(self, depth: int = 1):
+        self.depth = depth
+        self._last: Optional[Union[Dict, str]] = None
+        self._last_text: Optional[str] = None
+        # value and encoding of every entry (by path) at the last call
+        self._encoded: Dict[Tuple[str, ...], Tuple[Any, str]] = {}
+
+    def _split(self, state: Any, depth: int) -> Union[Dict, str]:
+        encoded = {}
+        parts = self._split_entry(state, depth, (), set(), encoded)
+        self._encoded = encoded
+        return parts
+
+    def _split_entry(
+        self,
+        state: Any,
+        depth: int,
+        path: Tuple[str, ...],
+        seen: Set[int],
+        encoded: Dict[Tuple[str, ...], Tuple[Any, str]],
+    ) -> Union[Dict, str]:
+        if isinstance(state, (CowDict, CowList)) and not state._owner.forked:
+            # a live copy-on-write tree: its fork is what it is now, and shares what doesn't change later
+            state = state.fork()
+        if depth > 0 and isinstance(state, dict):
+            return {
+                str(k): self._split_entry(v, depth - 1, path + (str(k),), seen, encoded)
+                for k, v in dict.items(state)
+            }
+
+        last = self._encoded.get(path)
+        if last is not None and _unchanged(state, last[0]):
+            text = last[1]
+        else:
+            text = encode(state, seen)
+        encoded[path] = (state, text)
+        return text
+
+    @staticmethod
+    def _join(parts: Union[Dict, str]) -> str:
+        if isinstance(parts, str):
+            return parts
+        return '{' + ','.join(f'{json.dumps(k, ensure_ascii=False)}:{StateRenderer._join(parts[k])}' for k in sorted(parts)) + '}'
+
+    def render(self, state: Any) -> str:
+        '''
+        Returns the compact encoding of the whole state, and makes it the reference of the next `diff`.
+        '''
+        parts = self._split(state, self.depth)
+        if parts != self._last:
+            self._last = parts
+            self._last_text = self._join(parts)
+        return self._last_text
+
+    def diff(self, state: Any) -> Optional[str]:
+        '''
+        Returns what changed since the last `render` / `diff` (None if nothing did), as
+        `{"changed":{...new values of the changed entries...},"removed":[...paths of the removed entries...]}`.
+        '''
+        parts = self._split(state, self.depth)
+        changed, removed = {}, []
+        self._diff(self._last, parts, changed, removed, [])
+        self._last = parts
+        self._last_text = None
+
+        if not changed and not removed:
+            return None
+        diff = {}
+        if changed:
+            diff["changed"] = changed
+        if removed:
+            diff["removed"] = removed
+        return self._join({k: self._join(v) if k == "changed" else json.dumps(v, ensure_ascii=False) for k, v in diff.items()})
+
+    def _diff(self, old: Any, new: Any, changed: Dict, removed: list, path: list) -> None:
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            if old != new:
+                # replaced entirely (e.g. a new value, or a dict which became a value)
+                changed.update(self._nest(path, new))
+            return
+
+        for key in new:
+            if key not in old:
+                changed.update(self._nest(path + [key], new[key]))
+            else:
+                sub_changed = {}
+                self._diff(old[key], new[key], sub_changed, removed, path + [key])
+                self._merge(changed, sub_changed)
+        for key in old:
+            if key not in new:
+                removed.append(path + [key])
+
+    @staticmethod
+    def _nest(path: list, value: Union[Dict, str]) -> Union[Dict, str]:
+        for key in reversed(path):
+            value = {key: value}
+        return value
+
+    @staticmethod
+    def _merge(into: Dict, other: Any) -> None:
+        if not isinstance(other, dict):
+            return
+        for key, value in other.items():
+            if key in into and isinstance(into[key], dict) and isinstance(value, dict):
+                StateRenderer._merge(into[key], value)
+            else:
+                into[key] = value
+
+def _unchanged(new: Any, old: Any) -> bool:
+    # whether `new` is known to encode like `old` without encoding it: immutable values are compared, containers
+    # shared with a fork can't have changed and the others (e.g. the fork itself) are compared one level down
+    if new is old:
+        return _is_immutable(new) or (isinstance(new, (CowDict, CowList)) and new._owner.forked)
+    if type(new) is not type(old):
+        return False
+    if _is_immutable(new):
+        return new == old
+    if type(new) is CowDict:
+        return dict.keys(new) == dict.keys(old) and all(
+            _unchanged(dict.__getitem__(new, key), dict.__getitem__(old, key)) for key in dict.keys(new)
+        )
+    if type(new) is CowList:
+        return len(new) == len(old) and all(
+            _unchanged(a, b) for a, b in zip(list.__iter__(new), list.__iter__(old))
+        )
+    return False
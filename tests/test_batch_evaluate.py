@@ -0,0 +1,43 @@
+import json
+import os
+
+from batch_evaluate import DATASET_FILE, evaluate_results, load_entries, summarize
+from evaluate import evaluate_world, load_world
+
+
+def first_entry():
+    with open(DATASET_FILE) as f:
+        return json.load(f)[0]
+
+
+def test_unknown_function_names_match_no_symbol():
+    world = load_world(first_entry())
+    made_up = {"name": "made_up_function", "arguments": {}, "response": None}
+    assert evaluate_world(world, {"functions_called": [made_up]}) == evaluate_world(world, {"functions_called": []})
+
+
+def test_unscored_records_are_not_errors(tmp_path):
+    entry = first_entry()
+    results_file = os.path.join(tmp_path, "results.jsonl")
+    with open(results_file, "w") as f:
+        for record in [
+            {"prompt_id": entry["prompt_id"], "functions_called": [{"name": "made_up_function", "arguments": {}}]},
+            {"prompt_id": "not_in_the_dataset", "prompt": "", "functions_called": []},
+        ]:
+            f.write(json.dumps(record) + "\n")
+
+    rows = evaluate_results([results_file], [DATASET_FILE], workers=1)
+    assert rows[0]["score"] is not None and rows[0]["error"] is None
+    assert rows[1]["score"] is None and rows[1]["error"] is None
+
+    summary = {row["world"]: row for row in summarize(rows)}
+    assert summary[entry["world"]]["records"] == 1
+    assert summary[entry["world"]]["errors"] == 0
+    assert summary["?"]["unscored"] == 1
+    assert summary["?"]["mean_score"] is None
+
+
+def test_missing_datasets_are_logged(tmp_path, caplog):
+    missing = os.path.join(tmp_path, "missing.json")
+    assert load_entries([missing]) == {}
+    assert f"Dataset {missing} not found" in caplog.text
@@ -0,0 +1,12 @@
+from completion_cache import CompletionCache
+
+
+def test_overwriting_an_entry_does_not_grow_the_size(tmp_path):
+    cache = CompletionCache(str(tmp_path), max_bytes=1000)
+    first, second = CompletionCache.key(prompt="a"), CompletionCache.key(prompt="b")
+    cache.put(first, {"output": "x" * 100})
+    for _ in range(20):
+        cache.put(second, {"output": "y" * 100})
+
+    assert cache._size == cache._scan_size()
+    assert cache.get(first) == {"output": "x" * 100}
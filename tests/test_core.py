@@ -0,0 +1,144 @@
+import json
+import os
+import random
+
+import pytest
+
+import core
+from core import G0, G1, G2, PathCache
+from evaluate import convert_dfa, load_world
+
+
+def walk_paths(node, k):
+    # every path of k transitions from node, as (symbols, end state)
+    if k == 0:
+        return [([], node)]
+    return [
+        ([transition.symbol, *symbols], end)
+        for transition in node.transitions
+        for symbols, end in walk_paths(transition._to, k - 1)
+    ]
+
+
+def test_path_cache_matches_walk():
+    cache = PathCache()
+    entry = cache.get([G0, G1, G2], G0, 5)
+    for k in range(6):
+        walked = walk_paths(G0, k)
+        for node in [G0, G1, G2]:
+            sequences = [[0, *symbols] for symbols, end in walked if end is node]
+            assert entry.paths[k][node.name] == len(sequences)
+            assert sorted(entry.path_sequences[k][node.name]) == sorted(sequences)
+
+
+def test_path_cache_refuses_to_exceed_max_symbols():
+    cache = PathCache(max_symbols=100)
+    cache.get([G0, G1, G2], G0, 3)
+    with pytest.raises(ValueError):
+        cache.get([G0, G1, G2], G0, 10)
+    assert cache._symbols <= 100
+    # what was enumerated before is kept
+    assert len(cache.get([G0, G1, G2], G0, 3).paths) >= 4
+
+
+def test_path_cache_evicts_least_recently_used():
+    cache = PathCache(max_dfas=1)
+    cache.get([G0, G1, G2], G0, 2)
+    cache.get([G0, G1, G2], G1, 2)
+    assert len(cache._entries) == 1
+    assert cache._symbols == next(iter(cache._entries.values())).symbols
+
+
+def random_dfa(rng, n_states, alphabet):
+    nodes = [core.Node(f"S{i}") for i in range(n_states)]
+    nodes[-1].is_final = True
+    for node in nodes:
+        for symbol in rng.sample(alphabet, rng.randrange(3)):
+            node.transitions.append(core.Transition(symbol=symbol, _from=node, _to=rng.choice(nodes)))
+    return nodes
+
+
+def accepting_paths(dfa, max_length):
+    # every path from the initial state to the final one, up to max_length transitions
+    paths, frontier = [], [([], dfa[0])]
+    for _ in range(max_length + 1):
+        paths.extend(symbols for symbols, node in frontier if node is dfa[-1])
+        frontier = [([*symbols, t.symbol], t._to) for symbols, node in frontier for t in node.transitions]
+    return paths
+
+
+def test_closest_path_matches_enumeration():
+    rng = random.Random(0)
+    alphabet = ["A", "B", "C"]
+    for _ in range(300):
+        dfa = random_dfa(rng, rng.randrange(1, 5), alphabet)
+        seq = [rng.choice(alphabet + ["D"]) for _ in range(rng.randrange(4))]
+        # a path further than the sequence's length plus a shortest path (< number of states) is never the closest
+        paths = accepting_paths(dfa, 2 * len(seq) + len(dfa))
+        path, distance = core.closest_path(seq, dfa)
+        if not paths:
+            assert path is None
+            continue
+        best = min(core.LD(candidate, seq) for candidate in paths)
+        assert distance == best == core.LD(path, seq)
+        assert path in paths
+        # among the closest paths, the longest one
+        assert len(path) == max(len(candidate) for candidate in paths if core.LD(candidate, seq) == best)
+
+
+def dataset_dfas():
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for dataset_file in ["all_worlds_dataset.json", os.path.join("bfcl_dataset", "bfcl_dataset_final_list.json")]:
+        with open(os.path.join(base_dir, dataset_file)) as f:
+            for entry in json.load(f):
+                world = load_world(entry)
+                # compiled by load_world, before convert_dfa splits the transitions in place
+                yield world["dfa"], convert_dfa(world["nodes"])
+
+
+def walk_accepts(seq, dfa):
+    current = dfa[0]
+    for action in seq[1:]:
+        current = next((t._to for t in current.transitions if t.symbol == action), None)
+        if current is None:
+            return False
+    return current is dfa[-1]
+
+
+def test_compiled_dfa_matches_node_walks():
+    rng = random.Random(0)
+    for compiled, nodes in dataset_dfas():
+        symbols = sorted({t.symbol for node in nodes for t in node.transitions}) + ["unknown"]
+        seqs = []
+        for _ in range(10):
+            # mostly along the transitions, so that sequences get deep into the DFA
+            seq, node = ["0"], nodes[0]
+            for _ in range(rng.randrange(8)):
+                if node.transitions and rng.random() < 0.8:
+                    transition = rng.choice(node.transitions)
+                    seq.append(transition.symbol)
+                    node = transition._to
+                else:
+                    seq.append(rng.choice(symbols))
+            seqs.append(seq)
+
+        assert compiled.actions_to_states(seqs) == [core.actions_to_states(seq, nodes) for seq in seqs]
+        assert compiled.simplify_action_sequences(seqs) == [core.simplify_action_sequence(seq, nodes) for seq in seqs]
+        assert compiled.accepts(seqs).tolist() == [walk_accepts(seq, nodes) for seq in seqs]
+        for seq in seqs[:3]:
+            assert core.closest_path(seq[1:], compiled)[1] == core.closest_path(seq[1:], nodes)[1]
+
+
+@pytest.mark.parametrize("redefine_final", [False, True])
+def test_compiled_dfa_keeps_the_last_node_final(redefine_final):
+    # "X" is the target of a transition but no node: it is a state, not the final one
+    a, b = core.Node("A"), core.Node("B", is_final=True)
+    a.transitions = [core.Transition("s", a, b), core.Transition("t", a, core.Node("X"))]
+    # (an earlier definition of the final node's name keeps its position, not its definition)
+    nodes = [a, core.Node("B"), b] if redefine_final else [a, b]
+    compiled = core.CompiledDFA.from_nodes(nodes)
+
+    assert compiled.states[compiled.final] == "B"
+    assert compiled.accepts([["0", "s"], ["0", "t"]]).tolist() == [True, False]
+    assert core.closest_path(["s"], compiled) == core.closest_path(["s"], nodes) == (["s"], 0)
+    assert core.closest_path(["t"], compiled) == core.closest_path(["t"], nodes) == (["s"], 1)
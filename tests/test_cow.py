@@ -0,0 +1,91 @@
+import copy
+import json
+
+import pytest
+
+from worlds.cow import CowDict, CowList, SharedContainerError, fork, freeze, is_cheap_to_fork
+
+def make_tree():
+    return CowDict({"users": {"alice": {"tags": ["a"]}}, "log": [{"id": 1}]})
+
+def plain(tree):
+    return json.loads(json.dumps(tree))
+
+def test_fork_changes_are_isolated():
+    tree = make_tree()
+    before = plain(tree)
+    other = tree.fork()
+
+    other["users"]["alice"]["tags"].append("b")
+    other["users"]["bob"] = {"tags": []}
+    other["log"][0]["id"] = 2
+    del other["users"]["alice"]
+
+    assert plain(tree) == before
+    tree["log"].append({"id": 3})
+    assert plain(other) == {"users": {"bob": {"tags": []}}, "log": [{"id": 2}]}
+
+def test_in_place_or_adopts_values():
+    tree = make_tree()
+    tree |= {"extra": [1]}
+    assert isinstance(dict.__getitem__(tree, "extra"), CowList)
+
+    other = tree.fork()
+    other["extra"].append(2)
+    assert tree["extra"] == [1]
+
+def test_setdefault_adopts_values():
+    tree = make_tree()
+    tree.setdefault("extra", {"a": []})
+    other = tree.fork()
+    other["extra"]["a"].append(1)
+    assert tree["extra"] == {"a": []}
+
+def test_values_returned_by_popitem_copy_and_or_are_not_shared():
+    tree = make_tree()
+    other = tree.fork()
+
+    key, value = other.popitem()
+    value.append({"id": 2})
+    other.copy()["users"]["alice"]["tags"].append("b")
+    (other | {})["users"]["alice"]["tags"].append("c")
+    for entry in reversed(other["users"]["alice"]["tags"]):
+        assert isinstance(entry, str)
+
+    assert plain(tree) == plain(make_tree())
+
+def test_references_taken_before_a_fork_are_guarded():
+    tree = make_tree()
+    tags = tree["users"]["alice"]["tags"]
+    other = tree.fork()
+
+    with pytest.raises(SharedContainerError):
+        tags.append("b")
+    assert other["users"]["alice"]["tags"] == ["a"]
+    # reached from the tree again, it is the tree's own copy
+    tree["users"]["alice"]["tags"].append("b")
+    assert tree["users"]["alice"]["tags"] == ["a", "b"]
+    assert other["users"]["alice"]["tags"] == ["a"]
+
+def test_cow_containers_compare_and_copy_like_plain_ones():
+    tree = make_tree()
+    assert tree == plain(tree)
+    assert copy.deepcopy(tree) == tree
+    assert json.loads(json.dumps(tree)) == plain(tree)
+
+class Template:
+    def __init__(self):
+        self.balances = {"alice": 10}
+        self.history = [{"amount": 1}]
+        self.name = "bank"
+
+def test_forked_objects_are_isolated():
+    template = freeze(Template())
+    assert is_cheap_to_fork(template)
+
+    first, second = fork(template), fork(template)
+    first.balances["alice"] -= 5
+    first.history[0]["amount"] = 3
+    assert second.balances == {"alice": 10}
+    assert second.history == [{"amount": 1}]
+    assert template.balances == {"alice": 10}
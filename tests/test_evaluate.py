@@ -0,0 +1,87 @@
+import glob
+import json
+import os
+import random
+
+from evaluate import (
+    SymbolMatcher,
+    convert_alphabet_to_proc,
+    fc2symbol,
+    json_to_alphabet,
+    parse_function_calls,
+    parse_function_calls_from_string,
+)
+from results import load_results
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET_FILES = [
+    os.path.join(BASE_DIR, "all_worlds_dataset.json"),
+    os.path.join(BASE_DIR, "bfcl_dataset", "bfcl_dataset_final_list.json"),
+]
+
+
+def dataset_alphabets():
+    for dataset_file in DATASET_FILES:
+        with open(dataset_file) as f:
+            for entry in json.load(f):
+                spec = entry["CORE"] if entry.get("CORE") is not None else entry
+                yield json_to_alphabet(spec["alphabet"])
+
+
+def calls_around(rng, alphabet):
+    # calls made of the symbols' arguments, with values dropped, set to None, excluded or swapped between symbols
+    values = [arg.value for func_call in alphabet.values() for arg in func_call.arguments.values()] + [None, "other"]
+    excluded = [
+        value
+        for func_call in alphabet.values()
+        for arg in func_call.arguments.values()
+        for value in arg.excluded_values or []
+    ]
+    for func_call in alphabet.values():
+        arguments = {arg_name: arg.value for arg_name, arg in func_call.arguments.items()}
+        yield {"name": func_call.name, "arguments": dict(arguments)}
+        for _ in range(5):
+            variant = dict(arguments)
+            for arg_name in list(variant):
+                roll = rng.random()
+                if roll < 0.2:
+                    del variant[arg_name]
+                elif roll < 0.4:
+                    variant[arg_name] = rng.choice(values)
+                elif roll < 0.5 and excluded:
+                    variant[arg_name] = rng.choice(excluded)
+            if rng.random() < 0.2:
+                variant["extra"] = rng.choice(values)
+            yield {"name": func_call.name, "arguments": variant}
+        yield {"name": func_call.name}
+
+
+def test_symbol_matcher_matches_fc2symbol():
+    rng = random.Random(0)
+    calls = 0
+    for alphabet in dataset_alphabets():
+        matcher, proc = SymbolMatcher(alphabet), convert_alphabet_to_proc(alphabet)
+        for fc in calls_around(rng, alphabet):
+            assert matcher.match(fc) == fc2symbol(fc, proc), fc
+            calls += 1
+    assert calls > 1000
+
+
+def test_legacy_reprs_parse_like_the_string_parser():
+    parsed = 0
+    for results_file in glob.glob(os.path.join(BASE_DIR, "results_*.json")):
+        for record in load_results(results_file):
+            functions_called = record.get("functions_called")
+            if not isinstance(functions_called, str) or not functions_called.strip("[] \n"):
+                continue
+            calls = parse_function_calls(functions_called)
+            assert calls and all(isinstance(call.get("name"), str) for call in calls)
+            try:
+                expected = parse_function_calls_from_string(functions_called)
+            except ValueError:
+                # e.g. quotes in the responses, which only the Python parser handles
+                continue
+            assert [(call["name"], call["arguments"]) for call in calls] == \
+                [(call["name"], call["arguments"]) for call in expected]
+            parsed += 1
+    assert parsed > 0
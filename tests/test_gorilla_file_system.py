@@ -0,0 +1,86 @@
+import random
+
+from bfcl_dataset.worlds_functions_source_code.gorilla_file_system import Directory, File, GorillaFileSystem
+
+NAMES = ["a", "b", "ab", "notes.txt", "data.csv"]
+
+
+def walk_find(directory, base_path, name):
+    # find as it walked the tree before the indexes
+    matches = []
+    for item_name, item in directory.contents.items():
+        path = f"{base_path}/{item_name}"
+        if name is None or name in item_name:
+            matches.append(path)
+        if isinstance(item, Directory):
+            matches.extend(walk_find(item, path, name))
+    return matches
+
+
+def walk_size(directory):
+    return sum(
+        walk_size(item) if isinstance(item, Directory) else len(item.content.encode("utf-8"))
+        for item in directory.contents.values()
+    )
+
+
+def test_indexes_follow_every_change():
+    rng = random.Random(0)
+    fs = GorillaFileSystem()
+    fs._load_scenario({"root": {"workspace": {"type": "directory", "contents": {
+        "docs": {"type": "directory", "contents": {"notes.txt": {"type": "file", "content": "hello"}}},
+    }}}})
+
+    for step in range(2000):
+        operation = rng.choice(["cd", "cd_up", "mkdir", "touch", "echo", "mv", "rm", "rmdir", "cp"])
+        # (mv / cp of a directory into itself makes a cycle, which find never supported)
+        name, other = rng.sample(NAMES, 2)
+        try:
+            if operation == "cd":
+                directories = [n for n, item in fs._current_dir.contents.items() if isinstance(item, Directory)]
+                if directories:
+                    fs.cd(rng.choice(directories))
+            elif operation == "cd_up":
+                if fs._current_dir.parent is not None:
+                    fs.cd("..")
+            elif operation == "mkdir":
+                fs.mkdir(name)
+            elif operation == "touch":
+                fs.touch(name)
+            elif operation == "echo":
+                fs.echo("x" * rng.randrange(10), name)
+            elif operation == "mv":
+                fs.mv(name, other)
+            elif operation == "rm":
+                fs.rm(name)
+            elif operation == "rmdir":
+                fs.rmdir(name)
+            elif operation == "cp":
+                fs.cp(name, other)
+        except (AttributeError, ValueError):
+            # the world's own errors, e.g. echo into a directory or cp into one holding an item of that name
+            pass
+
+        query = rng.choice([None] + NAMES)
+        assert fs.find(name=query)["matches"] == walk_find(fs._current_dir, ".", query), step
+        assert fs.du()["disk_usage"] == f"{walk_size(fs._current_dir)} bytes", step
+
+
+def test_only_the_changed_directories_are_reindexed():
+    fs = GorillaFileSystem()
+    fs._load_scenario({"root": {"workspace": {"type": "directory", "contents": {
+        "docs": {"type": "directory", "contents": {"notes.txt": {"type": "file", "content": "hello"}}},
+        "src": {"type": "directory", "contents": {"main.py": {"type": "file", "content": ""}}},
+    }}}})
+    fs.find()
+    docs, src = fs.root.contents["docs"], fs.root.contents["src"]
+    src_index = src._index
+
+    fs.cd("docs")
+    fs.echo("hello world", "notes.txt")
+    assert docs._index is None and fs.root._index is None
+    assert src._index is src_index
+
+    fs.cd("..")
+    assert fs.du()["disk_usage"] == "11 bytes"
+    assert src._index is src_index
@@ -0,0 +1,92 @@
+import pytest
+import torch
+
+import model as model_module
+from completion_cache import CompletionCache
+from const import ModelType
+from model import GenerationStats, Model
+from utils import RowSampler, StopOnString
+
+EOS = 0
+
+class CharTokenizer:
+    '''
+    One token per character, id 0 is EOS.
+    '''
+    eos_token_id = EOS
+
+    def decode(self, ids):
+        return ''.join('' if i == EOS else chr(i) for i in ids)
+
+def ids(text):
+    return [ord(c) for c in text]
+
+def make_model():
+    model = Model.__new__(Model)
+    model.tokenizer = CharTokenizer()
+    return model
+
+def test_stop_on_string_records_where_rows_stop():
+    prompt = ids("p:")
+    # generated tokens of each row, the first one stops at "END" after 5 tokens
+    rows = [ids("abEND") + [EOS, EOS], ids("abcdefg")]
+    stopper = StopOnString(CharTokenizer(), len(prompt), stop_strings=["END"])
+
+    for step in range(1, 8):
+        done = stopper(torch.tensor([prompt + row[:step] for row in rows]), None)
+        if done.all():
+            break
+    assert stopper.stopped_at == [5, None]
+
+def test_count_generated_tokens():
+    model = make_model()
+    # stopped by a stop string, then padded with pad == EOS: the padding is not generated
+    assert model._count_generated_tokens(ids("abEND") + [EOS, EOS], stopped_at=5) == 5
+    # finished with a generated EOS, then padded
+    assert model._count_generated_tokens(ids("abc") + [EOS, EOS, EOS]) == 4
+    # EOS generated before the stop position
+    assert model._count_generated_tokens(ids("ab") + [EOS, EOS], stopped_at=4) == 3
+    # ran out of budget
+    assert model._count_generated_tokens(ids("abcd")) == 4
+
+@pytest.fixture
+def no_weights(monkeypatch):
+    monkeypatch.setattr(model_module, "get_model_tools", lambda model, dtype=None: (None, CharTokenizer()))
+
+def fake_prompt_batch(model):
+    def _prompt_batch(prompts, function_schemas=None, stop_patterns=None, max_new_tokens=None):
+        model.last_stats_batch = [GenerationStats(prompt_tokens=1, generated_tokens=1) for _ in prompts]
+        return [prompt.upper() for prompt in prompts]
+    model._prompt_batch = _prompt_batch
+
+def test_unseeded_sampling_is_not_cached(no_weights, tmp_path):
+    cache = CompletionCache(str(tmp_path))
+    assert Model(ModelType.QWEN_0_5B, cache=cache).cache is None
+    assert Model(ModelType.QWEN_0_5B, cache=cache, seed=0).cache is cache
+    assert Model(ModelType.QWEN_0_5B, cache=cache, do_sample=False).cache is cache
+
+def test_replay_needs_a_seed_when_sampling(tmp_path):
+    with pytest.raises(ValueError):
+        Model(ModelType.QWEN_0_5B, cache=CompletionCache(str(tmp_path), read_only=True))
+
+@pytest.mark.parametrize("do_sample, num_beams, stored", [(True, 1, True), (False, 1, True), (True, 2, False)])
+def test_seeded_batches_are_cached(no_weights, tmp_path, do_sample, num_beams, stored):
+    model = Model(
+        ModelType.QWEN_0_5B, cache=CompletionCache(str(tmp_path)), do_sample=do_sample, num_beams=num_beams, seed=0,
+    )
+    fake_prompt_batch(model)
+    assert model.prompt_batch(["a", "b"]) == ["A", "B"]
+    assert (model.cache.get(model._cache_key("a", None, None, model.config["max_new_tokens"])) is not None) == stored
+
+def test_row_sampler_draws_the_same_rows_alone_or_batched():
+    seeds = [3, 1, 4]
+    scores = torch.randn(5, len(seeds), 50, generator=torch.Generator().manual_seed(0))
+    batched = RowSampler(seeds, temperature=0.7, top_p=0.9)
+    alone = [RowSampler([seed], temperature=0.7, top_p=0.9) for seed in seeds]
+
+    for step in scores:
+        sampled = batched(None, step)
+        # every row keeps exactly one token
+        assert (sampled == 0).sum(dim=-1).tolist() == [1] * len(seeds)
+        for row, sampler in enumerate(alone):
+            assert torch.equal(sampler(None, step[row:row + 1])[0], sampled[row])
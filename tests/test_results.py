@@ -0,0 +1,34 @@
+import json
+import os
+
+import pytest
+
+from results import ResultSink, load_results, merge_results
+
+
+@pytest.mark.parametrize("tail", ['{"prompt_id": "c", "functions_cal', '{"prompt_id": "c"}'])
+def test_resume_drops_a_truncated_last_record(tmp_path, tail):
+    path = os.path.join(tmp_path, "results.jsonl")
+    with ResultSink(path) as sink:
+        sink.write({"prompt_id": "a"})
+        sink.write({"prompt_id": "b"})
+    # a crash in the middle of the last write: cut short, or complete but without its newline
+    with open(path, "a") as f:
+        f.write(tail)
+
+    with ResultSink(path, resume=True) as sink:
+        assert sink.completed == {"a", "b"}
+        sink.write({"prompt_id": "c"})
+    assert [record["prompt_id"] for record in load_results(path)] == ["a", "b", "c"]
+
+
+def test_merge_orders_by_prompt_and_keeps_the_first_record(tmp_path):
+    paths = [os.path.join(tmp_path, f"shard_{i}.jsonl") for i in range(2)]
+    with open(paths[0], "w") as f:
+        f.write(json.dumps({"prompt_id": "b", "shard": 0}) + "\n" + json.dumps({"prompt_id": "x"}) + "\n")
+    with open(paths[1], "w") as f:
+        f.write(json.dumps({"prompt_id": "a"}) + "\n" + json.dumps({"prompt_id": "b", "shard": 1}) + "\n")
+
+    output_file = os.path.join(tmp_path, "results.jsonl")
+    assert merge_results(paths + [os.path.join(tmp_path, "missing.jsonl")], output_file, ["a", "b"]) == 3
+    assert load_results(output_file) == [{"prompt_id": "a"}, {"prompt_id": "b", "shard": 0}, {"prompt_id": "x"}]
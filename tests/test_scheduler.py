@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from model import GenerationRequest, GenerationStats
+from scheduler import BatchingBackend, EpisodeScheduler
+
+class FakeModel:
+    '''
+    Stands in for `model.Model`: echoes prompts, fails the ones starting with "fail" and, in a batch,
+    every batch holding one starting with "batch-fail".
+    '''
+
+    def __init__(self, seed=None, weights=None):
+        self.model_type = "fake"
+        self._model = weights if weights is not None else object()
+        self.config = {"max_new_tokens": 16}
+        self.seed = seed
+        self.stop_strings = []
+        self.context_length = None
+        self.cache = None
+        self.replay = False
+        self.batches = []
+
+    def _plan(self, prompt, max_new_tokens):
+        if prompt.startswith("fail"):
+            raise ValueError(f"{prompt} does not fit")
+        return [], max_new_tokens
+
+    def prompt_request(self, request):
+        self._plan(request.prompt, 16)
+        if request.prompt.startswith("batch-fail"):
+            raise MemoryError(request.prompt)
+        self.last_stats = GenerationStats(generated_tokens=1)
+        return request.prompt.upper()
+
+    def prompt_batch(self, prompts, **kwargs):
+        self.batches.append(list(prompts))
+        if any(prompt.startswith("batch-fail") for prompt in prompts):
+            raise MemoryError("batch")
+        self.last_stats_batch = [GenerationStats(generated_tokens=1) for _ in prompts]
+        return [prompt.upper() for prompt in prompts]
+
+def run_requests(model, prompts, models=None, function_schemas=None):
+    async def episode(backend, model, prompt, schemas):
+        try:
+            output, _ = await backend.generate(model, GenerationRequest(prompt=prompt, function_schemas=schemas))
+            return output
+        except Exception as e:
+            return type(e).__name__
+
+    models = models or [model] * len(prompts)
+    function_schemas = function_schemas or [None] * len(prompts)
+    return EpisodeScheduler(concurrency=len(prompts)).run([
+        lambda backend, model=m, prompt=p, schemas=f: episode(backend, model, prompt, schemas)
+        for m, p, f in zip(models, prompts, function_schemas)
+    ])
+
+def test_batched_requests():
+    model = FakeModel()
+    assert run_requests(model, ["a", "b", "c"]) == ["A", "B", "C"]
+    assert model.batches == [["a", "b", "c"]]
+
+def test_unplannable_request_only_fails_itself():
+    model = FakeModel()
+    assert run_requests(model, ["a", "fail", "c"]) == ["A", "ValueError", "C"]
+    # the others are still batched
+    assert model.batches == [["a", "c"]]
+
+def test_failed_batch_is_retried_one_by_one():
+    model = FakeModel()
+    assert run_requests(model, ["a", "batch-fail", "c"]) == ["A", "MemoryError", "C"]
+
+def test_differently_configured_models_are_not_batched_together():
+    weights = object()
+    seeded, unseeded = FakeModel(seed=1, weights=weights), FakeModel(weights=weights)
+    assert run_requests(None, ["a", "b", "c", "d"], models=[seeded, unseeded, seeded, unseeded]) == ["A", "B", "C", "D"]
+    assert seeded.batches == [["a", "c"]]
+    assert unseeded.batches == [["b", "d"]]
+
+def test_requests_with_equal_schemas_are_batched_together():
+    model = FakeModel()
+    # every agent builds its own schemas
+    schemas = [{"send": ["to", "body"], "list": []}, {"list": [], "send": ["to", "body"]}, {"list": []}]
+    assert run_requests(model, ["a", "b", "c"], function_schemas=schemas) == ["A", "B", "C"]
+    assert model.batches == [["a", "b"]]
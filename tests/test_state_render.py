@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import state_render
+from state_render import StateRenderer, encode
+from worlds.cow import CowDict, CowList
+
+
+@pytest.fixture
+def encodes(monkeypatch):
+    # values encoded by the renderer
+    encoded = []
+
+    def counting_encode(value, seen=None):
+        encoded.append(value)
+        return encode(value, seen)
+
+    monkeypatch.setattr(state_render, "encode", counting_encode)
+    return encoded
+
+
+def test_diff_reports_changed_and_removed_entries():
+    state = {"users": {"alice": 1}, "count": 1, "tmp": True}
+    renderer = StateRenderer()
+    renderer.render(state)
+
+    state["users"]["bob"] = 2
+    del state["tmp"]
+    assert json.loads(renderer.diff(state)) == {"changed": {"users": {"alice": 1, "bob": 2}}, "removed": [["tmp"]]}
+    assert renderer.diff(state) is None
+
+
+def test_diff_only_encodes_changed_cow_entries(encodes):
+    state = CowDict({"users": {"alice": {"tags": ["a"]}}, "orders": [1, 2], "count": 2})
+    renderer = StateRenderer()
+    assert json.loads(renderer.render(state)) == {"users": {"alice": {"tags": ["a"]}}, "orders": [1, 2], "count": 2}
+
+    encodes.clear()
+    state["users"]["alice"]["tags"].append("b")
+    assert json.loads(renderer.diff(state)) == {"changed": {"users": {"alice": {"tags": ["a", "b"]}}}}
+    assert encodes == [{"alice": {"tags": ["a", "b"]}}]
+
+    encodes.clear()
+    assert renderer.diff(state) is None
+    assert encodes == []
+
+
+def test_diff_of_cow_state_matches_plain_state():
+    plain = {"world": {"inbox": [], "counter": 0}}
+    cow = {"world": {"inbox": CowList(), "counter": 0}}
+    plain_renderer, cow_renderer = StateRenderer(depth=2), StateRenderer(depth=2)
+    assert plain_renderer.render(plain) == cow_renderer.render(cow)
+
+    for i in range(3):
+        plain["world"]["inbox"].append({"id": i})
+        cow["world"]["inbox"].append({"id": i})
+        plain["world"]["counter"] = cow["world"]["counter"] = i
+        assert plain_renderer.diff(plain) == cow_renderer.diff(cow)
+        assert plain_renderer.render(plain) == cow_renderer.render(cow)
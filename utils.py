@@ -1,44 +1,219 @@
+import gc
+import re
+import time
+from dataclasses import dataclass
+
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    LogitsProcessor,
+    StoppingCriteria,
+    TemperatureLogitsWarper,
+    TopPLogitsWarper,
+)
 
 from const import ModelType
 
-class StopOnString(StoppingCriteria):
-    def __init__(self, stop_string_ids):
-        self.stop_string_ids = stop_string_ids
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+# device used by this process instead of the default one (see set_device)
+_DEVICE: Optional[torch.device] = None
+
+# process-wide registry of loaded (model, tokenizer) pairs keyed by (model type, dtype, device)
+_MODEL_REGISTRY: Dict[Tuple[ModelType, torch.dtype, str], Tuple[AutoModelForCausalLM, AutoTokenizer]] = {}
 
+@dataclass
+class StopPattern:
+    '''
+    A regex which stops generation as soon as it is found in the generated text.
+    
+    Only the last `window` characters are searched, and only on steps whose new text
+    completes `trigger` (on every step if `trigger` is None).
+    '''
+    pattern: str
+    window: int = 64
+    trigger: Optional[str] = None
+    
+    def __post_init__(self):
+        self.regex = re.compile(self.pattern)
+
+class StopOnString(StoppingCriteria):
+    '''
+    Stops every row of a batch independently once its generated text ends with one of `stop_strings`
+    or one of its `stop_patterns` matches.
+    
+    Only the newest token of each row is decoded on every step and only a bounded tail of the generated
+    text is kept and searched, so each check costs the same however long the output gets.
+    '''
+    
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        stop_strings: Sequence[str] = (),
+        stop_patterns: Optional[Sequence[Sequence[StopPattern]]] = None,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_strings = list(stop_strings)
+        # patterns of each row
+        self.stop_patterns = stop_patterns
+        self.window = max(
+            [len(stop) for stop in self.stop_strings]
+            + [pattern.window for patterns in (stop_patterns or []) for pattern in patterns]
+            + [1]
+        )
+        self._tails: List[str] = []
+        self._done: Optional[torch.BoolTensor] = None
+        self._seen = prompt_length
+        # number of tokens each row had generated when it was stopped (None: not stopped by a stop string / pattern)
+        self.stopped_at: List[Optional[int]] = []
+    
+    def _new_text(self, ids: List[int]) -> str:
+        # decode together with the previous token so that tokenizers which drop leading spaces decode correctly
+        if len(ids) == 1:
+            return self.tokenizer.decode(ids)
+        return self.tokenizer.decode(ids)[len(self.tokenizer.decode(ids[:1])):]
+    
     def __call__(self, input_ids, scores, **kwargs):
-        # Flatten the generated token IDs from the first batch (assumes batch size 1)
-        generated_ids = input_ids[0].tolist()
+        batch_size, length = input_ids.shape
+        if self._done is None:
+            self._done = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+            self._tails = [''] * batch_size
+            self.stopped_at = [None] * batch_size
         
-        # If the generated output is shorter than the stop string, keep generating
-        if len(generated_ids) < len(self.stop_string_ids):
-            return False
+        for row in range(batch_size):
+            if self._done[row]:
+                continue
+            
+            new_text = self._new_text(input_ids[row, max(self._seen - 1, self.prompt_length - 1):length].tolist())
+            tail = (self._tails[row] + new_text)[-self.window:]
+            self._tails[row] = tail
+            
+            if any(tail.endswith(stop) for stop in self.stop_strings):
+                self._done[row] = True
+                self.stopped_at[row] = length - self.prompt_length
+                continue
+            
+            for pattern in (self.stop_patterns[row] if self.stop_patterns else []):
+                if pattern.trigger is not None and pattern.trigger not in tail[-(len(new_text) + len(pattern.trigger) - 1):]:
+                    continue
+                if pattern.regex.search(tail[-pattern.window:]):
+                    self._done[row] = True
+                    self.stopped_at[row] = length - self.prompt_length
+                    break
         
-        # Check if the ending tokens match the stop string sequence
-        
-        # debug
-        # print(f'comparing {generated_ids[-len(self.stop_string_ids):]} with {self.stop_string_ids}')
-        
-        if generated_ids[-len(self.stop_string_ids):] == self.stop_string_ids:
-            return True
-        return False
+        self._seen = length
+        return self._done.clone()
+
+class GenerationTimer(StoppingCriteria):
+    '''
+    Records when the first token has been generated (i.e. when prefill is over). Never stops generation.
+    '''
+    
+    def __init__(self):
+        self.first_token_time: Optional[float] = None
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class RowSampler(LogitsProcessor):
+    '''
+    Samples the next token of every row of a batch with the row's own generator, seeded with `seeds[row]`, and
+    leaves it as the only possible token (generation itself is then greedy).
+
+    A row's samples only depend on its seed and its own scores, not on the other rows of the batch nor on the
+    order rows are sampled in, so the same prompt draws the same output alone or batched. Temperature and
+    top-p are applied as `generate` would.
+    '''
+
+    def __init__(self, seeds: Sequence[int], temperature: float = 1.0, top_p: float = 1.0):
+        self.seeds = list(seeds)
+        self.warpers = []
+        if temperature != 1.0:
+            self.warpers.append(TemperatureLogitsWarper(temperature))
+        if top_p < 1.0:
+            self.warpers.append(TopPLogitsWarper(top_p))
+        # created on the first step, on the device of the scores
+        self._generators: List[torch.Generator] = []
+
+    def __call__(self, input_ids, scores):
+        if not self._generators:
+            for seed in self.seeds:
+                generator = torch.Generator(device=scores.device)
+                generator.manual_seed(seed)
+                self._generators.append(generator)
+
+        warped = scores.float()
+        for warper in self.warpers:
+            warped = warper(input_ids, warped)
+        probs = torch.softmax(warped, dim=-1)
+        tokens = torch.cat([
+            torch.multinomial(probs[row], 1, generator=generator)
+            for row, generator in enumerate(self._generators)
+        ])
 
+        sampled = torch.full_like(scores, float("-inf"))
+        sampled[torch.arange(scores.shape[0], device=scores.device), tokens] = 0
+        return sampled
 
 def get_device():
+    if _DEVICE is not None:
+        return _DEVICE
     return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def get_model_tools(model: ModelType):
-    model = model.value
-    tokenizer = AutoTokenizer.from_pretrained(model, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(
-        model,
-        torch_dtype=torch.float16,
-        device_map=get_device(),
-        trust_remote_code=True,
-    ).to(get_device())
-    
-    return model, tokenizer
+def set_device(device: Optional[Union[str, torch.device]]) -> None:
+    '''
+    Makes `get_device` return `device` in this process (the default device again if None).
+    '''
+    global _DEVICE
+    _DEVICE = torch.device(device) if device is not None else None
+    if _DEVICE is not None and _DEVICE.type == "cuda":
+        torch.cuda.set_device(_DEVICE)
+
+def get_model_tools(
+    model: ModelType,
+    dtype: torch.dtype = torch.float16,
+    device: Optional[torch.device] = None,
+):
+    '''
+    Returns the (model, tokenizer) pair for `model`, loading it from disk only the first time
+    it is requested for a given dtype and device.
+    '''
+    device = device if device is not None else get_device()
+    key = (model, dtype, str(device))
+    
+    if key not in _MODEL_REGISTRY:
+        tokenizer = AutoTokenizer.from_pretrained(model.value, trust_remote_code=True)
+        _model = AutoModelForCausalLM.from_pretrained(
+            model.value,
+            torch_dtype=dtype,
+            device_map=device,
+            trust_remote_code=True,
+        ).to(device)
+        _MODEL_REGISTRY[key] = (_model, tokenizer)
+    
+    return _MODEL_REGISTRY[key]
+
+def evict_model_tools(model: Optional[ModelType] = None) -> int:
+    '''
+    Drops loaded models from the registry (all of them if `model` is None) and releases their memory.
+    
+    :return: the number of evicted entries
+    '''
+    keys = [key for key in _MODEL_REGISTRY if model is None or key[0] == model]
+    for key in keys:
+        del _MODEL_REGISTRY[key]
+    
+    if keys:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    return len(keys)
     
 if __name__ == '__main__':
     print(type(get_model(ModelType.DEEPSCALE_R)))
\ No newline at end of file
@@ -0,0 +1,321 @@
+import copy
+import random
+from typing import Any, Iterator, Optional, Tuple
+
+class CowDict(dict):
+    '''
+    A dict whose nested dicts and lists are shared with its forks until one of them changes them.
+
+    Every container belongs to an owner (the tree it was created or copied for). A container only changes
+    the children it owns: the first time a tree reaches a child it doesn't own, the child is shallow-copied
+    into the tree. `fork` gives both the forked tree and the new one a new owner, so it only copies the top
+    level, and every later change copies the containers on its path once.
+
+    Plain dicts and lists put in the tree are converted, so they are shared safely too.
+    It is still a dict: it compares, prints and serializes like the equivalent plain dict.
+
+    A nested container referenced before a `fork` (e.g. `users = tree["users"]`) is shared with the fork:
+    changing it through that reference raises `SharedContainerError`, it has to be reached from the tree again.
+    '''
+
+    def __init__(self, data: Any = (), owner: Optional["_Owner"] = None):
+        self._owner = owner if owner is not None else _Owner()
+        super().__init__()
+        for key, value in dict(data).items():
+            self[key] = value
+
+    def _own(self, key: Any, value: Any) -> Any:
+        if isinstance(value, (CowDict, CowList)) and value._owner is not self._owner:
+            value = value._copy(self._owner)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _copy(self, owner: "_Owner") -> "CowDict":
+        other = CowDict.__new__(CowDict)
+        other._owner = owner
+        dict.update(other, self)
+        return other
+
+    def fork(self) -> "CowDict":
+        '''
+        Returns an independent copy of the tree, sharing every nested container with it until one is changed.
+        '''
+        self._owner.forked = True
+        self._owner = _Owner()
+        return self._copy(_Owner())
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._own(key, dict.__getitem__(self, key))
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            return default
+        return self[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        _check_owner(self)
+        dict.__setitem__(self, key, _adopt(value, self._owner))
+
+    def __delitem__(self, key: Any) -> None:
+        _check_owner(self)
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other: Any) -> "CowDict":
+        # dict.__ior__ would store the values as they are
+        self.update(other)
+        return self
+
+    def __or__(self, other: Any) -> dict:
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = dict(self.items())
+        merged.update(other)
+        return merged
+
+    def __ror__(self, other: Any) -> dict:
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = dict(other)
+        merged.update(self.items())
+        return merged
+
+    def copy(self) -> dict:
+        # a shallow copy, like dict.copy, of the values as this tree sees them
+        return dict(self.items())
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        _check_owner(self)
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        dict.__delitem__(self, key)
+        return value
+
+    def popitem(self) -> Tuple[Any, Any]:
+        _check_owner(self)
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = next(reversed(dict.keys(self)))
+        return key, self.pop(key)
+
+    def clear(self) -> None:
+        _check_owner(self)
+        dict.clear(self)
+
+    def values(self):
+        for key in self:
+            self[key]
+        return dict.values(self)
+
+    def items(self):
+        for key in self:
+            self[key]
+        return dict.items(self)
+
+    def __reduce__(self):
+        return (CowDict, (dict(self),))
+
+class CowList(list):
+    '''
+    The list counterpart of `CowDict`.
+    '''
+
+    def __init__(self, data: Any = (), owner: Optional["_Owner"] = None):
+        self._owner = owner if owner is not None else _Owner()
+        super().__init__(_adopt(value, self._owner) for value in data)
+
+    def _own(self, index: int, value: Any) -> Any:
+        if isinstance(value, (CowDict, CowList)) and value._owner is not self._owner:
+            value = value._copy(self._owner)
+            list.__setitem__(self, index, value)
+        return value
+
+    def _copy(self, owner: "_Owner") -> "CowList":
+        other = CowList.__new__(CowList)
+        other._owner = owner
+        list.extend(other, self)
+        return other
+
+    def fork(self) -> "CowList":
+        '''
+        See `CowDict.fork`.
+        '''
+        self._owner.forked = True
+        self._owner = _Owner()
+        return self._copy(_Owner())
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._own(index, list.__getitem__(self, index))
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self) -> Iterator[Any]:
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        _check_owner(self)
+        if isinstance(index, slice):
+            value = [_adopt(v, self._owner) for v in value]
+        else:
+            value = _adopt(value, self._owner)
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index: Any) -> None:
+        _check_owner(self)
+        list.__delitem__(self, index)
+
+    def append(self, value: Any) -> None:
+        _check_owner(self)
+        list.append(self, _adopt(value, self._owner))
+
+    def insert(self, index: int, value: Any) -> None:
+        _check_owner(self)
+        list.insert(self, index, _adopt(value, self._owner))
+
+    def extend(self, values: Any) -> None:
+        _check_owner(self)
+        list.extend(self, [_adopt(value, self._owner) for value in values])
+
+    def __iadd__(self, values: Any) -> "CowList":
+        self.extend(values)
+        return self
+
+    def __imul__(self, n: int) -> "CowList":
+        _check_owner(self)
+        return list.__imul__(self, n)
+
+    def __add__(self, other: Any) -> list:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) + list(other)
+
+    def copy(self) -> list:
+        # a shallow copy, like list.copy, of the values as this tree sees them
+        return list(self)
+
+    def pop(self, index: int = -1) -> Any:
+        _check_owner(self)
+        value = self[index]
+        list.pop(self, index)
+        return value
+
+    def remove(self, value: Any) -> None:
+        _check_owner(self)
+        list.remove(self, value)
+
+    def clear(self) -> None:
+        _check_owner(self)
+        list.clear(self)
+
+    def sort(self, *args: Any, **kwargs: Any) -> None:
+        _check_owner(self)
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self) -> None:
+        _check_owner(self)
+        list.reverse(self)
+
+    def __reduce__(self):
+        return (CowList, (list(self),))
+
+class SharedContainerError(RuntimeError):
+    '''
+    A container shared with a fork was changed through a reference taken before the fork.
+    '''
+
+class _Owner:
+    '''
+    The tree a container belongs to. A forked tree gets a new owner, so the old one marks the containers
+    which are shared with the fork.
+    '''
+    __slots__ = ("forked",)
+
+    def __init__(self):
+        self.forked = False
+
+def _check_owner(container: Any) -> None:
+    if container._owner.forked:
+        raise SharedContainerError(
+            "This container is shared with a fork of its tree: reach it from the tree again to change it"
+        )
+
+def _adopt(value: Any, owner: "_Owner") -> Any:
+    # plain containers are converted (copied) into the tree of `owner`, shared ones are copied once reached
+    if type(value) is dict:
+        return CowDict(value, owner=owner)
+    if type(value) is list:
+        return CowList(value, owner=owner)
+    return value
+
+# values which can be shared as they are
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+def is_plain(value: Any) -> bool:
+    '''
+    Whether `value` is made of dicts, lists and immutable values only, i.e. can be shared copy-on-write.
+    '''
+    if isinstance(value, (dict, list)):
+        items = dict.items(value) if isinstance(value, dict) else [(None, v) for v in list.__iter__(value)]
+        return all(_is_immutable(k) and is_plain(v) for k, v in items)
+    return _is_immutable(value)
+
+def _is_immutable(value: Any) -> bool:
+    if type(value) is tuple:
+        return all(_is_immutable(v) for v in value)
+    return isinstance(value, IMMUTABLE_TYPES)
+
+def freeze(obj: Any) -> Any:
+    '''
+    Turns the plain dict / list attributes of `obj` into copy-on-write ones, so that `fork` can share them.
+    '''
+    for name, value in vars(obj).items():
+        if type(value) in (dict, list) and is_plain(value):
+            setattr(obj, name, CowDict(value) if type(value) is dict else CowList(value))
+    return obj
+
+def fork(obj: Any) -> Any:
+    '''
+    Returns an independent copy of `obj`: its copy-on-write attributes are forked, the other mutable ones
+    (e.g. object trees) are deep-copied together, so references between them are kept.
+    '''
+    other = copy.copy(obj)
+    memo = {}
+    for name, value in vars(obj).items():
+        if isinstance(value, (CowDict, CowList)):
+            setattr(other, name, value.fork())
+        elif isinstance(value, random.Random):
+            # much faster than deep-copying it (which pickles its state)
+            clone = random.Random()
+            clone.setstate(value.getstate())
+            setattr(other, name, clone)
+        elif isinstance(value, (set, frozenset)) and all(_is_immutable(v) for v in value):
+            setattr(other, name, value.copy())
+        elif not _is_immutable(value):
+            setattr(other, name, copy.deepcopy(value, memo))
+    return other
+
+def is_cheap_to_fork(obj: Any) -> bool:
+    '''
+    Whether `fork` copies nothing but the top level of `obj`'s attributes (no deep copies).
+    '''
+    for value in vars(obj).values():
+        if isinstance(value, (CowDict, CowList, random.Random)) or _is_immutable(value):
+            continue
+        if isinstance(value, (set, frozenset)) and all(_is_immutable(v) for v in value):
+            continue
+        return False
+    return True
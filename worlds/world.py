@@ -1,7 +1,10 @@
+import copy
 from llm_tool import tool
 from typing import List, Dict, Optional
 from dataclasses import dataclass
 
+from worlds.cow import CowDict
+
 @dataclass
 class World:
     tool_definitions: List[Dict]
@@ -25,4 +28,33 @@ class World:
         ]
         
     def reset_world_state(self):
-        self.world_state = self._init_world_state.copy()
+        self.restore(self._init_snapshot())
+    
+    def _init_snapshot(self) -> CowDict:
+        # converted once per initial state, every reset then forks it
+        if getattr(self, "_init_snapshot_source", None) is not self._init_world_state:
+            self._init_world_state_snapshot = CowDict(self._init_world_state)
+            self._init_snapshot_source = self._init_world_state
+        return self._init_world_state_snapshot
+    
+    def snapshot(self) -> CowDict:
+        '''
+        Returns a copy of the world state to `restore` later. It shares everything with the state,
+        so it only costs a copy of the top level (later changes copy what they change).
+        The snapshot must not be changed.
+        '''
+        if not isinstance(self.world_state, CowDict):
+            self.world_state = CowDict(self.world_state)
+        return self.world_state.fork()
+    
+    def restore(self, snapshot: CowDict):
+        self.world_state = snapshot.fork()
+    
+    def fork(self) -> "World":
+        '''
+        Returns a copy of the world with its own copy-on-write copy of the state,
+        e.g. to run many episodes from the same state.
+        '''
+        other = copy.copy(self)
+        other.world_state = self.snapshot()
+        return other